@@ -0,0 +1,219 @@
+# benchmark.py
+# Benchmarks da camada de serviços contra um banco local (SQLite e/ou um Postgres local).
+# Popula datasets em várias escalas com o datagen, mede cada função de services.py com
+# aquecimento e percentis e grava JSON comparável entre commits.
+#
+# Uso:
+#   python benchmark.py --scales 1k,100k --out bench_head.json
+#   python benchmark.py --url postgresql://localhost/bench --scales 1k,100k,10m --out bench_pg.json
+#   python benchmark.py --compare bench_base.json bench_head.json [--threshold 10]
+#
+# Os datasets ficam em --data-dir (SQLite) ou num schema bench_<escala> (Postgres) e são reaproveitados.
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta
+import sqlalchemy
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import sessionmaker
+from database import build_engine
+from models import Company, Product, User
+import cache
+import datagen
+import migrations
+import rollup
+import services as api
+
+SCALES = {
+    '1k': dict(sales=1_000, tenants=1, products=50, days=30),
+    '100k': dict(sales=100_000, tenants=5, products=1_000, days=365),
+    '10m': dict(sales=10_000_000, tenants=50, products=5_000, days=730),
+}
+BENCH_PASSWORD = "bench123"
+
+# --- PREPARAÇÃO DOS DATASETS ---
+def _engine_for(url: str, scale: str, data_dir: str):
+    if url == "sqlite":
+        os.makedirs(data_dir, exist_ok=True)
+        return build_engine("sqlite:///" + os.path.join(data_dir, f"bench_{scale}.db"))
+    if url.startswith("postgresql"):
+        schema = f"bench_{scale}"
+        with create_engine(url).begin() as conn:
+            conn.execute(text(f"CREATE SCHEMA IF NOT EXISTS {schema}"))
+        sep = "&" if "?" in url else "?"
+        return build_engine(f"{url}{sep}options=-csearch_path%3D{schema}")
+    return build_engine(url)
+
+def prepare(url: str, scale: str, data_dir: str):
+    """Garante o dataset da escala (popula só na primeira vez). Retorna (engine, empresa, produto, usuário)."""
+    spec = SCALES[scale]
+    engine = _engine_for(url, scale, data_dir)
+    migrations.upgrade(engine)
+    Session_ = sessionmaker(bind=engine, expire_on_commit=False)
+    prefix = f"Bench {scale}"
+    with Session_() as db:
+        company = db.query(Company).filter(Company.name.like(f"{prefix} %")).order_by(Company.id).first()
+    if company is None:
+        started = time.perf_counter()
+        # O gerador faz dias úteis com a média pedida e fins de semana com 40% dela
+        per_day = spec['sales'] / (spec['tenants'] * spec['days'] * (5 + 2 * 0.4) / 7)
+        with engine.begin() as conn:
+            report = datagen.generate(conn, spec['tenants'], spec['products'], spec['days'], per_day, seed=42, name_prefix=prefix)
+        with Session_() as db:
+            rollup.rebuild(db)
+            company = db.query(Company).filter(Company.id == report['company_ids'][0]).one()
+            db.add(User(username=f"bench_{scale}", password_hash=api.hash_password(BENCH_PASSWORD), role="admin", company_id=company.id))
+            db.commit()
+        with engine.begin() as conn:
+            conn.exec_driver_sql("ANALYZE")
+        print(f"  dataset {scale}: {report['sales']['rows']:,} vendas em {time.perf_counter() - started:.1f} s", file=sys.stderr)
+    with Session_() as db:
+        product = db.query(Product).filter(Product.company_id == company.id).order_by(Product.id).first()
+        # Estoque "infinito" para o process_sale nunca falhar durante a medição
+        product.stock = 10 ** 9
+        db.commit()
+        user = db.query(User).filter(User.username == f"bench_{scale}").one()
+    return engine, company, product, user
+
+# --- MEDIÇÃO ---
+def _cases(company, product, user):
+    now = datetime.now()
+    start, end = now - timedelta(days=30), now
+    pdf_data = {}
+
+    def pdf_setup(db):
+        # Os DataFrames do relatório saem do banco fora da medição (e sem depender de outro caso)
+        pdf_data['df'] = api.get_financial_by_range.uncached(db, company.id, start, end)
+
+    def dashboard(db):
+        # Carga completa do Dashboard com o cache vazio (as quatro consultas vão ao banco)
+        cache.invalidate(company.id)
+        api.load_dashboard(sessionmaker(bind=db.get_bind()), company.id, 30, start, end)
+
+    # Leituras chamam a função sem o cache de cache.py: medimos o caminho até o banco.
+    # Um terceiro elemento opcional é a preparação do caso, executada uma vez antes do aquecimento.
+    return [
+        ("authenticate", lambda db: api.authenticate(db, user.username, BENCH_PASSWORD)),
+        ("process_sale", lambda db: api.process_sale(db, product.id, 1, "varejo", user.id, company.id)),
+        ("process_cart_10", lambda db: api.process_cart(db, [{'id': product.id}] * 10, user.id, company.id)),
+        ("get_products", lambda db: api.get_products.uncached(db, company.id)),
+        ("get_inventory_summary", lambda db: api.get_inventory_summary.uncached(db, company.id)),
+        ("get_inventory", lambda db: api.get_inventory.uncached(db, company.id)),
+        ("search_products", lambda db: api.search_products.uncached(db, company.id, "modelo 00")),
+        ("get_financial_by_range_30d", lambda db: api.get_financial_by_range.uncached(db, company.id, start, end)),
+        ("get_closing_totals_30d", lambda db: api.get_closing_totals.uncached(db, company.id, start, end)),
+        ("get_sales_page_30d", lambda db: api.get_sales_page.uncached(db, company.id, start, end)),
+        ("get_period_kpis_30d", lambda db: api.get_period_kpis.uncached(db, company.id, 30)),
+        ("get_daily_summary_30d", lambda db: api.get_daily_summary.uncached(db, company.id, start.date(), end.date())),
+        ("get_sales_heatmap_30d", lambda db: api.get_sales_heatmap.uncached(db, company.id, start, end)),
+        ("get_top_products_30d", lambda db: api.get_top_products.uncached(db, company.id, start, end)),
+        ("load_dashboard_30d", dashboard),
+        ("generate_financial_pdf", lambda db: api.generate_financial_pdf(*pdf_data['df'], "30 dias", company.name), pdf_setup),
+    ]
+
+def _percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    k = (len(sorted_values) - 1) * q
+    lo, hi = int(k), min(int(k) + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo)
+
+def measure(Session_, fn, warmup: int, iterations: int, setup=None):
+    if setup:
+        with Session_() as db:
+            setup(db)
+    for _ in range(warmup):
+        with Session_() as db:
+            fn(db)
+    samples = []
+    for _ in range(iterations):
+        with Session_() as db:
+            t0 = time.perf_counter()
+            fn(db)
+            samples.append(time.perf_counter() - t0)
+    samples.sort()
+    ms = lambda v: round(v * 1000, 3)
+    return {
+        'iterations': iterations,
+        'mean_ms': ms(statistics.fmean(samples)), 'min_ms': ms(samples[0]), 'max_ms': ms(samples[-1]),
+        'p50_ms': ms(_percentile(samples, 0.50)), 'p90_ms': ms(_percentile(samples, 0.90)),
+        'p99_ms': ms(_percentile(samples, 0.99)),
+    }
+
+def run(urls, scales, warmup: int, iterations: int, data_dir: str, only=None):
+    results = []
+    for url in urls:
+        for scale in scales:
+            engine, company, product, user = prepare(url, scale, data_dir)
+            Session_ = sessionmaker(bind=engine, autoflush=False, expire_on_commit=False)
+            target = engine.dialect.name
+            for name, fn, *setup in _cases(company, product, user):
+                if only and name not in only:
+                    continue
+                stats = measure(Session_, fn, warmup, iterations, *setup)
+                results.append({'target': target, 'scale': scale, 'name': name, **stats})
+                print(f"  {target:10} {scale:5} {name:28} p50 {stats['p50_ms']:9.2f} ms  p99 {stats['p99_ms']:9.2f} ms", file=sys.stderr)
+            engine.dispose()
+    return results
+
+def _meta():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ""
+    return {
+        'commit': commit, 'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(), 'sqlalchemy': sqlalchemy.__version__, 'machine': platform.machine(),
+    }
+
+# --- COMPARAÇÃO ENTRE EXECUÇÕES ---
+def compare(base_path: str, head_path: str, threshold: float, metric: str = 'p50_ms'):
+    """Imprime a variação por caso; retorna quantos pioraram mais que `threshold` %."""
+    load = lambda p: {(r['target'], r['scale'], r['name']): r for r in json.load(open(p))['results']}
+    base, head = load(base_path), load(head_path)
+    regressions = 0
+    print(f"{'alvo':10} {'escala':6} {'caso':28} {'base':>10} {'head':>10} {'Δ%':>8}")
+    for key in sorted(set(base) & set(head)):
+        b, h = base[key][metric], head[key][metric]
+        delta = (h - b) / b * 100 if b else 0.0
+        flag = ""
+        if delta > threshold:
+            regressions += 1
+            flag = "  <-- regressão"
+        print(f"{key[0]:10} {key[1]:6} {key[2]:28} {b:10.2f} {h:10.2f} {delta:+8.1f}{flag}")
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks da camada de serviços")
+    parser.add_argument("--url", action="append", help="'sqlite' (padrão) ou URL de um Postgres LOCAL; pode repetir")
+    parser.add_argument("--scales", default="1k,100k", help=f"Escalas separadas por vírgula: {', '.join(SCALES)}")
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--iterations", type=int, default=30)
+    parser.add_argument("--only", default=None, help="Casos separados por vírgula (padrão: todos)")
+    parser.add_argument("--data-dir", default=".bench")
+    parser.add_argument("--out", default=None, help="Arquivo JSON de saída (padrão: stdout)")
+    parser.add_argument("--compare", nargs=2, metavar=("BASE", "HEAD"), help="Compara dois JSONs de resultado")
+    parser.add_argument("--threshold", type=float, default=10.0, help="Piora máxima tolerada em %% no --compare")
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(1 if compare(*args.compare, args.threshold) else 0)
+
+    scales = [s.strip().lower() for s in args.scales.split(",")]
+    unknown = [s for s in scales if s not in SCALES]
+    if unknown:
+        parser.error(f"escala desconhecida: {', '.join(unknown)}")
+    only = set(args.only.split(",")) if args.only else None
+    output = {'meta': _meta(), 'results': run(args.url or ["sqlite"], scales, args.warmup, args.iterations, args.data_dir, only)}
+    payload = json.dumps(output, indent=2, ensure_ascii=False)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(payload)
+    else:
+        print(payload)
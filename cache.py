@@ -0,0 +1,133 @@
+# cache.py
+# Cache em memória (por processo) das leituras de services.py.
+# Cada rerun do Streamlit chama as mesmas consultas; com o banco remoto cada uma custa
+# dezenas de ms. As entradas são separadas por empresa, têm TTL e despejo LRU, e são
+# invalidadas pelas escritas (venda, reposição, cadastro, despesa) através de "tags".
+import functools
+import threading
+import time
+from collections import OrderedDict
+import pandas as pd
+
+MAX_ENTRIES = 512
+DEFAULT_TTL = 60  # segundos; protege contra escritas feitas por outros processos
+
+class TTLCache:
+    def __init__(self, maxsize: int = MAX_ENTRIES, ttl: float = DEFAULT_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (expira_em, tags, valor)
+        self._changed = {}          # company_id -> instante (monotonic) da última invalidação
+        self._generations = {}      # (company_id, tag ou None = todas) -> invalidações até agora
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+
+    def get(self, key):
+        """Retorna (achou, valor)."""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return False, None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return True, entry[2]
+
+    def generation(self, company_id, tags=()):
+        """Marca das invalidações que atingem estas tags da empresa; tire antes de ler do banco."""
+        with self._lock:
+            return tuple(self._generations.get((company_id, tag), 0) for tag in (None, *tags))
+
+    def set(self, key, value, tags=(), ttl: float = None, generation=None):
+        """Guarda o valor; com `generation`, só se nenhuma invalidação das tags ocorreu desde que ela foi tirada."""
+        with self._lock:
+            if generation is not None and generation != tuple(
+                    self._generations.get((key[0], tag), 0) for tag in (None, *tags)):
+                return False  # leitura anterior a uma escrita: o valor já nasceu velho
+            self._data[key] = (time.monotonic() + (ttl or self.ttl), frozenset(tags), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+            return True
+
+    def invalidate(self, company_id, *tags):
+        """Remove as entradas da empresa que dependem de alguma das tags (todas, se nenhuma tag)."""
+        with self._lock:
+            wanted = set(tags)
+            stale = [k for k, (_, entry_tags, _) in self._data.items()
+                     if k[0] == company_id and (not wanted or entry_tags & wanted)]
+            for k in stale:
+                del self._data[k]
+            self.invalidations += len(stale)
+            for tag in wanted or (None,):
+                self._generations[(company_id, tag)] = self._generations.get((company_id, tag), 0) + 1
+            self._changed[company_id] = time.monotonic()
+
+    def changed_at(self, company_id):
+        with self._lock:
+            return self._changed.get(company_id)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0,
+                'evictions': self.evictions, 'invalidations': self.invalidations,
+                'size': len(self._data), 'maxsize': self.maxsize,
+            }
+
+_cache = TTLCache()
+
+def _clone(value):
+    # Quem chama pode alterar DataFrames/listas devolvidos; o valor guardado não pode mudar
+    if isinstance(value, pd.DataFrame):
+        return value.copy()
+    if isinstance(value, tuple) and not hasattr(value, '_fields'):
+        return tuple(_clone(v) for v in value)
+    if isinstance(value, list):
+        return list(value)
+    return value
+
+def cached(tags=(), ttl: float = None):
+    """
+    Decorador para leituras com assinatura fn(db, company_id, *args).
+    A chave é (company_id, módulo.nome da função, argumentos); `tags` dizem de quais dados a leitura depende.
+    O valor é compartilhado entre as sessões: devolva linhas, DataFrames ou dataclasses, nunca objetos ORM.
+    """
+    def decorator(fn):
+        name = f"{fn.__module__}.{fn.__qualname__}"
+
+        @functools.wraps(fn)
+        def wrapper(db, company_id, *args, **kwargs):
+            key = (company_id, name, args, tuple(sorted(kwargs.items())))
+            hit, value = _cache.get(key)
+            if not hit:
+                # Uma escrita que invalide estas tags durante a leitura descarta o resultado (não vai ao cache)
+                generation = _cache.generation(company_id, tags)
+                value = fn(db, company_id, *args, **kwargs)
+                _cache.set(key, value, tags, ttl, generation)
+            return _clone(value)
+        wrapper.uncached = fn
+        return wrapper
+    return decorator
+
+def invalidate(company_id, *tags):
+    _cache.invalidate(company_id, *tags)
+
+def clear():
+    _cache.clear()
+
+def last_write(company_id):
+    """Instante (time.monotonic) da última escrita da empresa neste processo, ou None."""
+    return _cache.changed_at(company_id)
+
+def stats():
+    return _cache.stats()
@@ -0,0 +1,92 @@
+# cart.py
+# Carrinho do PDV: uma linha por produto, com quantidade e faixa de preço (varejo/atacado),
+# e totais ajustados a cada alteração pela diferença da linha. Repetir o mesmo produto só
+# soma quantidade: cupom e checkout custam o mesmo para 1 ou 500 unidades de um item.
+from dataclasses import dataclass
+
+RETAIL, WHOLESALE = "varejo", "atacado"
+KINDS = (RETAIL, WHOLESALE)
+
+def unit_price(price_retail: float, price_wholesale: float, kind: str):
+    """Preço unitário da faixa; produto sem preço de atacado vende no varejo."""
+    if kind == WHOLESALE and price_wholesale:
+        return price_wholesale
+    return price_retail
+
+@dataclass
+class CartLine:
+    id: int
+    name: str
+    price_retail: float
+    price_wholesale: float
+    qty: int = 0
+    kind: str = RETAIL
+
+    @property
+    def unit_price(self):
+        return unit_price(self.price_retail, self.price_wholesale, self.kind)
+
+    @property
+    def total(self):
+        return self.unit_price * self.qty
+
+class Cart:
+    def __init__(self):
+        self.lines = {}   # product_id -> CartLine, na ordem de inclusão
+        self.total = 0.0
+        self.units = 0
+        self.version = 0  # muda a cada alteração (chave dos widgets que mostram o carrinho)
+
+    def __len__(self):
+        return len(self.lines)
+
+    def __iter__(self):
+        return iter(self.lines.values())
+
+    def _apply(self, line: CartLine, qty: int = None, kind: str = None):
+        # Só a diferença da linha entra nos totais: custo constante por alteração
+        self.total -= line.total
+        self.units -= line.qty
+        if qty is not None:
+            line.qty = qty
+        if kind is not None:
+            line.kind = kind
+        self.total += line.total
+        self.units += line.qty
+        self.version += 1
+
+    def add(self, product_id: int, name: str, price_retail: float, price_wholesale: float, qty: int = 1, kind: str = None):
+        line = self.lines.get(product_id)
+        if line is None:
+            line = self.lines[product_id] = CartLine(product_id, name, price_retail, price_wholesale, 0, kind or RETAIL)
+        self._apply(line, qty=line.qty + qty, kind=kind)
+        return line
+
+    def set_qty(self, product_id: int, qty: int):
+        if qty <= 0:
+            self.remove(product_id)
+        else:
+            self._apply(self.lines[product_id], qty=qty)
+
+    def set_kind(self, product_id: int, kind: str):
+        if kind not in KINDS:
+            raise ValueError(f"Faixa de preço desconhecida: {kind}")
+        self._apply(self.lines[product_id], kind=kind)
+
+    def remove(self, product_id: int):
+        line = self.lines.pop(product_id, None)
+        if line is not None:
+            self.total -= line.total
+            self.units -= line.qty
+            self.version += 1
+        if not self.lines:
+            self.total, self.units = 0.0, 0  # sem resíduo de arredondamento
+
+    def clear(self):
+        self.lines.clear()
+        self.total, self.units = 0.0, 0
+        self.version += 1
+
+    def items(self):
+        """Uma linha por produto no formato de services.process_cart."""
+        return [{'id': line.id, 'qty': line.qty, 'kind': line.kind} for line in self]
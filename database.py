@@ -1,7 +1,16 @@
+import os
+import threading
+import time
 import urllib.parse
-from sqlalchemy import create_engine
+import weakref
+from contextlib import contextmanager
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
+import cache
+import instrumentation
 
 # Dados extraídos da sua última atualização
 user = "neondb_owner"
@@ -13,23 +22,161 @@ password = urllib.parse.quote_plus(password_raw)
 host = "ep-long-scene-ah1e55pi-pooler.c-3.us-east-1.aws.neon.tech"
 dbname = "neondb"
 
-# String de conexão com SSL Obrigatório
-SQLALCHEMY_DATABASE_URL = f"postgresql://{user}:{password}@{host}/{dbname}?sslmode=require"
-
-# Configuração da Engine para Nuvem (Neon)
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL,
-    pool_pre_ping=True,  # Testa a conexão antes de usar (evita quedas)
-    pool_recycle=300,    # Reinicia conexões a cada 5 minutos
-    connect_args={'connect_timeout': 10}
+# String de conexão com SSL Obrigatório (PEEGFLOW_DATABASE_URL substitui, ex.: banco local)
+SQLALCHEMY_DATABASE_URL = os.environ.get(
+    "PEEGFLOW_DATABASE_URL",
+    f"postgresql://{user}:{password}@{host}/{dbname}?sslmode=require"
 )
 
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# Réplica de leitura (opcional): Dashboard e relatórios leem dela; sem a variável tudo vai ao primário.
+# Teste local com dois arquivos: PEEGFLOW_DATABASE_URL=sqlite:///primario.db PEEGFLOW_REPLICA_URL=sqlite:///replica.db
+REPLICA_URL = os.environ.get("PEEGFLOW_REPLICA_URL")
+# Depois de uma escrita da empresa, as leituras dela ficam no primário por este tempo (segundos),
+# para que o caixa veja a própria venda mesmo com a réplica atrasada
+READ_YOUR_WRITES = float(os.environ.get("PEEGFLOW_READ_YOUR_WRITES", 10))
+
+# Tamanho do pool por processo: conexões fixas + extras temporárias, e espera máxima por uma conexão
+POOL_SIZE = int(os.environ.get("PEEGFLOW_POOL_SIZE", 5))
+MAX_OVERFLOW = int(os.environ.get("PEEGFLOW_MAX_OVERFLOW", 10))
+POOL_TIMEOUT = float(os.environ.get("PEEGFLOW_POOL_TIMEOUT", 30))
+
+# --- ESTATÍSTICAS DO POOL ---
+class PoolStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.connects = self.checkouts = self.checkins = self.timeouts = 0
+        self.wait_total = self.wait_max = 0.0
+
+    def add(self, field, n=1):
+        with self._lock:
+            setattr(self, field, getattr(self, field) + n)
+
+    def record_wait(self, seconds):
+        with self._lock:
+            self.wait_total += seconds
+            self.wait_max = max(self.wait_max, seconds)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'connects': self.connects, 'checkouts': self.checkouts, 'checkins': self.checkins,
+                'timeouts': self.timeouts,
+                'wait_avg_ms': self.wait_total / self.checkouts * 1000 if self.checkouts else 0.0,
+                'wait_max_ms': self.wait_max * 1000,
+            }
+
+# Uma por engine (primário e réplica têm pools diferentes e são medidos à parte)
+_engine_stats = weakref.WeakKeyDictionary()
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool que mede quanto tempo cada checkout esperou por uma conexão livre."""
+    stats = None  # PoolStats da engine dona, atribuído em build_engine
+
+    def recreate(self):
+        # engine.dispose() troca o pool por um novo: as estatísticas continuam as mesmas
+        pool = super().recreate()
+        pool.stats = self.stats
+        return pool
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            conn = super()._do_get()
+        except PoolTimeoutError:
+            self.stats.add('timeouts')
+            raise
+        self.stats.record_wait(time.perf_counter() - start)
+        return conn
+
+def build_engine(url: str, pool_size: int = POOL_SIZE, max_overflow: int = MAX_OVERFLOW, pool_timeout: float = POOL_TIMEOUT):
+    if url.startswith("sqlite"):
+        # SQLite local (testes/benchmarks): o pool padrão já é adequado
+        new_engine = create_engine(url, connect_args={'check_same_thread': False})
+    else:
+        # Configuração da Engine para Nuvem (Neon)
+        new_engine = create_engine(
+            url,
+            poolclass=InstrumentedQueuePool,
+            pool_size=pool_size,
+            max_overflow=max_overflow,
+            pool_timeout=pool_timeout,
+            pool_pre_ping=True,  # Testa a conexão antes de usar (evita quedas)
+            pool_recycle=300,    # Reinicia conexões a cada 5 minutos
+            connect_args={'connect_timeout': 10}
+        )
+    stats = _engine_stats[new_engine] = PoolStats()
+    if isinstance(new_engine.pool, InstrumentedQueuePool):
+        new_engine.pool.stats = stats
+    event.listen(new_engine, "connect", lambda *a: stats.add('connects'))
+    event.listen(new_engine, "checkout", lambda *a: stats.add('checkouts'))
+    event.listen(new_engine, "checkin", lambda *a: stats.add('checkins'))
+    instrumentation.instrument(new_engine)  # tempo, linhas e origem de cada comando SQL
+    return new_engine
+
+# Uma única engine (e um único pool) por processo: o módulo só é importado uma vez,
+# mesmo com o Streamlit reexecutando main.py a cada interação.
+engine = build_engine(SQLALCHEMY_DATABASE_URL)
+
+# expire_on_commit=False: objetos carregados continuam legíveis depois que a sessão fecha
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=engine)
 Base = declarative_base()
 
+# Engine e sessões da réplica (as mesmas do primário quando não há réplica configurada)
+replica_engine = build_engine(REPLICA_URL) if REPLICA_URL else engine
+ReplicaSessionLocal = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=replica_engine) \
+    if REPLICA_URL else SessionLocal
+
+def engine_pool_status(target):
+    """Estado atual do pool da engine (em uso, livres, overflow) somado às estatísticas acumuladas dela."""
+    status = _engine_stats[target].snapshot()
+    pool = target.pool
+    if isinstance(pool, QueuePool):
+        status.update(size=pool.size(), checked_out=pool.checkedout(), idle=pool.checkedin(),
+                      overflow=pool.overflow(), max_overflow=MAX_OVERFLOW)
+    return status
+
+def pool_status():
+    """Estado de cada pool do processo: {'primary': {...}} e, com réplica configurada, também {'replica': {...}}."""
+    status = {'primary': engine_pool_status(engine)}
+    if replica_engine is not engine:
+        status['replica'] = engine_pool_status(replica_engine)
+    return status
+
+@contextmanager
+def session_scope():
+    """Uma sessão por unidade de trabalho: commit ao final, rollback em erro e sempre devolvida ao pool."""
+    db = SessionLocal()
+    try:
+        yield db
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+# --- ROTEAMENTO DE LEITURAS ---
+def read_sessionmaker(company_id: int = None):
+    """Fábrica de sessões para leituras: a réplica, ou o primário se a empresa escreveu há menos de READ_YOUR_WRITES s."""
+    if ReplicaSessionLocal is SessionLocal:
+        return SessionLocal
+    last = cache.last_write(company_id) if company_id is not None else None
+    if last is not None and time.monotonic() - last < READ_YOUR_WRITES:
+        return SessionLocal
+    return ReplicaSessionLocal
+
+@contextmanager
+def read_scope(company_id: int = None):
+    """Sessão só de leitura (Dashboard, relatórios), roteada por read_sessionmaker; nunca faz commit."""
+    db = read_sessionmaker(company_id)()
+    try:
+        yield db
+    finally:
+        db.close()
+
 def get_db():
     db = SessionLocal()
     try:
         yield db
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
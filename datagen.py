@@ -0,0 +1,169 @@
+# datagen.py
+# Gerador de dados sintéticos em volume (empresas, produtos, vendas, despesas).
+# Escreve por caminhos em lote: COPY no Postgres (psycopg2) e INSERT em lotes
+# (executemany) nos demais bancos, como o SQLite. Com a mesma semente gera os mesmos dados.
+#
+# Uso: python datagen.py --url postgresql://... --tenants 10 --products 2000 --days 365 --sales-per-day 500 --seed 42
+import argparse
+import csv
+import io
+import random
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import insert, select
+from sqlalchemy.engine import Connection
+from models import Company, Product, Sale, Expense
+
+BATCH_SIZE = 10000
+
+CATEGORIES = ["Smartphones", "Notebooks", "Áudio", "Wearables", "Acessórios", "Tablets"]
+
+# --- ESCRITA EM LOTE ---
+def _copy_rows(conn: Connection, table, columns, rows):
+    """COPY ... FROM STDIN (CSV) pela conexão psycopg2 da transação atual."""
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    for row in rows:
+        writer.writerow(["" if row[c] is None else row[c] for c in columns])
+    buf.seek(0)
+    cursor = conn.connection.dbapi_connection.cursor()
+    try:
+        cursor.copy_expert(f"COPY {table.name} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", buf)
+    finally:
+        cursor.close()
+
+def bulk_insert(conn: Connection, model, rows, batch_size: int = BATCH_SIZE):
+    """Grava um iterável de dicts em lotes; retorna quantas linhas foram escritas."""
+    table = model.__table__
+    use_copy = conn.dialect.name == "postgresql" and conn.dialect.driver == "psycopg2"
+    total, batch = 0, []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            total += _flush(conn, table, batch, use_copy)
+            batch = []
+    if batch:
+        total += _flush(conn, table, batch, use_copy)
+    return total
+
+def _flush(conn, table, batch, use_copy):
+    if use_copy:
+        _copy_rows(conn, table, list(batch[0].keys()), batch)
+    else:
+        conn.execute(insert(table), batch)
+    return len(batch)
+
+# --- GERAÇÃO ---
+def _sales_rows(rng, company_id, products, days, sales_per_day, end, user_id):
+    for i in range(days - 1, -1, -1):
+        day = (end - timedelta(days=i)).replace(hour=0, minute=0, second=0, microsecond=0)
+        # Mais volume em dias de semana
+        mean = sales_per_day if day.weekday() < 5 else sales_per_day * 0.4
+        count = max(0, int(rng.gauss(mean, mean * 0.25)))
+        for _ in range(count):
+            p = rng.choice(products)
+            wholesale = rng.random() < 0.1
+            yield dict(
+                product_id=p[0],
+                quantity=rng.randint(5, 20) if wholesale else rng.choices([1, 2, 3], [70, 20, 10])[0],
+                price=p[2] if wholesale else p[1],
+                kind="atacado" if wholesale else "varejo",
+                date=day + timedelta(seconds=rng.randint(9 * 3600, 21 * 3600)),  # horário comercial
+                user_id=user_id,
+                company_id=company_id,
+            )
+
+def _expense_rows(rng, company_id, days, end):
+    for i in range(days - 1, -1, -1):
+        day = end - timedelta(days=i)
+        # Despesas Fixas e Variáveis
+        if day.day == 5:
+            yield dict(description="Aluguel Mensal", amount=2800.0, category="Aluguel", company_id=company_id, date=day)
+        if rng.random() < 0.2:
+            yield dict(description="Marketing/Ads", amount=round(rng.uniform(100, 400), 2), category="Marketing", company_id=company_id, date=day)
+
+def generate_history(conn: Connection, company_id: int, products, days: int, sales_per_day: float,
+                     seed=None, end: datetime = None, user_id: int = None, batch_size: int = BATCH_SIZE):
+    """
+    Gera vendas e despesas de `days` dias para uma empresa.
+    products: lista de (id, price_retail, price_wholesale). Retorna (vendas, despesas) gravadas.
+    """
+    rng = random.Random(seed)
+    end = end or datetime.now()
+    products = list(products)
+    sales = bulk_insert(conn, Sale, _sales_rows(rng, company_id, products, days, sales_per_day, end, user_id), batch_size)
+    expenses = bulk_insert(conn, Expense, _expense_rows(rng, company_id, days, end), batch_size)
+    return sales, expenses
+
+def generate(conn: Connection, tenants: int, products: int, days: int, sales_per_day: float,
+             seed: int = 42, end: datetime = None, name_prefix: str = "Tenant Sintético", batch_size: int = BATCH_SIZE):
+    """Cria `tenants` empresas com catálogo e histórico. Retorna um relatório com linhas e linhas/s por tabela."""
+    rng = random.Random(seed)
+    end = end or datetime.now()
+    report = {}
+
+    def timed(name, fn):
+        start = time.perf_counter()
+        rows = fn()
+        elapsed = time.perf_counter() - start
+        prev = report.get(name, {'rows': 0, 'seconds': 0.0})
+        report[name] = {'rows': prev['rows'] + rows, 'seconds': prev['seconds'] + elapsed}
+
+    stamp = time.time_ns() % 16 ** 6  # só para nomes únicos; não afeta os dados gerados
+    company_names = [f"{name_prefix} {stamp:06x}-{n + 1}" for n in range(tenants)]
+    timed('companies', lambda: bulk_insert(conn, Company, (
+        dict(name=name, license_key=f"GEN-{stamp:06x}-{n + 1}", is_active=True, created_at=end)
+        for n, name in enumerate(company_names)), batch_size))
+    company_ids = [cid for (cid,) in conn.execute(
+        select(Company.id).where(Company.name.in_(company_names)).order_by(Company.id))]
+
+    for company_id in company_ids:
+        def _catalog():
+            for i in range(products):
+                retail = round(rng.lognormvariate(4.5, 1.0), 2)
+                yield dict(sku=f"SKU-{company_id}-{i:06d}", name=f"{rng.choice(CATEGORIES)} Modelo {i:06d}",
+                           category=rng.choice(CATEGORIES), price_retail=retail, price_wholesale=round(retail * 0.75, 2),
+                           stock=rng.randint(0, 500), stock_min=rng.choice([2, 5, 10]), company_id=company_id)
+        timed('products', lambda: bulk_insert(conn, Product, _catalog(), batch_size))
+        catalog = conn.execute(select(Product.id, Product.price_retail, Product.price_wholesale)
+                               .where(Product.company_id == company_id)).all()
+        hist_rng = random.Random(rng.randrange(2 ** 32))
+        timed('sales', lambda: bulk_insert(conn, Sale, _sales_rows(hist_rng, company_id, catalog, days, sales_per_day, end, None), batch_size))
+        timed('expenses', lambda: bulk_insert(conn, Expense, _expense_rows(hist_rng, company_id, days, end), batch_size))
+
+    for stats in report.values():
+        stats['rows_per_second'] = stats['rows'] / stats['seconds'] if stats['seconds'] else 0.0
+    report['company_ids'] = company_ids
+    return report
+
+if __name__ == "__main__":
+    from database import build_engine
+    import migrations
+    import rollup
+    from sqlalchemy.orm import Session
+
+    parser = argparse.ArgumentParser(description="Gera dados sintéticos em volume para dimensionamento")
+    parser.add_argument("--url", required=True, help="Banco de destino (não use o de produção)")
+    parser.add_argument("--tenants", type=int, default=1)
+    parser.add_argument("--products", type=int, default=100)
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--sales-per-day", type=float, default=50)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    args = parser.parse_args()
+
+    engine = build_engine(args.url)
+    migrations.upgrade(engine)
+    started = time.perf_counter()
+    with engine.begin() as conn:
+        result = generate(conn, args.tenants, args.products, args.days, args.sales_per_day, args.seed, batch_size=args.batch_size)
+    company_ids = result.pop('company_ids')
+    with Session(bind=engine) as db:
+        for company_id in company_ids:
+            rollup.rebuild(db, company_id)
+    total = time.perf_counter() - started
+
+    for name, stats in result.items():
+        print(f"{name:10} {stats['rows']:>12,} linhas  {stats['seconds']:8.2f} s  {stats['rows_per_second']:>12,.0f} linhas/s")
+    rows = sum(s['rows'] for s in result.values())
+    print(f"{'total':10} {rows:>12,} linhas  {total:8.2f} s  {rows / total:>12,.0f} linhas/s (com resumos diários)")
@@ -0,0 +1,247 @@
+# instrumentation.py
+# Medição de consultas e de seções de página (por processo).
+# Os eventos da engine medem cada comando SQL: tempo, linhas e a função do app que o
+# disparou (ex.: services.get_period_kpis). main.py mede o tempo de cada página.
+# Tudo vai para histogramas de baldes fixos, exibidos na página de diagnóstico
+# (superadmin) e no formato texto do Prometheus; comandos lentos vão para o log.
+#
+# Com PEEGFLOW_METRICS_PORT definido, /metrics fica disponível nessa porta para o Prometheus.
+import logging
+import os
+import sys
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from sqlalchemy import event
+
+SLOW_QUERY_MS = float(os.environ.get("PEEGFLOW_SLOW_QUERY_MS", 500))
+METRICS_PORT = os.environ.get("PEEGFLOW_METRICS_PORT")
+SLOW_LOG_SIZE = 200
+
+# Limites superiores dos baldes, em segundos (o último é +Inf)
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+log = logging.getLogger("peegflow.slow_query")
+
+_ROOT = os.path.dirname(os.path.abspath(__file__)) + os.sep
+_SKIP = {os.path.join(_ROOT, name) for name in ("instrumentation.py", "database.py", "cache.py")}
+
+# --- HISTOGRAMAS ---
+class Histogram:
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.rows = 0
+
+    def observe(self, seconds: float, rows: int = 0):
+        i = 0
+        while i < len(BUCKETS) and seconds > BUCKETS[i]:
+            i += 1
+        self.buckets[i] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.rows += rows
+
+    def quantile(self, q: float):
+        """Estimativa pelo limite superior do balde (como o histogram_quantile do Prometheus, sem interpolar)."""
+        if not self.count:
+            return 0.0
+        target, seen = q * self.count, 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= target:
+                return min(BUCKETS[i], self.max) if i < len(BUCKETS) else self.max
+        return self.max
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.statements = {}  # (operação, origem) -> Histogram
+        self.sections = {}    # seção da página -> Histogram
+        self.slow = deque(maxlen=SLOW_LOG_SIZE)
+        self.started = datetime.now()
+
+    def observe_statement(self, operation, site, seconds, rows, statement):
+        with self._lock:
+            self.statements.setdefault((operation, site), Histogram()).observe(seconds, rows)
+            if seconds * 1000 >= SLOW_QUERY_MS:
+                self.slow.append((datetime.now(), seconds, site, " ".join(statement.split())[:500], rows))
+        if seconds * 1000 >= SLOW_QUERY_MS:
+            log.warning("Consulta lenta: %.0f ms em %s (%s linhas): %s", seconds * 1000, site, rows,
+                        " ".join(statement.split())[:300])
+
+    def observe_section(self, name, seconds):
+        with self._lock:
+            self.sections.setdefault(name, Histogram()).observe(seconds)
+
+    def reset(self):
+        with self._lock:
+            self.statements.clear()
+            self.sections.clear()
+            self.slow.clear()
+            self.started = datetime.now()
+
+registry = Registry()
+
+# --- ORIGEM DOS COMANDOS ---
+_site_cache = {}
+
+def _call_site():
+    """Primeira função do app (fora deste módulo, do database.py e do cache.py) na pilha."""
+    frame = sys._getframe(2)
+    while frame is not None:
+        path = frame.f_code.co_filename
+        ours = _site_cache.get(path)
+        if ours is None:
+            ours = _site_cache[path] = path.startswith(_ROOT) and path not in _SKIP
+        if ours:
+            module = os.path.splitext(path[len(_ROOT):])[0].replace(os.sep, ".")
+            return f"{module}.{frame.f_code.co_name}"
+        frame = frame.f_back
+    return "externo"
+
+def _operation(statement: str):
+    word = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else ""
+    return word if word in ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH") else "OUTRO"
+
+# --- EVENTOS DA ENGINE ---
+def _before(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('peegflow_started', []).append(time.perf_counter())
+
+def _after(conn, cursor, statement, parameters, context, executemany):
+    stack = conn.info.get('peegflow_started')
+    if not stack:
+        return
+    elapsed = time.perf_counter() - stack.pop()
+    rows = cursor.rowcount if cursor.rowcount and cursor.rowcount > 0 else 0
+    registry.observe_statement(_operation(statement), _call_site(), elapsed, rows, statement)
+
+def _error(context):
+    # Comando que falhou: descarta o início pendente para não desalinhar a pilha da conexão
+    stack = context.connection.info.get('peegflow_started') if context.connection is not None else None
+    if stack:
+        stack.pop()
+
+def instrument(engine):
+    """Liga a medição de comandos na engine (uma vez por engine)."""
+    if not event.contains(engine, "before_cursor_execute", _before):
+        event.listen(engine, "before_cursor_execute", _before)
+        event.listen(engine, "after_cursor_execute", _after)
+        event.listen(engine, "handle_error", _error)
+    return engine
+
+# --- SEÇÕES DE PÁGINA ---
+def observe_section(name: str, seconds: float):
+    registry.observe_section(name, seconds)
+
+@contextmanager
+def section(name: str):
+    """Mede o bloco como uma seção de página (o tempo conta mesmo se o bloco sair por exceção)."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        registry.observe_section(name, time.perf_counter() - start)
+
+# --- LEITURA (página de diagnóstico) ---
+def _summary(key_names, items):
+    rows = []
+    for key, h in items:
+        rows.append({
+            **dict(zip(key_names, key if isinstance(key, tuple) else (key,))),
+            'count': h.count, 'avg_ms': h.total / h.count * 1000 if h.count else 0.0,
+            'p50_ms': h.quantile(0.5) * 1000, 'p95_ms': h.quantile(0.95) * 1000,
+            'max_ms': h.max * 1000, 'total_ms': h.total * 1000, 'rows': h.rows,
+        })
+    return sorted(rows, key=lambda r: r['total_ms'], reverse=True)
+
+def statement_summary():
+    """Uma linha por (operação, origem), ordenada pelo tempo total gasto."""
+    with registry._lock:
+        return _summary(('operation', 'site'), list(registry.statements.items()))
+
+def section_summary():
+    with registry._lock:
+        return _summary(('section',), list(registry.sections.items()))
+
+def slow_queries():
+    """Comandos acima de SLOW_QUERY_MS, do mais recente ao mais antigo: (quando, segundos, origem, sql, linhas)."""
+    with registry._lock:
+        return list(reversed(registry.slow))
+
+# --- FORMATO PROMETHEUS ---
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _labels(**labels):
+    return ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items())
+
+def _histogram_lines(name, labels, h):
+    lines, cumulative = [], 0
+    for bound, n in zip(BUCKETS + (float("inf"),), h.buckets):
+        cumulative += n
+        le = "+Inf" if bound == float("inf") else repr(bound)
+        lines.append(f"{name}_bucket{{{_labels(**labels, le=le)}}} {cumulative}")
+    lines.append(f"{name}_sum{{{_labels(**labels)}}} {h.total}")
+    lines.append(f"{name}_count{{{_labels(**labels)}}} {h.count}")
+    return lines
+
+def prometheus():
+    """Métricas no formato texto de exposição do Prometheus."""
+    from database import pool_status
+    import cache
+    lines = ["# HELP peegflow_db_statement_seconds Duração dos comandos SQL por operação e origem.",
+             "# TYPE peegflow_db_statement_seconds histogram"]
+    with registry._lock:
+        statements = list(registry.statements.items())
+        sections = list(registry.sections.items())
+    for (operation, site), h in statements:
+        lines += _histogram_lines("peegflow_db_statement_seconds", dict(operation=operation, site=site), h)
+    lines += ["# HELP peegflow_db_statement_rows_total Linhas afetadas/retornadas informadas pelo driver.",
+              "# TYPE peegflow_db_statement_rows_total counter"]
+    for (operation, site), h in statements:
+        lines.append(f"peegflow_db_statement_rows_total{{{_labels(operation=operation, site=site)}}} {h.rows}")
+    lines += ["# HELP peegflow_page_section_seconds Tempo de renderização por seção de página.",
+              "# TYPE peegflow_page_section_seconds histogram"]
+    for name, h in sections:
+        lines += _histogram_lines("peegflow_page_section_seconds", dict(section=name), h)
+    pools = pool_status()
+    for key in dict.fromkeys(k for status in pools.values() for k in status):
+        lines.append(f"# TYPE peegflow_pool_{key} gauge")
+        lines += [f"peegflow_pool_{key}{{{_labels(engine=name)}}} {status[key]}"
+                  for name, status in pools.items() if key in status]
+    for key, value in cache.stats().items():
+        lines += [f"# TYPE peegflow_cache_{key} gauge", f"peegflow_cache_{key} {value}"]
+    return "\n".join(lines) + "\n"
+
+# --- ENDPOINT /metrics (opcional) ---
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.rstrip("/") != "/metrics":
+            self.send_error(404)
+            return
+        body = prometheus().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+_server = None
+
+def serve(port=METRICS_PORT):
+    """Sobe o /metrics numa thread, se houver porta configurada (uma vez por processo)."""
+    global _server
+    if port and _server is None:
+        _server = ThreadingHTTPServer(("0.0.0.0", int(port)), _MetricsHandler)
+        threading.Thread(target=_server.serve_forever, name="peegflow-metrics", daemon=True).start()
+    return _server
@@ -0,0 +1,292 @@
+# jobs.py
+# Tarefas pesadas (PDFs, relatórios, carga da demo) fora da thread do script do Streamlit.
+# O estado de cada tarefa fica na tabela jobs, então a página só enfileira e acompanha.
+# A execução é num pool de threads do processo, com limite de tarefas simultâneas por
+# empresa: os relatórios de uma loja não ocupam o pool (nem o banco) de quem está no caixa.
+# Vários processos (ou um reiniciando) podem ver a mesma tarefa pendente: ela é assumida
+# por um UPDATE condicional, e só o processo que o venceu a executa. Quem executa renova
+# heartbeat_at; uma tarefa em execução sem sinal de vida é de um processo que morreu.
+# Os arquivos gerados ficam em RESULTS_DIR (a tabela guarda só o caminho) e são gravados
+# direto no disco enquanto a tarefa roda: nada do tamanho da exportação passa pela memória.
+import io
+import json
+import logging
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import uuid
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from sqlalchemy import and_, or_, update
+from sqlalchemy.orm import defer
+from database import session_scope
+from models import Job
+import services as api
+
+MAX_WORKERS = int(os.environ.get("PEEGFLOW_JOB_WORKERS", 4))
+PER_TENANT = int(os.environ.get("PEEGFLOW_JOB_PER_TENANT", 1))
+KEEP_DAYS = int(os.environ.get("PEEGFLOW_JOB_KEEP_DAYS", 7))  # tarefas encerradas (e seus arquivos) ficam por este tempo
+HEARTBEAT = 30          # segundos entre sinais de vida das tarefas em execução
+STALE_AFTER = 3 * HEARTBEAT  # sem sinal por este tempo: o processo dono morreu
+# Pasta dos arquivos gerados; com mais de um servidor, precisa ser compartilhada entre eles (volume montado)
+RESULTS_DIR = os.environ.get("PEEGFLOW_JOB_DIR", os.path.join(tempfile.gettempdir(), "peegflow_jobs"))
+LEDGER_DIR = os.path.join(RESULTS_DIR, "ledger")  # PDFs de períodos fechados, por impressão digital dos dados
+
+OWNER = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+PENDING, RUNNING, DONE, FAILED = "pendente", "executando", "concluido", "erro"
+
+log = logging.getLogger(__name__)
+
+TASKS = {}   # tipo -> função
+LABELS = {}  # tipo -> nome exibido na página
+
+def task(kind: str, label: str):
+    """
+    Registra fn(db, company_id, params, progress, out) -> None ou (nome do arquivo, mime).
+    `out` é um arquivo binário aberto em RESULTS_DIR; a tarefa escreve nele o resultado (se houver).
+    """
+    def decorator(fn):
+        TASKS[kind] = fn
+        LABELS[kind] = label
+        return fn
+    return decorator
+
+# --- AGENDADOR (pool + fila por empresa) ---
+class _Scheduler:
+    def __init__(self, workers: int, per_tenant: int):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="peegflow-job")
+        self._per_tenant = per_tenant
+        self._lock = threading.Lock()
+        self._running = defaultdict(int)
+        self._waiting = defaultdict(deque)
+
+    def submit(self, company_id, job_id):
+        # Empresa no limite: a tarefa espera na fila dela, sem ocupar uma thread do pool
+        with self._lock:
+            if self._running[company_id] >= self._per_tenant:
+                self._waiting[company_id].append(job_id)
+                return
+            self._running[company_id] += 1
+        self._executor.submit(self._run, company_id, job_id)
+
+    def _run(self, company_id, job_id):
+        try:
+            _execute(job_id)
+        finally:
+            with self._lock:
+                queue = self._waiting[company_id]
+                next_id = queue.popleft() if queue else None
+                if next_id is None:
+                    self._running[company_id] -= 1
+            if next_id is not None:
+                self._executor.submit(self._run, company_id, next_id)
+
+_scheduler = _Scheduler(MAX_WORKERS, PER_TENANT)
+
+def _json_default(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    raise TypeError(f"Parâmetro não serializável: {value!r}")
+
+def _update(job_id: int, **values):
+    # Só enquanto a tarefa for deste processo: se ela foi dada como órfã, o resultado é descartado
+    with session_scope() as db:
+        return db.query(Job).filter(Job.id == job_id, Job.owner == OWNER, Job.status == RUNNING) \
+            .update(values, synchronize_session=False)
+
+def _claim(job_id: int):
+    """Assume a tarefa se ela ainda estiver pendente. Retorna (tipo, empresa, parâmetros) ou None se outro processo a pegou."""
+    now = datetime.now()
+    with session_scope() as db:
+        claimed = db.execute(update(Job).where(Job.id == job_id, Job.status == PENDING).values(
+            status=RUNNING, started_at=now, heartbeat_at=now, owner=OWNER)).rowcount
+        if claimed != 1:
+            return None
+        job = db.get(Job, job_id)
+        return job.kind, job.company_id, json.loads(job.params or "{}")
+
+def _execute(job_id: int):
+    claimed = _claim(job_id)
+    if claimed is None:
+        return
+    kind, company_id, params = claimed
+    _heartbeat.start()
+
+    def progress(fraction: float, message: str = None):
+        _update(job_id, progress=max(0.0, min(1.0, fraction)), message=message, heartbeat_at=datetime.now())
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    partial = os.path.join(RESULTS_DIR, f"{job_id}.part")
+    try:
+        with session_scope() as db, open(partial, 'wb') as out:
+            output = TASKS[kind](db, company_id, params, progress, out)
+    except Exception as e:
+        log.exception("Tarefa %s (%s) falhou", job_id, kind)
+        _remove(partial)
+        _update(job_id, status=FAILED, message=str(e) or e.__class__.__name__, finished_at=datetime.now())
+        return
+    values = dict(status=DONE, progress=1.0, message="Concluído", finished_at=datetime.now())
+    path = None
+    if output:
+        name, mime = output
+        path = os.path.join(RESULTS_DIR, f"{job_id}_{name}")
+        os.replace(partial, path)
+        values.update(result_path=path, result_name=name, result_mime=mime)
+    else:
+        _remove(partial)
+    if not _update(job_id, **values) and path:
+        _remove(path)  # a tarefa foi dada como órfã enquanto rodava: o arquivo não tem dono
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+# --- SINAL DE VIDA, ÓRFÃS E LIMPEZA ---
+def fail_orphans():
+    """Marca como erro as tarefas em execução cujo processo dono parou de dar sinal de vida."""
+    cutoff = datetime.now() - timedelta(seconds=STALE_AFTER)
+    with session_scope() as db:
+        return db.execute(update(Job).where(
+            Job.status == RUNNING,
+            or_(Job.heartbeat_at < cutoff, and_(Job.heartbeat_at.is_(None), Job.started_at < cutoff))
+        ).values(status=FAILED, message="Interrompida (o processo que a executava parou)",
+                 finished_at=datetime.now())).rowcount
+
+def prune(keep_days: int = KEEP_DAYS):
+    """Apaga as tarefas encerradas há mais de `keep_days` dias, com os arquivos gerados."""
+    cutoff = datetime.now() - timedelta(days=keep_days)
+    with session_scope() as db:
+        old = db.query(Job).filter(Job.status.in_((DONE, FAILED)), Job.finished_at < cutoff)
+        paths = [path for (path,) in old.with_entities(Job.result_path) if path]
+        count = old.delete(synchronize_session=False)
+    for path in paths:
+        _remove(path)
+    # Sobras de tarefas interrompidas no meio da escrita e PDFs sem uso recente
+    for folder, stale in ((RESULTS_DIR, lambda name: name.endswith(".part")), (LEDGER_DIR, lambda name: True)):
+        if os.path.isdir(folder):
+            for entry in os.scandir(folder):
+                if entry.is_file() and stale(entry.name) and datetime.fromtimestamp(entry.stat().st_mtime) < cutoff:
+                    _remove(entry.path)
+    return count
+
+class _Heartbeat:
+    """Thread do processo que renova heartbeat_at das suas tarefas e recolhe as órfãs dos outros."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._thread = None
+        self._last_prune = None
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name="peegflow-job-heartbeat", daemon=True)
+                self._thread.start()
+
+    def _loop(self):
+        while True:
+            try:
+                with session_scope() as db:
+                    db.execute(update(Job).where(Job.owner == OWNER, Job.status == RUNNING)
+                               .values(heartbeat_at=datetime.now()))
+                fail_orphans()
+                if self._last_prune is None or datetime.now() - self._last_prune > timedelta(hours=1):
+                    prune()
+                    self._last_prune = datetime.now()
+            except Exception:
+                log.exception("Sinal de vida das tarefas falhou")
+            time.sleep(HEARTBEAT)
+
+_heartbeat = _Heartbeat()
+
+# --- API USADA PELA PÁGINA ---
+def submit(company_id: int, kind: str, params: dict = None, user_id: int = None) -> int:
+    """Grava a tarefa como pendente e a entrega ao pool. Retorna o id."""
+    if kind not in TASKS:
+        raise ValueError(f"Tarefa desconhecida: {kind}")
+    with session_scope() as db:
+        job = Job(company_id=company_id, user_id=user_id, kind=kind, status=PENDING, progress=0.0,
+                  params=json.dumps(params or {}, default=_json_default))
+        db.add(job)
+        db.flush()
+        job_id = job.id
+    _scheduler.submit(company_id, job_id)
+    return job_id
+
+def list_jobs(company_id: int, limit: int = 10):
+    """Tarefas mais recentes da empresa, sem carregar os arquivos gerados."""
+    with session_scope() as db:
+        return db.query(Job).options(defer(Job.result)).filter(Job.company_id == company_id) \
+            .order_by(Job.created_at.desc(), Job.id.desc()).limit(limit).all()
+
+def open_result(company_id: int, job_id: int):
+    """Arquivo gerado pela tarefa, aberto para leitura binária (quem chama fecha), ou None se não existir mais."""
+    with session_scope() as db:
+        done = db.query(Job).filter(Job.id == job_id, Job.company_id == company_id, Job.status == DONE)
+        path = done.with_entities(Job.result_path).scalar()
+        if path is None:
+            # Tarefas anteriores à pasta de resultados guardavam o arquivo na própria tabela
+            legacy = done.with_entities(Job.result).scalar()
+            return io.BytesIO(legacy) if legacy is not None else None
+    try:
+        return open(path, 'rb')
+    except FileNotFoundError:
+        return None
+
+def recover():
+    """
+    Na subida do processo: marca como erro só as tarefas em execução sem sinal de vida (o dono morreu),
+    entrega as pendentes ao pool (outro processo vivo pode assumi-las antes; o UPDATE condicional
+    garante que cada uma roda uma vez) e liga o sinal de vida, que também faz a limpeza.
+    """
+    fail_orphans()
+    with session_scope() as db:
+        pending = db.query(Job.id, Job.company_id).filter(Job.status == PENDING).order_by(Job.id).all()
+    for job_id, company_id in pending:
+        _scheduler.submit(company_id, job_id)
+    _heartbeat.start()
+    return len(pending)
+
+# --- TAREFAS ---
+@task("ledger_pdf", "Relatório detalhado (PDF)")
+def _ledger_pdf(db, company_id, params, progress, out):
+    start, end = date.fromisoformat(params['start']), date.fromisoformat(params['end'])
+    # Período fechado: o mesmo PDF serve enquanto os dados do período não mudarem (e fica em disco, não no cache)
+    key = api.ledger_fingerprint(db, company_id, start, end)
+    path = os.path.join(LEDGER_DIR, f"{company_id}_{start:%Y%m%d}_{end:%Y%m%d}_{key}.pdf")
+    if os.path.exists(path):
+        progress(0.5, "Reaproveitando o relatório já gerado para estes dados...")
+        os.utime(path)  # usado agora: a limpeza conta a partir daqui
+    else:
+        progress(0.1, "Gerando relatório detalhado...")
+        pdf = api.generate_ledger_pdf(db, company_id, start, end)
+        os.makedirs(LEDGER_DIR, exist_ok=True)
+        partial = f"{path}.{uuid.uuid4().hex[:8]}.part"
+        with open(partial, 'wb') as f:
+            f.write(pdf)
+        os.replace(partial, path)
+    with open(path, 'rb') as f:
+        shutil.copyfileobj(f, out)
+    return f"fechamento_{start:%Y%m%d}_{end:%Y%m%d}.pdf", "application/pdf"
+
+@task("export", "Exportação de dados")
+def _export(db, company_id, params, progress, out):
+    stream, fmt = params['stream'], params.get('format', 'csv')
+    start = datetime.fromisoformat(params['start']) if params.get('start') else None
+    end = datetime.fromisoformat(params['end']) if params.get('end') else None
+    # Bloco a bloco direto no arquivo da tarefa: a memória fica limitada a um bloco
+    api.export_rows(db, company_id, stream, out, fmt, start, end, params.get('incremental', False),
+                    progress=lambda rows: progress(0.5, f"{rows:,} linhas exportadas..."))
+    mime = "text/csv" if fmt == 'csv' else "application/vnd.apache.parquet"
+    return f"{stream}_{company_id}_{datetime.now():%Y%m%d_%H%M%S}.{fmt}", mime
+
+@task("demo_seed", "Dados de demonstração")
+def _demo_seed(db, company_id, params, progress, out):
+    progress(0.1, "Gerando 30 dias de dados de demonstração...")
+    api.setup_demo_data(db)
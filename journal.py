@@ -0,0 +1,225 @@
+# journal.py
+# Diário local de vendas do PDV (gravação adiada para o banco principal).
+# Com PEEGFLOW_JOURNAL apontando para um arquivo, o caixa grava o carrinho num SQLite local
+# (WAL, fsync a cada venda) e libera o cliente na latência do disco. Uma thread envia as
+# vendas pendentes ao banco principal em lotes, na ordem em que foram feitas, repetindo com
+# espera crescente enquanto a rede ou o banco estiverem fora.
+# Cada venda leva um client_ref (uuid) gravado em Order.client_ref com índice único: reenviar
+# um lote já aplicado não duplica nada. Uma venda que o banco recusar (ex.: sem estoque no
+# momento do envio) fica como "rejeitada" no diário para conferência, sem travar a fila.
+#
+# Uso manual (esvazia o diário com o app fechado): python journal.py [--path arquivo.db]
+import argparse
+import json
+import logging
+import os
+import sqlite3
+import threading
+import uuid
+from datetime import datetime, timedelta
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+from database import SessionLocal
+from models import Order
+import cache
+import services as api
+
+JOURNAL_PATH = os.environ.get("PEEGFLOW_JOURNAL")  # vazio = desligado (venda direto no banco)
+FLUSH_INTERVAL = float(os.environ.get("PEEGFLOW_JOURNAL_INTERVAL", 2))
+BATCH_SIZE = int(os.environ.get("PEEGFLOW_JOURNAL_BATCH", 50))
+MAX_BACKOFF = 60    # segundos entre tentativas com o banco fora
+KEEP_DAYS = 7       # vendas já enviadas ficam no diário por este tempo
+
+PENDING, SENT, REJECTED = "pendente", "enviada", "rejeitada"
+
+log = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS journal (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    client_ref TEXT NOT NULL UNIQUE,
+    company_id INTEGER NOT NULL,
+    user_id INTEGER,
+    items TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    message TEXT,
+    sent_at TEXT
+);
+CREATE INDEX IF NOT EXISTS ix_journal_status_seq ON journal (status, seq);
+"""
+
+class _Rejected(Exception):
+    pass
+
+class Journal:
+    def __init__(self, path: str, session_factory=SessionLocal):
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=FULL")  # a venda só volta ao caixa depois do fsync
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        self._conn.executescript(_SCHEMA)
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._session_factory = session_factory
+        self.failures = 0
+        self.last_error = None
+        self.last_flush = None
+
+    # --- CAIXA ---
+    def record(self, company_id: int, user_id: int, items: list) -> str:
+        """Grava o carrinho no diário local e acorda o envio. Retorna o client_ref da venda."""
+        ref = str(uuid.uuid4())
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO journal (client_ref, company_id, user_id, items, created_at, status) VALUES (?, ?, ?, ?, ?, ?)",
+                (ref, company_id, user_id, json.dumps(items), datetime.now().isoformat(), PENDING))
+        self._wake.set()
+        return ref
+
+    def status(self, company_id: int = None):
+        """Contagem de vendas pendentes e rejeitadas (da empresa ou de todas) e o último erro de envio."""
+        where, args = ("WHERE company_id = ?", (company_id,)) if company_id is not None else ("", ())
+        with self._lock:
+            counts = dict(self._conn.execute(f"SELECT status, COUNT(*) FROM journal {where} GROUP BY status", args).fetchall())
+        return {'pending': counts.get(PENDING, 0), 'rejected': counts.get(REJECTED, 0),
+                'last_error': self.last_error, 'last_flush': self.last_flush}
+
+    def rejected(self, company_id: int, limit: int = 20):
+        """Vendas recusadas pelo banco principal: [(client_ref, itens, data, motivo)]."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT client_ref, items, created_at, message FROM journal WHERE company_id = ? AND status = ? "
+                "ORDER BY seq DESC LIMIT ?", (company_id, REJECTED, limit)).fetchall()
+        return [(ref, json.loads(items), datetime.fromisoformat(created), message) for ref, items, created, message in rows]
+
+    # --- ENVIO AO BANCO PRINCIPAL ---
+    def flush(self, limit: int = BATCH_SIZE) -> int:
+        """
+        Envia até `limit` vendas pendentes numa única transação do banco principal, em ordem.
+        Retorna quantas foram resolvidas (enviadas ou rejeitadas). Erros de conexão sobem para quem chama.
+        """
+        with self._flush_lock:
+            with self._lock:
+                batch = self._conn.execute(
+                    "SELECT seq, client_ref, company_id, user_id, items, created_at FROM journal "
+                    "WHERE status = ? ORDER BY seq LIMIT ?", (PENDING, limit)).fetchall()
+            if not batch:
+                return 0
+
+            outcome, companies = {}, set()
+            db = self._session_factory()
+            try:
+                # Vendas que já chegaram antes (ex.: o commit passou mas a marcação local não)
+                applied = set(db.execute(select(Order.client_ref).where(
+                    Order.client_ref.in_([row[1] for row in batch]))).scalars())
+                for seq, ref, company_id, user_id, items, created_at in batch:
+                    if ref in applied:
+                        outcome[seq] = (SENT, None)
+                        continue
+                    # Um savepoint por venda: uma recusa desfaz só a venda dela, não o lote
+                    try:
+                        with db.begin_nested():
+                            ok, results = api.apply_cart(db, json.loads(items), user_id, company_id,
+                                                         datetime.fromisoformat(created_at), ref)
+                            if not ok:
+                                raise _Rejected("; ".join(f"produto {r['id']}: {r['msg']}" for r in results if not r['ok']))
+                    except _Rejected as e:
+                        outcome[seq] = (REJECTED, str(e))
+                    except IntegrityError as e:
+                        # Outro processo aplicou o mesmo client_ref ao mesmo tempo
+                        if db.execute(select(Order.id).where(Order.client_ref == ref)).first():
+                            outcome[seq] = (SENT, None)
+                        else:
+                            outcome[seq] = (REJECTED, str(e.orig))
+                    else:
+                        outcome[seq] = (SENT, None)
+                        companies.add(company_id)
+                db.commit()
+            except Exception:
+                db.rollback()
+                with self._lock:
+                    self._conn.execute(f"UPDATE journal SET attempts = attempts + 1 WHERE seq IN ({','.join('?' * len(batch))})",
+                                       [row[0] for row in batch])
+                raise
+            finally:
+                db.close()
+
+            now = datetime.now().isoformat()
+            with self._lock:
+                self._conn.execute("BEGIN")
+                self._conn.executemany("UPDATE journal SET status = ?, message = ?, sent_at = ?, attempts = attempts + 1 WHERE seq = ?",
+                                       [(status, message, now, seq) for seq, (status, message) in outcome.items()])
+                self._conn.execute("COMMIT")
+            for company_id in companies:
+                cache.invalidate(company_id, 'sales', 'products')
+            return len(outcome)
+
+    def prune(self, keep_days: int = KEEP_DAYS):
+        """Apaga do diário as vendas enviadas há mais de `keep_days` dias."""
+        cutoff = (datetime.now() - timedelta(days=keep_days)).isoformat()
+        with self._lock:
+            return self._conn.execute("DELETE FROM journal WHERE status = ? AND sent_at < ?", (SENT, cutoff)).rowcount
+
+    def drain(self):
+        """Envia tudo o que estiver pendente (até o primeiro erro de conexão)."""
+        total = 0
+        while (sent := self.flush()):
+            total += sent
+        return total
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                if self.drain():
+                    self.prune()
+                self.failures, self.last_error, self.last_flush = 0, None, datetime.now()
+            except Exception as e:
+                self.failures += 1
+                self.last_error = str(e) or e.__class__.__name__
+                log.warning("Envio do diário falhou (%s tentativa): %s", self.failures, self.last_error)
+            # Com o banco fora, espera cada vez mais (até MAX_BACKOFF); uma venda nova acorda antes
+            delay = min(MAX_BACKOFF, FLUSH_INTERVAL * 2 ** self.failures) if self.failures else FLUSH_INTERVAL
+            self._wake.wait(delay)
+            self._wake.clear()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name="peegflow-journal", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+# --- DIÁRIO DO PROCESSO ---
+_journal = None
+_journal_lock = threading.Lock()
+
+def get():
+    """Diário do processo (com o envio em segundo plano já rodando) ou None se estiver desligado."""
+    global _journal
+    if not JOURNAL_PATH:
+        return None
+    with _journal_lock:
+        if _journal is None:
+            _journal = Journal(JOURNAL_PATH)
+            _journal.start()
+    return _journal
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Envia ao banco principal as vendas pendentes do diário local")
+    parser.add_argument("--path", default=JOURNAL_PATH, help="Arquivo do diário (padrão: PEEGFLOW_JOURNAL)")
+    args = parser.parse_args()
+    if not args.path:
+        parser.error("informe --path ou defina PEEGFLOW_JOURNAL")
+    journal = Journal(args.path)
+    sent = journal.drain()
+    print(f"Vendas resolvidas: {sent}. Situação: {journal.status()}")
@@ -0,0 +1,150 @@
+# ledger.py
+# Livro de movimentações de estoque e fotos diárias por produto.
+# Toda venda, reposição e ajuste grava uma movimentação (só inserções) na mesma transação
+# que altera Product.stock. O estoque numa data sai da foto mais próxima somada às poucas
+# movimentações entre a foto e a data, em vez de repassar o histórico inteiro.
+#
+# Uso (ex.: cron diário): python ledger.py [--company ID] [--day AAAA-MM-DD]
+import argparse
+from datetime import date, datetime, time, timedelta
+import pandas as pd
+from sqlalchemy import case, delete, func, insert, literal, select
+from sqlalchemy.orm import Session
+from models import Product, StockMovement, StockSnapshot
+
+SALE, RESTOCK, ADJUSTMENT, OPENING = "venda", "reposicao", "ajuste", "abertura"
+
+def _day_end(day: date):
+    # A foto do dia D vale para o instante 00:00 de D+1
+    return datetime.combine(day + timedelta(days=1), time.min)
+
+# --- GRAVAÇÃO (não faz commit; quem chama controla a transação) ---
+def record(db: Session, company_id: int, moves: list, kind: str, when: datetime = None,
+           order_id: int = None, user_id: int = None, note: str = None):
+    """moves = [(product_id, variação com sinal, estoque depois)]."""
+    if not moves:
+        return
+    when = when or datetime.now()
+    db.execute(insert(StockMovement), [
+        dict(product_id=pid, kind=kind, quantity=delta, stock_after=after, note=note, order_id=order_id,
+             user_id=user_id, date=when, company_id=company_id)
+        for pid, delta, after in moves
+    ])
+
+# --- FOTOS ---
+def snapshot(db: Session, company_id: int = None, day: date = None):
+    """
+    Grava a foto do fim de `day` (padrão: ontem): estoque atual menos o que se moveu depois do dia.
+    Refazer a foto de um dia a substitui. Retorna quantos produtos foram gravados.
+    """
+    day = day or date.today() - timedelta(days=1)
+    after = select(StockMovement.product_id, func.sum(StockMovement.quantity).label('moved')) \
+        .where(StockMovement.date >= _day_end(day)).group_by(StockMovement.product_id)
+    if company_id is not None:
+        after = after.where(StockMovement.company_id == company_id)
+    after = after.subquery()
+    rows = select(
+        Product.company_id, literal(day), Product.id, Product.stock - func.coalesce(after.c.moved, 0)
+    ).outerjoin(after, after.c.product_id == Product.id)
+    clear = delete(StockSnapshot).where(StockSnapshot.day == day)
+    if company_id is not None:
+        rows = rows.where(Product.company_id == company_id)
+        clear = clear.where(StockSnapshot.company_id == company_id)
+    db.execute(clear)
+    result = db.execute(insert(StockSnapshot).from_select(['company_id', 'day', 'product_id', 'stock'], rows))
+    db.commit()
+    return result.rowcount
+
+def ensure_snapshot(db: Session):
+    """Tira a foto de ontem se ela ainda não existir (chamada na subida do app)."""
+    yesterday = date.today() - timedelta(days=1)
+    if db.query(StockSnapshot.day).filter(StockSnapshot.day == yesterday).first() is None:
+        return snapshot(db, None, yesterday)
+    return 0
+
+# --- CONSULTAS ---
+def stock_at(db: Session, company_id: int, at: datetime):
+    """
+    Estoque de cada produto da empresa no instante `at` ({product_id: estoque}).
+    Parte da foto anterior mais próxima (somando o que entrou/saiu até `at`) ou do estoque
+    atual (desfazendo o que se moveu depois de `at`), o que estiver mais perto.
+    """
+    now = datetime.now()
+    snap_day = db.query(func.max(StockSnapshot.day)).filter(
+        StockSnapshot.company_id == company_id, StockSnapshot.day <= (at - timedelta(days=1)).date()).scalar()
+    moved = select(StockMovement.product_id, func.sum(StockMovement.quantity)) \
+        .where(StockMovement.company_id == company_id).group_by(StockMovement.product_id)
+
+    if snap_day is not None and at - _day_end(snap_day) < now - at:
+        levels = dict(db.query(StockSnapshot.product_id, StockSnapshot.stock).filter(
+            StockSnapshot.company_id == company_id, StockSnapshot.day == snap_day).all())
+        for pid, delta in db.execute(moved.where(StockMovement.date >= _day_end(snap_day), StockMovement.date <= at)):
+            levels[pid] = levels.get(pid, 0) + int(delta)
+        return levels
+
+    levels = dict(db.query(Product.id, Product.stock).filter(Product.company_id == company_id).all())
+    for pid, delta in db.execute(moved.where(StockMovement.date > at)):
+        if pid in levels:
+            levels[pid] -= int(delta)
+    return levels
+
+def movements(db: Session, company_id: int, start: datetime, end: datetime, product_id: int = None):
+    """Movimentações do período (com nome do produto), em ordem cronológica."""
+    q = select(
+        StockMovement.date, Product.sku, Product.name.label('product_name'), StockMovement.kind,
+        StockMovement.quantity, StockMovement.stock_after, StockMovement.note
+    ).join(Product, Product.id == StockMovement.product_id).where(
+        StockMovement.company_id == company_id, StockMovement.date >= start, StockMovement.date <= end)
+    if product_id is not None:
+        q = q.where(StockMovement.product_id == product_id)
+    return pd.read_sql_query(q.order_by(StockMovement.date, StockMovement.id), db.connection())
+
+def movement_report(db: Session, company_id: int, start: datetime, end: datetime):
+    """Por produto: estoque inicial, vendas, reposições, ajustes e estoque final do período."""
+    def _sum(kinds):
+        return func.coalesce(func.sum(case((StockMovement.kind.in_(kinds), StockMovement.quantity), else_=0)), 0)
+    totals = db.execute(select(
+        StockMovement.product_id, _sum([SALE]), _sum([RESTOCK]), _sum([ADJUSTMENT, OPENING])
+    ).where(
+        StockMovement.company_id == company_id, StockMovement.date >= start, StockMovement.date <= end
+    ).group_by(StockMovement.product_id)).all()
+    moved = {pid: (int(s), int(r), int(a)) for pid, s, r, a in totals}
+    opening = stock_at(db, company_id, start - timedelta(microseconds=1))
+    closing = stock_at(db, company_id, end)
+
+    products = db.query(Product.id, Product.sku, Product.name).filter(Product.company_id == company_id) \
+        .order_by(Product.name, Product.id).all()
+    return pd.DataFrame([
+        dict(product_id=p.id, sku=p.sku, name=p.name, opening=opening.get(p.id, 0),
+             sales=-moved.get(p.id, (0, 0, 0))[0], restocks=moved.get(p.id, (0, 0, 0))[1],
+             adjustments=moved.get(p.id, (0, 0, 0))[2], closing=closing.get(p.id, 0))
+        for p in products
+    ], columns=['product_id', 'sku', 'name', 'opening', 'sales', 'restocks', 'adjustments', 'closing'])
+
+def drift(db: Session, company_id: int):
+    """
+    Auditoria: produtos cujo estoque atual difere da última foto somada às movimentações posteriores.
+    Retorna [(product_id, esperado, atual)]; lista vazia = livro e estoque batem.
+    """
+    snap_day = db.query(func.max(StockSnapshot.day)).filter(StockSnapshot.company_id == company_id).scalar()
+    if snap_day is None:
+        return []
+    expected = dict(db.query(StockSnapshot.product_id, StockSnapshot.stock).filter(
+        StockSnapshot.company_id == company_id, StockSnapshot.day == snap_day).all())
+    for pid, delta in db.execute(select(StockMovement.product_id, func.sum(StockMovement.quantity)).where(
+            StockMovement.company_id == company_id, StockMovement.date >= _day_end(snap_day)
+    ).group_by(StockMovement.product_id)):
+        expected[pid] = expected.get(pid, 0) + int(delta)
+    actual = dict(db.query(Product.id, Product.stock).filter(Product.company_id == company_id).all())
+    return [(pid, expected.get(pid, 0), stock) for pid, stock in actual.items()
+            if pid in expected and expected[pid] != stock]
+
+if __name__ == "__main__":
+    from database import session_scope
+    parser = argparse.ArgumentParser(description="Grava a foto diária do estoque")
+    parser.add_argument("--company", type=int, default=None, help="ID da empresa (padrão: todas)")
+    parser.add_argument("--day", type=date.fromisoformat, default=None, help="Dia da foto (padrão: ontem)")
+    args = parser.parse_args()
+    with session_scope() as db:
+        count = snapshot(db, args.company, args.day)
+    print(f"Foto do estoque gravada: {count} produtos.")
@@ -1,16 +1,43 @@
 import streamlit as st
 import pandas as pd
 import plotly.express as px
-from database import get_db, engine, Base
+import time
+from database import engine, session_scope, read_scope, read_sessionmaker, pool_status
 import services as api
+import cache
+import cart
+import migrations
+import instrumentation
+import jobs
+import journal
+import ledger
+import partitioning
 from models import User, Company, Product, Sale, Expense
 from datetime import datetime, timedelta
 import base64
+import logging
 
 # Configurações iniciais da página
 st.set_page_config(page_title='PeegFlow Pro', page_icon='⚡', layout='wide')
-Base.metadata.create_all(bind=engine)
-db = next(get_db())
+
+# Cria tabelas e aplica migrações pendentes uma vez por processo
+@st.cache_resource
+def preparar_banco():
+    versao = migrations.upgrade(engine)
+    jobs.recover()  # tarefas deixadas na fila pela execução anterior
+    journal.get()   # com o diário local ligado, retoma o envio das vendas pendentes
+    try:
+        partitioning.ensure_partitions(engine)  # partições dos próximos meses, se as tabelas forem particionadas
+    except Exception:
+        # Sem a partição nova as linhas do mês caem na DEFAULT; o app continua e a próxima subida tenta de novo
+        logging.getLogger(__name__).exception("Falha ao criar as partições dos próximos meses")
+    instrumentation.serve()  # /metrics para o Prometheus, se PEEGFLOW_METRICS_PORT estiver definido
+    with session_scope() as db:
+        ledger.ensure_snapshot(db)  # foto do estoque de ontem, se o agendador ainda não tirou
+    return versao
+preparar_banco()
+# Sessões: cada operação abaixo abre a sua com session_scope() e a devolve ao pool ao terminar;
+# leituras de Dashboard e relatórios usam read_scope() (réplica, se configurada)
 
 # --- ESTILOS CSS (Login, PDV e Financeiro) ---
 st.markdown("""<style>
@@ -49,7 +76,71 @@ st.markdown("""<style>
 
 # Inicialização do estado da sessão
 if 'logged_in' not in st.session_state:
-    st.session_state.update({'logged_in': False, 'user_id': None, 'company_id': None, 'username': None, 'cart': []})
+    st.session_state.update({'logged_in': False, 'user_id': None, 'company_id': None, 'username': None, 'role': None, 'cart': cart.Cart()})
+
+# --- TABELA PAGINADA (Fechamento de Caixa) ---
+def tabela_paginada(chave, carregar, inicio, fim, total, colunas):
+    # st.session_state[chave] guarda a pilha de cursores (data, id): o topo é o início da página atual
+    cursores = st.session_state[chave]
+    with read_scope(cid) as db:
+        df, proximo = carregar(db, cid, inicio, fim, after=cursores[-1])
+    st.dataframe(df[list(colunas)].rename(columns=colunas), use_container_width=True, hide_index=True)
+    c_ant, c_info, c_prox = st.columns([1, 2, 1])
+    if c_ant.button("◀", key=f"{chave}_ant", disabled=len(cursores) == 1):
+        cursores.pop(); st.rerun()
+    c_info.caption(f"Página {len(cursores)} de {max(1, -(-total // api.PAGE_SIZE))} · {total} lançamentos")
+    if c_prox.button("▶", key=f"{chave}_prox", disabled=proximo is None):
+        cursores.append(proximo); st.rerun()
+
+# --- LEITOR DE CÓDIGO DE BARRAS (PDV) ---
+def ao_ler_codigo():
+    # O leitor "digita" o código e envia Enter: SKU exato entra direto no carrinho e o campo é limpo
+    with session_scope() as db:
+        item = api.lookup_sku(db, cid, st.session_state['pdv_busca_txt'])
+    if item:
+        st.session_state['cart'].add(item.id, item.name, item.price_retail, item.price_wholesale)
+        st.session_state['pdv_busca_txt'] = ""
+        st.session_state['pdv_lido'] = item.name
+
+# --- TAREFAS EM SEGUNDO PLANO (barra lateral) ---
+@st.fragment(run_every="3s")
+def painel_tarefas():
+    # Só este trecho é reexecutado periodicamente para acompanhar o andamento
+    diario = journal.get()
+    if diario:
+        situacao = diario.status(cid)
+        if situacao['pending']:
+            st.caption(f"🔄 {situacao['pending']} venda(s) aguardando sincronização")
+        if situacao['last_error']:
+            st.warning("Banco principal inacessível: as vendas seguem gravadas no caixa.", icon="📡")
+        for ref, itens, quando, motivo in diario.rejected(cid, limit=3):
+            st.error(f"Venda de {quando:%d/%m %H:%M} recusada: {motivo}", icon="⚠️")
+    tarefas = jobs.list_jobs(cid, limit=5)
+    if not tarefas:
+        return
+    st.caption("TAREFAS")
+    for t in tarefas:
+        nome = jobs.LABELS.get(t.kind, t.kind)
+        if t.status in (jobs.PENDING, jobs.RUNNING):
+            st.progress(t.progress or 0.0, text=f"{nome}: {t.message or 'na fila'}")
+        elif t.status == jobs.FAILED:
+            st.error(f"{nome}: {t.message}", icon="⚠️")
+        elif t.result_name:
+            # O arquivo só é lido do disco para a tarefa escolhida, não a cada atualização do painel
+            if st.session_state.get('tarefa_download') != t.id:
+                if st.button(f"📦 {t.result_name}", key=f"job_prep_{t.id}", use_container_width=True):
+                    st.session_state['tarefa_download'] = t.id
+                    st.rerun(scope="fragment")
+                continue
+            arquivo = jobs.open_result(cid, t.id)
+            if arquivo is None:
+                st.warning(f"{t.result_name}: arquivo não está mais disponível", icon="🗑️")
+                continue
+            with arquivo:
+                st.download_button(f"⬇️ {t.result_name}", arquivo, file_name=t.result_name,
+                                   mime=t.result_mime, key=f"job_{t.id}", use_container_width=True)
+        else:
+            st.success(f"{nome}: concluído", icon="✅")
 
 # --- FUNÇÃO AUXILIAR PARA IMAGEM (Pode ficar logo antes do if de login) ---
 def get_img_as_base64(file_path):
@@ -92,13 +183,15 @@ if not st.session_state['logged_in']:
             
             # Botão de Login
             if st.form_submit_button("Entrar no Sistema ⚡", use_container_width=True):
-                user = api.authenticate(db, u, p)
+                with session_scope() as db:
+                    user = api.authenticate(db, u, p)
                 if user:
                     st.session_state.update({
                         'logged_in': True, 
                         'user_id': user.id, 
                         'company_id': user.company_id, 
-                        'username': user.username
+                        'username': user.username,
+                        'role': user.role
                     })
                     st.rerun()
                 else:
@@ -106,12 +199,14 @@ if not st.session_state['logged_in']:
 
             # Botão Demo
             if st.form_submit_button("🧪 Ativar Modo Demo (30 dias)", use_container_width=True):
-                api.setup_demo_data(db)
+                # A carga roda em segundo plano; o progresso aparece na barra lateral
+                jobs.submit(99, "demo_seed", user_id=99)
                 st.session_state.update({
                     'logged_in': True, 
                     'user_id': 99, 
                     'company_id': 99, 
-                    'username': 'Admin Demo'
+                    'username': 'Admin Demo',
+                    'role': 'admin'
                 })
                 st.rerun()
                 
@@ -119,12 +214,20 @@ if not st.session_state['logged_in']:
     st.stop()
 # --- ESTRUTURA PRINCIPAL (SIDEBAR) ---
 cid = st.session_state['company_id']
+# Rótulo no menu -> nome da seção nas métricas de tempo de página
+PAGINAS = {"📊 Dashboard": "Dashboard", "🛒 Checkout (PDV)": "PDV", "💰 Fluxo Financeiro": "Financeiro", "📦 Estoque": "Estoque"}
+if st.session_state.get('role') == "superadmin":
+    PAGINAS["🩺 Diagnóstico"] = "Diagnóstico"
 with st.sidebar:
     st.image("logo_peegflow.jpg", width=140)
     st.write(f"👤 **{st.session_state['username']}**")
     st.divider()
-    choice = st.radio("Navegação", ["📊 Dashboard", "🛒 Checkout (PDV)", "💰 Fluxo Financeiro", "📦 Estoque"])
+    choice = st.radio("Navegação", list(PAGINAS))
     if st.button("Sair"): st.session_state.clear(); st.rerun()
+    st.divider()
+    painel_tarefas()
+
+pagina_inicio = time.perf_counter()
 
 # --- DASHBOARD EXECUTIVO 2.0 ---
 if choice == "📊 Dashboard":
@@ -132,51 +235,42 @@ if choice == "📊 Dashboard":
     st.markdown("Visão estratégica do seu negócio em tempo real.")
     
     # 1. PREPARAÇÃO DOS DADOS
-    # Vamos pegar 60 dias para poder comparar "Mês Atual" vs "Mês Anterior"
-    end_date = datetime.now()
-    start_date_current = end_date - timedelta(days=30)
-    start_date_previous = start_date_current - timedelta(days=30)
-    
-    # Busca dados brutos
-    df_vendas_atual, df_desp_atual = api.get_financial_by_range(db, cid, start_date_current, end_date)
-    df_vendas_prev, df_desp_prev = api.get_financial_by_range(db, cid, start_date_previous, start_date_current)
-
-    # Cálculos dos KPIs
-    rec_atual = df_vendas_atual['price'].sum() if not df_vendas_atual.empty else 0
-    rec_prev = df_vendas_prev['price'].sum() if not df_vendas_prev.empty else 0
-    delta_rec = rec_atual - rec_prev
-    
-    lucro_atual = rec_atual - (df_desp_atual['amount'].sum() if not df_desp_atual.empty else 0)
-    
-    ticket_medio = df_vendas_atual['price'].mean() if not df_vendas_atual.empty else 0
-    
-    # Contagem de Vendas (Transações)
-    qtd_vendas = len(df_vendas_atual)
+    # Período atual vs período anterior de mesmo tamanho
+    dias = st.selectbox("Período", [7, 30, 90, 365], index=1, format_func=lambda d: f"Últimos {d} dias")
+    # Janelas por dia inteiro: mesmas chaves de cache em todos os reruns do dia
+    end_date = datetime.combine(datetime.now().date(), datetime.max.time())
+    start_date_current = datetime.combine(end_date.date() - timedelta(days=dias - 1), datetime.min.time())
+
+    # KPIs dos dois períodos, resumo diário, mapa de calor e top produtos: consultas em paralelo
+    with instrumentation.section("Dashboard: consultas"):
+        dados = api.load_dashboard(read_sessionmaker(cid), cid, dias, start_date_current, end_date)
+    kpis, df_resumo_atual, heat_data, df_top = dados.kpis, dados.daily, dados.heatmap, dados.top_products
+    atual = kpis.current
 
     # 2. KPI CARDS COM DELTA (COMPARATIVO)
     col1, col2, col3, col4 = st.columns(4)
     
     col1.metric(
-        "Faturamento (30d)", 
-        f"€ {rec_atual:,.2f}", 
-        f"{delta_rec:,.2f} vs mês ant.",
+        f"Faturamento ({dias}d)", 
+        f"€ {atual.revenue:,.2f}", 
+        f"{kpis.revenue_delta:,.2f} vs período ant.",
         delta_color="normal" # Verde se positivo, vermelho se negativo
     )
     col2.metric(
         "Lucro Líquido Est.", 
-        f"€ {lucro_atual:,.2f}",
-        "Margem: " + (f"{lucro_atual/rec_atual:.1%}" if rec_atual > 0 else "0%"),
+        f"€ {atual.profit:,.2f}",
+        f"Margem: {atual.margin:.1%}",
         delta_color="off"
     )
     col3.metric(
         "Ticket Médio", 
-        f"€ {ticket_medio:,.2f}",
+        f"€ {atual.avg_ticket:,.2f}",
         help="Valor médio gasto por cliente por compra"
     )
     col4.metric(
         "Total Vendas", 
-        f"{qtd_vendas}",
-        f"{qtd_vendas - len(df_vendas_prev)} vs mês ant."
+        f"{atual.transactions}",
+        f"{kpis.transactions_delta} vs período ant."
     )
 
     st.divider()
@@ -186,16 +280,7 @@ if choice == "📊 Dashboard":
 
     with col_g1:
         st.subheader("📈 Mapa de Calor de Vendas")
-        if not df_vendas_atual.empty:
-            # Processamento para Heatmap (Dia da Semana x Hora)
-            df_heat = df_vendas_atual.copy()
-            df_heat['date'] = pd.to_datetime(df_heat['date'])
-            df_heat['hour'] = df_heat['date'].dt.hour
-            df_heat['weekday'] = df_heat['date'].dt.day_name()
-            
-            # Agrupar dados
-            heat_data = df_heat.groupby(['weekday', 'hour'])['price'].sum().reset_index()
-            
+        if not heat_data.empty:
             # Ordenar dias da semana corretamente
             days_order = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
             
@@ -216,10 +301,8 @@ if choice == "📊 Dashboard":
 
     with col_g2:
         st.subheader("🏆 Top Produtos")
-        if not df_vendas_atual.empty:
-            # Agrupar por produto e somar vendas
-            df_top = df_vendas_atual.groupby('product_name')['price'].sum().reset_index()
-            df_top = df_top.sort_values(by='price', ascending=True).tail(5) # Top 5
+        if not df_top.empty:
+            df_top = df_top.sort_values(by='price', ascending=True) # Top 5, maior no topo do gráfico
             
             fig_bar = px.bar(
                 df_top, 
@@ -238,19 +321,10 @@ if choice == "📊 Dashboard":
 
     # 4. GRÁFICO DE TENDÊNCIA (LINHA DO TEMPO)
     st.subheader("Evolução Diária (Vendas vs Custos)")
-    if not df_vendas_atual.empty:
-        # Agrupa Vendas por dia
-        daily_sales = df_vendas_atual.groupby(df_vendas_atual['date'].dt.date)['price'].sum().reset_index()
-        daily_sales['Tipo'] = 'Receita'
-        daily_sales.rename(columns={'price': 'Valor'}, inplace=True)
-        
-        # Agrupa Despesas por dia
-        daily_exp = df_desp_atual.groupby(df_desp_atual['date'].dt.date)['amount'].sum().reset_index()
-        daily_exp['Tipo'] = 'Despesa'
-        daily_exp.rename(columns={'amount': 'Valor'}, inplace=True)
-        
-        # Junta tudo
-        df_chart = pd.concat([daily_sales, daily_exp])
+    if not df_resumo_atual.empty:
+        # Receita e Despesa por dia já vêm agregadas do resumo diário
+        df_chart = df_resumo_atual.melt(id_vars='date', value_vars=['revenue', 'expenses'], var_name='Tipo', value_name='Valor')
+        df_chart['Tipo'] = df_chart['Tipo'].map({'revenue': 'Receita', 'expenses': 'Despesa'})
         
         fig_evol = px.area(
             df_chart, 
@@ -270,13 +344,22 @@ elif choice == "🛒 Checkout (PDV)":
 
     # --- COLUNA DA ESQUERDA (PRODUTOS) ---
     with col_prod:
-        search = st.text_input("🔍 Pesquisar produto ou código de barras...", placeholder="Ex: iPhone...")
-        prods = api.get_products(db, cid)
+        search = st.text_input("🔍 Pesquisar produto ou código de barras...", placeholder="Ex: iPhone...",
+                               key='pdv_busca_txt', on_change=ao_ler_codigo)
+        if lido := st.session_state.pop('pdv_lido', None):
+            st.toast(f"✅ {lido} adicionado")
+        # Nova busca volta para a primeira página
+        if st.session_state.get('pdv_busca') != search:
+            st.session_state.update({'pdv_busca': search, 'pdv_pagina': 0})
+        pagina = st.session_state['pdv_pagina']
+        # Busca no banco (índice por nome/SKU), já ordenada e limitada a uma página
+        with session_scope() as db:
+            filtered_prods, tem_mais = api.search_products(db, cid, search, pagina)
 
         # Grid de produtos
         p_cols = st.columns(3)
-        # Filtro simples
-        filtered_prods = [pr for pr in prods if search.lower() in pr.name.lower()]
+        if not filtered_prods:
+            st.info("Nenhum produto encontrado.")
         
         for i, p in enumerate(filtered_prods):
             with p_cols[i % 3]:
@@ -288,57 +371,102 @@ elif choice == "🛒 Checkout (PDV)":
                 </div>
                 """, unsafe_allow_html=True)
                 if st.button("Adicionar", key=f"add_{p.id}", use_container_width=True):
-                    st.session_state['cart'].append({"id": p.id, "name": p.name, "price": p.price_retail})
+                    st.session_state['cart'].add(p.id, p.name, p.price_retail, p.price_wholesale)
                     st.rerun()
 
+        if pagina or tem_mais:
+            c_ant, c_pag, c_prox = st.columns([1, 2, 1])
+            if c_ant.button("◀ Anteriores", disabled=pagina == 0, use_container_width=True):
+                st.session_state['pdv_pagina'] -= 1; st.rerun()
+            c_pag.caption(f"Página {pagina + 1}")
+            if c_prox.button("Próximos ▶", disabled=not tem_mais, use_container_width=True):
+                st.session_state['pdv_pagina'] += 1; st.rerun()
+
     # --- COLUNA DA DIREITA (CUPOM) ---
     with col_receipt:
-        # 1. Construção do HTML do Cupom (Visual Preto)
-        receipt_html = '<div class="receipt-panel">'
+        carrinho = st.session_state['cart']
+        # 1. Construção do HTML do Cupom (Visual Preto): uma linha por produto, total já acumulado no carrinho
+        partes = ['<div class="receipt-panel">']
         
         # Cabeçalho
-        receipt_html += f'<div class="receipt-title">CUPÃO FISCAL #{datetime.now().strftime("%H%M")}</div>'
+        partes.append(f'<div class="receipt-title">CUPÃO FISCAL #{datetime.now().strftime("%H%M")}</div>')
 
         # Itens
-        total = 0.0
-        if not st.session_state['cart']:
-            receipt_html += '<div style="color: #4B5563; text-align: center; margin-top: 60px;">Aguardando produtos...</div>'
+        if not len(carrinho):
+            partes.append('<div style="color: #4B5563; text-align: center; margin-top: 60px;">Aguardando produtos...</div>')
         else:
-            for item in st.session_state['cart']:
-                total += item['price']
-                receipt_html += f'<div class="receipt-item"><span>{item["name"]}</span><span style="font-weight: 700;">€ {item["price"]:,.2f}</span></div>'
+            for linha in carrinho:
+                faixa = " · atacado" if linha.kind == cart.WHOLESALE else ""
+                partes.append(
+                    f'<div class="receipt-item"><span>{linha.qty}× {linha.name}'
+                    f'<span style="color: #A3AED0; font-size: 0.8rem;"> € {linha.unit_price:,.2f}{faixa}</span></span>'
+                    f'<span style="font-weight: 700;">€ {linha.total:,.2f}</span></div>')
 
         # Totalização
-        receipt_html += '<div class="receipt-total-section">'
-        receipt_html += f'<div class="receipt-item"><span style="color: #A3AED0;">Subtotal</span><span>€ {total:,.2f}</span></div>'
-        receipt_html += f"""
+        partes.append('<div class="receipt-total-section">')
+        partes.append(f'<div class="receipt-item"><span style="color: #A3AED0;">Subtotal ({carrinho.units} un.)</span><span>€ {carrinho.total:,.2f}</span></div>')
+        partes.append(f"""
             <div style="display: flex; justify-content: space-between; align-items: baseline; margin-top: 10px;">
                 <span style="color: #A3AED0; font-weight: 700; font-size: 0.9rem;">TOTAL</span>
-                <span class="total-value">€ {total:,.2f}</span>
+                <span class="total-value">€ {carrinho.total:,.2f}</span>
             </div>
-        """
-        receipt_html += '</div>' # Fecha seção total
-        receipt_html += '</div>' # Fecha o painel preto AQUI.
+        """)
+        partes.append('</div>') # Fecha seção total
+        partes.append('</div>') # Fecha o painel preto AQUI.
         
         # 2. Renderiza o visual
-        st.markdown(receipt_html, unsafe_allow_html=True)
+        st.markdown("".join(partes), unsafe_allow_html=True)
+
+        # Quantidade e faixa de preço editáveis por linha (quantidade 0 remove o item)
+        if len(carrinho):
+            df_carrinho = pd.DataFrame([{'id': l.id, 'Produto': l.name, 'Qtd': l.qty, 'Preço': l.kind} for l in carrinho])
+            editado = st.data_editor(
+                df_carrinho,
+                column_config={
+                    'id': None,
+                    'Produto': st.column_config.TextColumn(disabled=True),
+                    'Qtd': st.column_config.NumberColumn(min_value=0, step=1, format="%d"),
+                    'Preço': st.column_config.SelectboxColumn(options=list(cart.KINDS), required=True),
+                },
+                hide_index=True, use_container_width=True, key=f"carrinho_{carrinho.version}"
+            )
+            mudou = False
+            for antes, depois in zip(df_carrinho.itertuples(index=False), editado.itertuples(index=False)):
+                if depois.Preço != antes.Preço:
+                    carrinho.set_kind(antes.id, depois.Preço); mudou = True
+                if depois.Qtd != antes.Qtd:
+                    carrinho.set_qty(antes.id, int(depois.Qtd or 0)); mudou = True
+            if mudou:
+                st.rerun()
 
         # 3. Botões (Ficam FORA do HTML, logo abaixo)
         st.write("") # Espaçamento
         
         if st.button("FINALIZAR VENDA (F10)", type="primary", use_container_width=True):
-            if st.session_state['cart']:
-                for item in st.session_state['cart']:
-                    # Certifique-se que api.process_sale existe e aceita esses argumentos
-                    api.process_sale(db, item['id'], 1, "varejo", st.session_state['user_id'], cid)
-                st.session_state['cart'] = []
-                st.success("Venda processada!")
-                st.rerun()
+            if len(carrinho):
+                diario = journal.get()
+                if diario:
+                    # Diário local: a venda fica gravada no disco do caixa e vai ao banco em segundo plano
+                    diario.record(cid, st.session_state['user_id'], carrinho.items())
+                    ok, resultados = True, []
+                else:
+                    # Checkout do carrinho inteiro numa única transação, uma linha por produto
+                    with session_scope() as db:
+                        ok, resultados = api.process_cart(db, carrinho.items(), st.session_state['user_id'], cid)
+                if ok:
+                    carrinho.clear()
+                    st.success("Venda processada!")
+                    st.rerun()
+                else:
+                    falhas = [r for r in resultados if not r['ok']]
+                    for r in falhas:
+                        linha = carrinho.lines.get(r['id'])
+                        st.error(f"{linha.name if linha else r['id']}: {r['msg']}")
             else:
                 st.warning("Carrinho vazio!")
 
         if st.button("🗑️ Limpar Tudo", use_container_width=True):
-            st.session_state['cart'] = []
+            carrinho.clear()
             st.rerun()
 
 
@@ -365,13 +493,19 @@ elif choice == "💰 Fluxo Financeiro":
         dt_end_full = datetime.combine(dt_fim, datetime.max.time())
 
         if st.button("🔍 Gerar Fechamento"):
-            # Busca dados filtrados
-            df_vendas, df_despesas = api.get_financial_by_range(db, cid, dt_start_full, dt_end_full)
-            
-            # Cálculos
-            total_entradas = df_vendas['price'].sum() if not df_vendas.empty else 0.0
-            total_saidas = df_despesas['amount'].sum() if not df_despesas.empty else 0.0
-            saldo = total_entradas - total_saidas
+            # O período fica no estado da sessão: a paginação das tabelas gera novos reruns
+            st.session_state['fechamento'] = (dt_start_full, dt_end_full)
+            st.session_state['fech_vendas'] = [None]
+            st.session_state['fech_despesas'] = [None]
+
+        if 'fechamento' in st.session_state:
+            fech_inicio, fech_fim = st.session_state['fechamento']
+            # Totais somados em blocos pelo cursor do servidor, sem carregar o período inteiro
+            with read_scope(cid) as db:
+                totais = api.get_closing_totals(db, cid, fech_inicio, fech_fim)
+            total_entradas = totais.revenue
+            total_saidas = totais.expenses
+            saldo = totais.balance
 
             # Cards de Resumo (Estilo CSS do usuário)
             col_kpi1, col_kpi2, col_kpi3 = st.columns(3)
@@ -396,32 +530,48 @@ elif choice == "💰 Fluxo Financeiro":
 
             st.divider()
 
-            # Detalhamento
+            # Detalhamento (paginado: uma página por vez vinda do banco)
             col_det1, col_det2 = st.columns(2)
             
             with col_det1:
                 st.subheader("📥 Detalhe de Entradas (Vendas)")
-                if not df_vendas.empty:
-                    # Tratamento visual da tabela
-                    st.dataframe(
-                        df_vendas[['date', 'product_name', 'quantity', 'price']].rename(columns={'date': 'Data', 'product_name': 'Produto', 'quantity': 'Qtd', 'price': 'Valor'}),
-                        use_container_width=True,
-                        hide_index=True
-                    )
+                if totais.sales_count:
+                    tabela_paginada('fech_vendas', api.get_sales_page, fech_inicio, fech_fim, totais.sales_count,
+                                    {'date': 'Data', 'product_name': 'Produto', 'quantity': 'Qtd', 'price': 'Valor'})
                 else:
                     st.info("Nenhuma venda neste período.")
 
             with col_det2:
                 st.subheader("📤 Detalhe de Saídas (Despesas)")
-                if not df_despesas.empty:
-                    st.dataframe(
-                        df_despesas[['date', 'category', 'description', 'amount']].rename(columns={'date': 'Data', 'category': 'Categoria', 'description': 'Descrição', 'amount': 'Valor'}),
-                        use_container_width=True,
-                        hide_index=True
-                    )
+                if totais.expense_count:
+                    tabela_paginada('fech_despesas', api.get_expenses_page, fech_inicio, fech_fim, totais.expense_count,
+                                    {'date': 'Data', 'category': 'Categoria', 'description': 'Descrição', 'amount': 'Valor'})
                 else:
                     st.info("Nenhuma despesa neste período.")
 
+            st.divider()
+            # Relatório contábil completo: só para períodos encerrados, cujo conteúdo não muda mais
+            if fech_fim.date() < datetime.now().date():
+                if st.button("📄 Gerar Relatório Detalhado (PDF)"):
+                    jobs.submit(cid, "ledger_pdf", {'start': fech_inicio.date(), 'end': fech_fim.date()}, st.session_state['user_id'])
+                    st.toast("Relatório na fila: acompanhe e baixe em Tarefas, na barra lateral.")
+            else:
+                st.caption("O relatório detalhado em PDF fica disponível para períodos já encerrados (até ontem).")
+
+        # Exportação para BI: gerada em segundo plano, em blocos, e baixada pela barra lateral
+        with st.expander("📤 Exportar dados (CSV / Parquet)"):
+            with st.form("form_exportacao"):
+                c_exp1, c_exp2 = st.columns(2)
+                fluxo = c_exp1.selectbox("Dados", ["sales", "expenses"], format_func={"sales": "Vendas", "expenses": "Despesas"}.get)
+                formato = c_exp2.selectbox("Formato", list(api.EXPORT_FORMATS))
+                incremental = st.checkbox("Somente o que entrou desde a última exportação incremental (ignora o período)")
+                if st.form_submit_button("Exportar"):
+                    params = {'stream': fluxo, 'format': formato, 'incremental': incremental}
+                    if not incremental:
+                        params.update(start=dt_start_full, end=dt_end_full)
+                    jobs.submit(cid, "export", params, st.session_state['user_id'])
+                    st.toast("Exportação na fila: acompanhe e baixe em Tarefas, na barra lateral.")
+
     # --- ABA 2: CALENDÁRIO FISCAL (CADASTROS) ---
     with tab_calendario:
         c_form, c_list = st.columns([0.4, 0.6], gap="large")
@@ -441,7 +591,8 @@ elif choice == "💰 Fluxo Financeiro":
                     if d_desc and d_valor > 0:
                         # Converte data para datetime completo
                         d_data_full = datetime.combine(d_data, datetime.now().time())
-                        api.add_expense(db, cid, d_desc, d_valor, d_tipo, d_data_full)
+                        with session_scope() as db:
+                            api.add_expense(db, cid, d_desc, d_valor, d_tipo, d_data_full)
                         st.success("Despesa lançada com sucesso!")
                         st.rerun()
                     else:
@@ -453,9 +604,11 @@ elif choice == "💰 Fluxo Financeiro":
             st.subheader("📅 Histórico e Previsão de Contas")
             
             # Pega todas as despesas dos últimos 60 dias e próximos 30 dias
-            d_start = datetime.now() - timedelta(days=60)
-            d_end = datetime.now() + timedelta(days=30)
-            _, df_all_expenses = api.get_financial_by_range(db, cid, d_start, d_end)
+            hoje = datetime.now().date()
+            d_start = datetime.combine(hoje - timedelta(days=60), datetime.min.time())
+            d_end = datetime.combine(hoje + timedelta(days=30), datetime.max.time())
+            with read_scope(cid) as db:
+                _, df_all_expenses = api.get_financial_by_range(db, cid, d_start, d_end)
             
             if not df_all_expenses.empty:
                 # Ordenar por data
@@ -481,45 +634,35 @@ elif choice == "💰 Fluxo Financeiro":
 elif choice == "📦 Estoque":
     st.title("Gestão de Inventário Inteligente")
     
-    # Busca dados atualizados
-    prods = api.get_products(db, cid)
-    
-    # Prepara Dataframe
-    data_list = []
-    low_stock_count = 0
-    for p in prods:
-        status = "🟢 OK"
-        if p.stock <= p.stock_min:
-            status = "🔴 BAIXO"
-            low_stock_count += 1
-            
-        data_list.append({
-            "ID": p.id,
-            "SKU": p.sku,
-            "Produto": p.name,
-            "Preço Venda": p.price_retail,
-            "Estoque Atual": p.stock,
-            "Mínimo": p.stock_min,
-            "Status": status
-        })
-    df_estoque = pd.DataFrame(data_list)
-
-    # Métricas de Topo
+    # Métricas de Topo (uma consulta agregada no banco)
+    with read_scope(cid) as db:
+        resumo = api.get_inventory_summary(db, cid)
+    low_stock_count = resumo.low_stock
     m1, m2, m3 = st.columns(3)
-    m1.metric("Total de Produtos", len(prods))
-    m2.metric("Valor em Estoque (Estimado)", f"€ {sum([p.stock * p.price_wholesale for p in prods]):,.2f}")
+    m1.metric("Total de Produtos", resumo.products)
+    m2.metric("Valor em Estoque (Estimado)", f"€ {resumo.stock_value:,.2f}")
     m3.metric("Alertas de Reposição", low_stock_count, delta=-low_stock_count if low_stock_count > 0 else 0, delta_color="inverse")
 
     st.divider()
 
     # ABAS: Visão Geral | Reposição | Novo Produto
-    tab_visao, tab_repor, tab_novo = st.tabs(["📋 Visão Geral & Alertas", "➕ Repor Estoque", "✨ Novo Produto"])
+    tab_visao, tab_repor, tab_mov, tab_novo = st.tabs(["📋 Visão Geral & Alertas", "➕ Repor Estoque", "📜 Movimentações", "✨ Novo Produto"])
 
     # --- ABA 1: VISÃO GERAL ---
     with tab_visao:
         if low_stock_count > 0:
             st.warning(f"⚠️ Atenção! Existem {low_stock_count} produtos com estoque abaixo do mínimo.")
-        
+        so_alertas = st.toggle("Mostrar só produtos abaixo do mínimo", value=low_stock_count > 0)
+
+        # Projeção das colunas direto num DataFrame; status calculado na coluna inteira
+        with read_scope(cid) as db:
+            df_estoque = api.get_inventory(db, cid, low_only=so_alertas)
+        df_estoque['status'] = (df_estoque['stock'] <= df_estoque['stock_min']).map({True: "🔴 BAIXO", False: "🟢 OK"})
+        df_estoque = df_estoque.rename(columns={
+            'id': "ID", 'sku': "SKU", 'name': "Produto", 'price_retail': "Preço Venda",
+            'stock': "Estoque Atual", 'stock_min': "Mínimo", 'status': "Status"
+        })
+
         # Tabela com formatação visual
         st.dataframe(
             df_estoque,
@@ -543,21 +686,67 @@ elif choice == "📦 Estoque":
             st.markdown("### 📥 Entrada de Mercadoria")
             st.info("Esta ação aumentará o estoque e lançará uma despesa no financeiro automaticamente.")
             
+            # Busca no banco em vez de listar o catálogo inteiro no seletor
+            busca_repor = st.text_input("🔍 Buscar produto (nome ou SKU)", key="busca_repor")
+            with session_scope() as db:
+                encontrados, _ = api.search_products(db, cid, busca_repor, 0, 50)
+
             with st.form("form_repor"):
                 # Selectbox com ID oculto visualmente mas útil para lógica
-                prod_options = {f"{p.sku} - {p.name} (Atual: {p.stock})": p.id for p in prods}
+                prod_options = {f"{p.sku} - {p.name} (Atual: {p.stock})": p.id for p in encontrados}
                 selected_label = st.selectbox("Selecione o Produto", list(prod_options.keys()))
-                selected_id = prod_options[selected_label]
+                selected_id = prod_options.get(selected_label)
                 
                 r_qty = st.number_input("Quantidade a Adicionar", min_value=1, step=1)
                 r_cost = st.number_input("Custo Unitário de Compra (€)", min_value=0.01, format="%.2f", help="Quanto você pagou por cada unidade ao fornecedor?")
                 
-                if st.form_submit_button("✅ Confirmar Entrada"):
-                    api.restock_product(db, cid, selected_id, r_qty, r_cost)
+                if st.form_submit_button("✅ Confirmar Entrada", disabled=selected_id is None):
+                    with session_scope() as db:
+                        api.restock_product(db, cid, selected_id, r_qty, r_cost)
                     st.success("Estoque atualizado e Custo lançado no Financeiro!")
                     st.rerun()
 
-    # --- ABA 3: CADASTRAR NOVO PRODUTO ---
+        with c_r2:
+            st.markdown("### 🧮 Ajuste de Inventário")
+            st.info("Informe a contagem física: a diferença fica registrada nas movimentações.")
+            with st.form("form_ajuste"):
+                ajuste_label = st.selectbox("Produto", list(prod_options.keys()), key="ajuste_prod")
+                ajuste_id = prod_options.get(ajuste_label)
+                a_contagem = st.number_input("Quantidade contada", min_value=0, step=1)
+                a_motivo = st.text_input("Motivo", placeholder="Ex: avaria, contagem mensal")
+
+                if st.form_submit_button("📝 Registrar Ajuste", disabled=ajuste_id is None):
+                    try:
+                        with session_scope() as db:
+                            diferenca = api.adjust_stock(db, cid, ajuste_id, a_contagem, a_motivo or None, st.session_state['user_id'])
+                    except RuntimeError as e:
+                        st.error(str(e))
+                    else:
+                        if diferenca is None:
+                            st.error("Produto não encontrado; ele pode ter sido removido.")
+                        else:
+                            st.success(f"Estoque ajustado ({diferenca:+d} un.).")
+                            st.rerun()
+
+    # --- ABA 3: MOVIMENTAÇÕES (livro de estoque) ---
+    with tab_mov:
+        c_m1, c_m2 = st.columns(2)
+        mov_inicio = c_m1.date_input("De", datetime.now().date() - timedelta(days=30), key="mov_inicio")
+        mov_fim = c_m2.date_input("Até", datetime.now().date(), key="mov_fim")
+        # Limites em dias inteiros: a mesma chave de cache serve o dia todo
+        inicio = datetime.combine(mov_inicio, datetime.min.time())
+        fim = datetime.combine(mov_fim, datetime.max.time())
+        with read_scope(cid) as db:
+            df_mov = api.get_stock_report(db, cid, inicio, fim)
+        st.dataframe(
+            df_mov.drop(columns=['product_id']).rename(columns={
+                'sku': "SKU", 'name': "Produto", 'opening': "Inicial", 'sales': "Vendas",
+                'restocks': "Reposições", 'adjustments': "Ajustes", 'closing': "Final"
+            }),
+            use_container_width=True, hide_index=True
+        )
+
+    # --- ABA 4: CADASTRAR NOVO PRODUTO ---
     with tab_novo:
         st.markdown("### ✨ Cadastro de Produto")
         with st.form("form_novo_prod"):
@@ -573,8 +762,54 @@ elif choice == "📦 Estoque":
             
             if st.form_submit_button("💾 Salvar Produto"):
                 if n_nome and n_sku:
-                    api.register_product(db, cid, n_nome, n_venda, n_custo_base, n_min, n_sku)
-                    st.success(f"Produto {n_nome} cadastrado com sucesso!")
-                    st.rerun()
+                    with session_scope() as db:
+                        cadastrado = api.register_product(db, cid, n_nome, n_venda, n_custo_base, n_min, n_sku)
+                    if cadastrado:
+                        st.success(f"Produto {n_nome} cadastrado com sucesso!")
+                        st.rerun()
+                    else:
+                        st.error(f"Já existe um produto com o SKU {n_sku}.")
                 else:
                     st.error("Preencha o Nome e o SKU.")
+
+# --- DIAGNÓSTICO (somente superadmin) ---
+elif choice == "🩺 Diagnóstico" and st.session_state.get('role') == "superadmin":
+    st.title("Diagnóstico de Desempenho")
+    st.caption(f"Medições deste processo desde {instrumentation.registry.started:%d/%m %H:%M} · "
+               f"consultas lentas: ≥ {instrumentation.SLOW_QUERY_MS:.0f} ms")
+
+    pools, cache_stats = pool_status(), cache.stats()
+    nomes_pool = {'primary': "primário", 'replica': "réplica"}
+    colunas = st.columns(2 * len(pools) + 2)
+    for i, (nome, pool) in enumerate(pools.items()):
+        colunas[2 * i].metric(f"Conexões em uso ({nomes_pool[nome]})", pool.get('checked_out', "-"))
+        colunas[2 * i + 1].metric(f"Espera máx. por conexão ({nomes_pool[nome]})", f"{pool['wait_max_ms']:.1f} ms")
+    colunas[-2].metric("Acertos do cache", f"{cache_stats['hit_rate']:.0%}")
+    colunas[-1].metric("Entradas no cache", f"{cache_stats['size']}/{cache_stats['maxsize']}")
+
+    colunas_tempo = {c: st.column_config.NumberColumn(format="%.1f") for c in ('avg_ms', 'p50_ms', 'p95_ms', 'max_ms', 'total_ms')}
+    tab_sql, tab_paginas, tab_lentas, tab_prom = st.tabs(["🗄️ Consultas", "🖥️ Páginas", "🐢 Consultas lentas", "📈 Prometheus"])
+    with tab_sql:
+        st.dataframe(pd.DataFrame(instrumentation.statement_summary()), column_config=colunas_tempo,
+                     use_container_width=True, hide_index=True)
+    with tab_paginas:
+        st.dataframe(pd.DataFrame(instrumentation.section_summary()).drop(columns=['rows'], errors='ignore'),
+                     column_config=colunas_tempo, use_container_width=True, hide_index=True)
+    with tab_lentas:
+        lentas = instrumentation.slow_queries()
+        if lentas:
+            st.dataframe(pd.DataFrame(lentas, columns=["Quando", "Segundos", "Origem", "SQL", "Linhas"]),
+                         use_container_width=True, hide_index=True)
+        else:
+            st.success("Nenhuma consulta acima do limite.")
+    with tab_prom:
+        texto = instrumentation.prometheus()
+        st.download_button("⬇️ metrics.txt", texto, file_name="metrics.txt", mime="text/plain")
+        st.code(texto[:20000], language=None)
+
+    if st.button("Zerar medições"):
+        instrumentation.registry.reset()
+        st.rerun()
+
+# Tempo da página (reruns interrompidos por st.rerun/st.stop não entram)
+instrumentation.observe_section(PAGINAS[choice], time.perf_counter() - pagina_inicio)
@@ -0,0 +1,137 @@
+# migrations.py
+# Migrações versionadas do esquema.
+# Base.metadata.create_all só cria tabelas que ainda não existem; não adiciona índices
+# nem colunas em tabelas antigas. Cada migração abaixo roda uma única vez por banco
+# e fica registrada em schema_migrations.
+import argparse
+from datetime import datetime
+from sqlalchemy import inspect, text, select
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import Session
+from database import Base
+from models import DailySales, SchemaMigration
+import rollup
+
+# --- MIGRAÇÕES (versão, descrição, função que recebe a conexão) ---
+def _m001_tenant_indexes(conn):
+    dupes = conn.execute(text(
+        # SKU nulo não conta: o índice único aceita vários produtos sem SKU
+        "SELECT company_id, sku, COUNT(*) FROM products WHERE sku IS NOT NULL "
+        "GROUP BY company_id, sku HAVING COUNT(*) > 1"
+    )).fetchall()
+    if dupes:
+        lista = ", ".join(f"empresa {c} / SKU {s!r}" for c, s, _ in dupes[:10])
+        raise RuntimeError(f"SKUs duplicados impedem o índice único (company_id, sku): {lista}")
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_sales_company_date ON sales (company_id, date)"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_expenses_company_date ON expenses (company_id, date)"))
+    conn.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS ux_products_company_sku ON products (company_id, sku)"))
+
+def _m002_product_search(conn):
+    if conn.dialect.name == 'postgresql':
+        # Prefixo (LIKE 'abc%') por empresa em qualquer Postgres
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_products_company_name_prefix "
+                          "ON products (company_id, lower(name) text_pattern_ops)"))
+        # Trigramas (LIKE '%abc%' e similaridade) quando o pg_trgm estiver disponível no servidor
+        try:
+            with conn.begin_nested():
+                conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+                conn.execute(text("CREATE INDEX IF NOT EXISTS ix_products_name_trgm ON products USING gin (lower(name) gin_trgm_ops)"))
+                conn.execute(text("CREATE INDEX IF NOT EXISTS ix_products_sku_trgm ON products USING gin (lower(sku) gin_trgm_ops)"))
+        except DBAPIError:
+            pass  # sem a extensão a busca usa só o índice de prefixo
+    else:
+        # SQLite: o LIKE padrão ignora maiúsculas, e só usa índice com colação NOCASE
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_products_company_name ON products (company_id, name COLLATE NOCASE)"))
+
+def _m003_sale_orders(conn):
+    # A tabela orders já foi criada pelo create_all; falta a coluna nas vendas de bancos antigos
+    if "order_id" not in {c["name"] for c in inspect(conn).get_columns("sales")}:
+        conn.execute(text("ALTER TABLE sales ADD COLUMN order_id INTEGER REFERENCES orders (id)"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_sales_order ON sales (order_id)"))
+
+def _m004_low_stock_index(conn):
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_products_low_stock ON products (company_id) WHERE stock <= stock_min"))
+
+def _m005_order_client_ref(conn):
+    if "client_ref" not in {c["name"] for c in inspect(conn).get_columns("orders")}:
+        conn.execute(text("ALTER TABLE orders ADD COLUMN client_ref VARCHAR(36)"))
+    conn.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS ux_orders_client_ref ON orders (client_ref)"))
+
+def _m006_backfill_rollups(conn):
+    # Bancos anteriores aos resumos diários só ganharam as tabelas vazias: sem isto o Dashboard
+    # mostra zero até alguém rodar rollup.py. O commit da sessão não encerra a transação da migração.
+    with Session(bind=conn) as db:
+        rollup.rebuild(db)
+
+def _m007_daily_sales_shards(conn):
+    # A chave passa de (empresa, dia) para (empresa, dia, shard); as linhas existentes ficam no shard 0
+    if "shard" in {c["name"] for c in inspect(conn).get_columns("daily_sales")}:
+        return
+    if conn.dialect.name == 'postgresql':
+        pk_name = inspect(conn).get_pk_constraint("daily_sales")['name']
+        conn.execute(text("ALTER TABLE daily_sales ADD COLUMN shard INTEGER NOT NULL DEFAULT 0"))
+        conn.execute(text(f"ALTER TABLE daily_sales DROP CONSTRAINT {pk_name}"))
+        conn.execute(text("ALTER TABLE daily_sales ADD PRIMARY KEY (company_id, day, shard)"))
+    else:
+        # SQLite não altera a chave primária: recria a tabela e copia
+        conn.execute(text("ALTER TABLE daily_sales RENAME TO daily_sales_old"))
+        DailySales.__table__.create(conn)
+        conn.execute(text("INSERT INTO daily_sales (company_id, day, shard, revenue, units, transactions) "
+                          "SELECT company_id, day, 0, revenue, units, transactions FROM daily_sales_old"))
+        conn.execute(text("DROP TABLE daily_sales_old"))
+
+def _m008_job_owner(conn):
+    columns = {c["name"] for c in inspect(conn).get_columns("jobs")}
+    for name, kind in (("owner", "VARCHAR"), ("heartbeat_at", "TIMESTAMP")):
+        if name not in columns:
+            conn.execute(text(f"ALTER TABLE jobs ADD COLUMN {name} {kind}"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_jobs_status ON jobs (status)"))
+
+def _m009_job_result_path(conn):
+    if "result_path" not in {c["name"] for c in inspect(conn).get_columns("jobs")}:
+        conn.execute(text("ALTER TABLE jobs ADD COLUMN result_path VARCHAR"))
+
+MIGRATIONS = [
+    (1, "Índices compostos (empresa, data) e SKU único por empresa", _m001_tenant_indexes),
+    (2, "Índices de busca de produtos (prefixo e trigramas)", _m002_product_search),
+    (3, "Pedidos: coluna sales.order_id e índice", _m003_sale_orders),
+    (4, "Índice parcial de produtos abaixo do estoque mínimo", _m004_low_stock_index),
+    (5, "Pedidos: referência única do PDV (diário local)", _m005_order_client_ref),
+    (6, "Resumos diários calculados a partir das vendas e despesas existentes", _m006_backfill_rollups),
+    (7, "Resumo diário de vendas em várias linhas por dia (shard)", _m007_daily_sales_shards),
+    (8, "Tarefas: processo dono e sinal de vida", _m008_job_owner),
+    (9, "Tarefas: arquivo gerado em disco (caminho)", _m009_job_result_path),
+]
+
+def current_version(conn):
+    return conn.execute(select(SchemaMigration.version).order_by(SchemaMigration.version.desc())).scalar() or 0
+
+def upgrade(engine: Engine):
+    """Cria tabelas novas e aplica, em ordem, as migrações pendentes. Retorna a versão final."""
+    Base.metadata.create_all(bind=engine)
+    with engine.begin() as conn:
+        if conn.dialect.name == 'postgresql':
+            # Vários processos do Streamlit podem subir ao mesmo tempo: só um migra
+            conn.execute(text("SELECT pg_advisory_xact_lock(727001)"))
+        version = current_version(conn)
+        for number, description, migrate in MIGRATIONS:
+            if number <= version:
+                continue
+            migrate(conn)
+            conn.execute(SchemaMigration.__table__.insert().values(
+                version=number, description=description, applied_at=datetime.utcnow()))
+            version = number
+    return version
+
+# Uso: python migrations.py [--url URL]
+if __name__ == "__main__":
+    from sqlalchemy import create_engine
+    parser = argparse.ArgumentParser(description="Aplica as migrações pendentes do esquema")
+    parser.add_argument("--url", default=None, help="URL do banco (padrão: o de database.py)")
+    args = parser.parse_args()
+    if args.url:
+        target = create_engine(args.url)
+    else:
+        from database import engine as target
+    print(f"Esquema na versão {upgrade(target)}.")
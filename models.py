@@ -1,5 +1,5 @@
 # models.py
-from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey, Boolean
+from sqlalchemy import Column, Integer, String, Float, DateTime, Date, ForeignKey, Boolean, Index, Text, LargeBinary, text
 from sqlalchemy.orm import relationship
 from datetime import datetime
 from database import Base
@@ -49,6 +49,32 @@ class Product(Base):
     company_id = Column(Integer, ForeignKey("companies.id"))
     company = relationship("Company", back_populates="products")
 
+    __table_args__ = (
+        Index("ux_products_company_sku", "company_id", "sku", unique=True),
+        # Índice parcial: só os produtos abaixo do mínimo (alertas de reposição)
+        Index("ix_products_low_stock", "company_id",
+              postgresql_where=text("stock <= stock_min"), sqlite_where=text("stock <= stock_min")),
+    )
+
+# --- TABELA DE PEDIDOS (um por cupom/checkout; as vendas são as linhas) ---
+class Order(Base):
+    __tablename__ = "orders"
+
+    id = Column(Integer, primary_key=True, index=True)
+    total = Column(Float, default=0.0)   # Soma das linhas (preço x quantidade)
+    items = Column(Integer, default=0)   # Unidades no pedido
+    date = Column(DateTime, default=datetime.now)
+    user_id = Column(Integer, ForeignKey("users.id"))
+    company_id = Column(Integer, ForeignKey("companies.id"))
+    client_ref = Column(String(36))      # Id gerado no PDV (diário local); garante gravação única
+
+    lines = relationship("Sale", back_populates="order")
+
+    __table_args__ = (
+        Index("ix_orders_company_date", "company_id", "date"),
+        Index("ux_orders_client_ref", "client_ref", unique=True),
+    )
+
 # --- TABELA DE VENDAS ---
 class Sale(Base):
     __tablename__ = "sales"
@@ -63,6 +89,13 @@ class Sale(Base):
     # Rastreabilidade
     user_id = Column(Integer, ForeignKey("users.id"))
     company_id = Column(Integer, ForeignKey("companies.id"))
+    order_id = Column(Integer, ForeignKey("orders.id"))  # Pedido (cupom); vazio em vendas antigas/importadas
+    order = relationship("Order", back_populates="lines")
+
+    __table_args__ = (
+        Index("ix_sales_company_date", "company_id", "date"),
+        Index("ix_sales_order", "order_id"),
+    )
 
 # --- TABELA DE DESPESAS (Para o Financeiro) ---
 class Expense(Base):
@@ -76,4 +109,114 @@ class Expense(Base):
     
     # Vínculo com a empresa
     company_id = Column(Integer, ForeignKey("companies.id"))
-    company = relationship("Company", back_populates="expenses")
\ No newline at end of file
+    company = relationship("Company", back_populates="expenses")
+
+    __table_args__ = (
+        Index("ix_expenses_company_date", "company_id", "date"),
+    )
+
+# --- LIVRO DE MOVIMENTAÇÕES DE ESTOQUE (só inserções; ver ledger.py) ---
+class StockMovement(Base):
+    __tablename__ = "stock_movements"
+
+    id = Column(Integer, primary_key=True, index=True)
+    product_id = Column(Integer, ForeignKey("products.id"))
+    kind = Column(String)         # venda, reposicao, ajuste, abertura
+    quantity = Column(Integer)    # Variação com sinal (venda negativa, reposição positiva)
+    stock_after = Column(Integer) # Estoque do produto logo após a movimentação
+    note = Column(String)
+    order_id = Column(Integer, ForeignKey("orders.id"))
+    user_id = Column(Integer)
+    date = Column(DateTime, default=datetime.now)
+    company_id = Column(Integer, ForeignKey("companies.id"))
+
+    __table_args__ = (
+        Index("ix_stock_movements_company_product_date", "company_id", "product_id", "date"),
+        Index("ix_stock_movements_company_date", "company_id", "date"),
+    )
+
+# --- FOTO DIÁRIA DO ESTOQUE (estoque de cada produto ao final do dia) ---
+class StockSnapshot(Base):
+    __tablename__ = "stock_snapshots"
+
+    company_id = Column(Integer, ForeignKey("companies.id"), primary_key=True)
+    day = Column(Date, primary_key=True)
+    product_id = Column(Integer, ForeignKey("products.id"), primary_key=True)
+    stock = Column(Integer)
+
+# --- RESUMO DIÁRIO DE VENDAS (mantido a cada venda, lido pelo Dashboard) ---
+# Várias linhas por dia (shard): cada venda soma numa delas, e os caixas da loja não disputam
+# o mesmo registro. O total do dia é a soma das linhas.
+class DailySales(Base):
+    __tablename__ = "daily_sales"
+
+    company_id = Column(Integer, ForeignKey("companies.id"), primary_key=True)
+    day = Column(Date, primary_key=True)
+    shard = Column(Integer, primary_key=True, server_default=text("0"))  # só default no banco: a migração 6 grava sem a coluna
+    revenue = Column(Float, default=0.0)      # Soma de preço x quantidade
+    units = Column(Integer, default=0)        # Unidades vendidas
+    transactions = Column(Integer, default=0) # Número de pedidos (cupons); venda sem pedido conta como um
+
+# --- RESUMO DIÁRIO DE DESPESAS POR CATEGORIA ---
+class DailyExpense(Base):
+    __tablename__ = "daily_expenses"
+
+    company_id = Column(Integer, ForeignKey("companies.id"), primary_key=True)
+    day = Column(Date, primary_key=True)
+    category = Column(String, primary_key=True)
+    amount = Column(Float, default=0.0)
+
+
+# --- CONTROLE DE VERSÃO DO ESQUEMA (ver migrations.py) ---
+class SchemaMigration(Base):
+    __tablename__ = "schema_migrations"
+
+    version = Column(Integer, primary_key=True)
+    description = Column(String)
+    applied_at = Column(DateTime, default=datetime.utcnow)
+
+# --- MARCA D'ÁGUA DAS EXPORTAÇÕES INCREMENTAIS (último id exportado por fluxo) ---
+class ExportWatermark(Base):
+    __tablename__ = "export_watermarks"
+
+    company_id = Column(Integer, ForeignKey("companies.id"), primary_key=True)
+    stream = Column(String, primary_key=True)   # 'sales' ou 'expenses'
+    last_id = Column(Integer, default=0)
+    updated_at = Column(DateTime, default=datetime.now)
+
+# --- MESES ARQUIVADOS (partições antigas de vendas/despesas movidas para Parquet; ver partitioning.py) ---
+class ArchivedMonth(Base):
+    __tablename__ = "archived_months"
+
+    table_name = Column(String, primary_key=True)   # 'sales' ou 'expenses'
+    month = Column(Date, primary_key=True)          # primeiro dia do mês
+    path = Column(String)                           # arquivo Parquet (todas as empresas, ordenado por empresa e data)
+    rows = Column(Integer)
+    archived_at = Column(DateTime, default=datetime.now)
+
+# --- TAREFAS EM SEGUNDO PLANO (ver jobs.py) ---
+class Job(Base):
+    __tablename__ = "jobs"
+
+    id = Column(Integer, primary_key=True, index=True)
+    company_id = Column(Integer)                  # sem FK: a carga da demo enfileira antes de a empresa existir
+    user_id = Column(Integer)
+    kind = Column(String)                         # tipo registrado em jobs.TASKS
+    params = Column(Text)                         # parâmetros em JSON
+    status = Column(String, default="pendente")   # pendente, executando, concluido, erro
+    progress = Column(Float, default=0.0)         # 0.0 a 1.0
+    message = Column(String)
+    result = Column(LargeBinary)                  # arquivo gerado, em tarefas antigas (as novas usam result_path)
+    result_path = Column(String)                  # arquivo gerado (PDF, CSV...) em jobs.RESULTS_DIR
+    result_name = Column(String)
+    result_mime = Column(String)
+    created_at = Column(DateTime, default=datetime.now)
+    started_at = Column(DateTime)
+    finished_at = Column(DateTime)
+    owner = Column(String)                        # processo que assumiu a tarefa (host:pid:id)
+    heartbeat_at = Column(DateTime)               # último sinal de vida desse processo enquanto executa
+
+    __table_args__ = (
+        Index("ix_jobs_company_created", "company_id", "created_at"),
+        Index("ix_jobs_status", "status"),
+    )
@@ -0,0 +1,267 @@
+# partitioning.py
+# Particionamento mensal (Postgres) de vendas e despesas e arquivamento dos meses frios.
+# Com as tabelas particionadas por RANGE (date), as consultas por período (todas as de
+# services.py) só leem as partições do intervalo, e cada partição tem índices pequenos.
+# Meses mais antigos que o horizonte vão para arquivos Parquet (zstd) e a partição é
+# removida; o fechamento de caixa continua lendo esses meses pelos arquivos (archive_frames).
+#
+# Uso (Postgres, numa janela de manutenção para a conversão):
+#   python partitioning.py --convert               # converte sales e expenses (uma vez)
+#   python partitioning.py --ensure                # cria as partições dos próximos meses (também roda na subida do app)
+#   python partitioning.py --archive [--months 24] # arquiva os meses mais antigos que o horizonte
+import argparse
+import os
+import re
+from datetime import date, datetime
+import pandas as pd
+from sqlalchemy import Boolean, Date, DateTime, Float, Integer, inspect, select, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+from models import ArchivedMonth, Expense, Sale
+
+ARCHIVE_DIR = os.environ.get("PEEGFLOW_ARCHIVE_DIR", "archive")
+ARCHIVE_AFTER_MONTHS = int(os.environ.get("PEEGFLOW_ARCHIVE_MONTHS", 24))
+MONTHS_AHEAD = 3      # partições criadas antes de o mês começar
+ARCHIVE_CHUNK = 50000
+
+TABLES = {'sales': Sale, 'expenses': Expense}
+_PARTITION = re.compile(r"^(sales|expenses)_(\d{4})_(\d{2})$")
+
+def _month_start(day: date):
+    return date(day.year, day.month, 1)
+
+def _add_months(month: date, n: int):
+    years, index = divmod(month.month - 1 + n, 12)
+    return date(month.year + years, index + 1, 1)
+
+def _partition_name(table: str, month: date):
+    return f"{table}_{month:%Y_%m}"
+
+# --- ESTRUTURA ---
+def is_partitioned(conn, table: str) -> bool:
+    if conn.dialect.name != 'postgresql':
+        return False
+    return conn.execute(text("SELECT relkind FROM pg_class WHERE oid = to_regclass(:t)"), {'t': table}).scalar() == 'p'
+
+def partitions(conn, table: str):
+    """Meses (primeiro dia) que têm partição própria, em ordem."""
+    names = conn.execute(text(
+        "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = to_regclass(:t)"
+    ), {'t': table}).scalars()
+    months = [date(int(m.group(2)), int(m.group(3)), 1) for m in map(_PARTITION.match, names) if m and m.group(1) == table]
+    return sorted(months)
+
+def _create_partition(conn, table: str, month: date):
+    conn.execute(text(
+        f"CREATE TABLE IF NOT EXISTS {_partition_name(table, month)} PARTITION OF {table} "
+        f"FOR VALUES FROM ('{month}') TO ('{_add_months(month, 1)}')"
+    ))
+
+def _split_default(conn, table: str, month: date):
+    """
+    Cria a partição do mês quando a DEFAULT já tem linhas dele (ex.: vendas com data futura lançadas
+    antes de a partição existir), caso em que CREATE ... PARTITION OF falharia. A nova tabela é
+    preenchida com as linhas retiradas da DEFAULT e só então anexada ao pai.
+    """
+    name, default = _partition_name(table, month), f"{table}_default"
+    bounds = {'start': month, 'end': _add_months(month, 1)}
+    conn.execute(text(f"LOCK TABLE {default} IN ACCESS EXCLUSIVE MODE"))  # nada novo cai na DEFAULT até o ATTACH
+    conn.execute(text(f"CREATE TABLE {name} (LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)"))
+    moved = conn.execute(text(
+        f"WITH moved AS (DELETE FROM {default} WHERE date >= :start AND date < :end RETURNING *) "
+        f"INSERT INTO {name} SELECT * FROM moved"
+    ), bounds).rowcount
+    # O ATTACH cria na partição os índices do pai
+    conn.execute(text(f"ALTER TABLE {table} ATTACH PARTITION {name} FOR VALUES FROM ('{month}') TO ('{bounds['end']}')"))
+    return moved
+
+def _default_has(conn, table: str, month: date) -> bool:
+    default = f"{table}_default"
+    if conn.execute(text("SELECT to_regclass(:t)"), {'t': default}).scalar() is None:
+        return False
+    return conn.execute(text(f"SELECT EXISTS (SELECT 1 FROM {default} WHERE date >= :start AND date < :end)"),
+                        {'start': month, 'end': _add_months(month, 1)}).scalar()
+
+def convert(engine: Engine, table: str, months_ahead: int = MONTHS_AHEAD):
+    """
+    Converte a tabela em particionada por mês, copiando os dados (bloqueia a tabela durante a cópia).
+    Chave primária passa a ser (id, date); índices e chaves estrangeiras são recriados no pai.
+    Retorna False se ela já estava particionada.
+    """
+    with engine.begin() as conn:
+        if conn.dialect.name != 'postgresql':
+            raise RuntimeError("O particionamento por mês só está disponível no Postgres.")
+        if is_partitioned(conn, table):
+            return False
+        conn.execute(text(f"LOCK TABLE {table} IN ACCESS EXCLUSIVE MODE"))
+        undated = conn.execute(text(f"SELECT count(*) FROM {table} WHERE date IS NULL")).scalar()
+        if undated:
+            raise RuntimeError(f"{undated} linhas de {table} sem data impedem o particionamento por data.")
+
+        insp = inspect(conn)
+        indexes, foreign_keys = insp.get_indexes(table), insp.get_foreign_keys(table)
+        pk_name = insp.get_pk_constraint(table)['name']
+        sequence = conn.execute(text("SELECT pg_get_serial_sequence(:t, 'id')"), {'t': table}).scalar()
+        first = conn.execute(text(f"SELECT min(date) FROM {table}")).scalar() or datetime.now()
+
+        old = f"{table}_unpartitioned"
+        conn.execute(text(f"ALTER TABLE {table} RENAME TO {old}"))
+        if pk_name:
+            conn.execute(text(f"ALTER TABLE {old} RENAME CONSTRAINT {pk_name} TO {old}_pkey"))
+        conn.execute(text(f"CREATE TABLE {table} (LIKE {old} INCLUDING DEFAULTS) PARTITION BY RANGE (date)"))
+        conn.execute(text(f"ALTER TABLE {table} ADD PRIMARY KEY (id, date)"))
+        if sequence:
+            conn.execute(text(f"ALTER SEQUENCE {sequence} OWNED BY {table}.id"))  # sobrevive ao DROP da antiga
+
+        # Um mês por partição, do primeiro lançamento até MONTHS_AHEAD à frente; o resto cai na DEFAULT
+        conn.execute(text(f"CREATE TABLE IF NOT EXISTS {table}_default PARTITION OF {table} DEFAULT"))
+        month, last = _month_start(first.date()), _add_months(_month_start(date.today()), months_ahead)
+        while month <= last:
+            _create_partition(conn, table, month)
+            month = _add_months(month, 1)
+
+        conn.execute(text(f"INSERT INTO {table} SELECT * FROM {old}"))
+        conn.execute(text(f"DROP TABLE {old}"))
+        for fk in foreign_keys:
+            conn.execute(text(
+                f"ALTER TABLE {table} ADD FOREIGN KEY ({', '.join(fk['constrained_columns'])}) "
+                f"REFERENCES {fk['referred_table']} ({', '.join(fk['referred_columns'])})"
+            ))
+        # Índices criados depois da cópia (mais rápido); no pai eles se propagam às partições
+        for ix in indexes:
+            unique = "UNIQUE " if ix['unique'] else ""
+            conn.execute(text(f"CREATE {unique}INDEX {ix['name']} ON {table} ({', '.join(ix['column_names'])})"))
+        conn.execute(text(f"ANALYZE {table}"))
+    return True
+
+def ensure_partitions(engine: Engine, months_ahead: int = MONTHS_AHEAD):
+    """
+    Cria as partições do mês atual e dos próximos meses nas tabelas particionadas (no-op fora do Postgres).
+    Linhas do mês que já estavam na partição DEFAULT são movidas para a nova partição.
+    """
+    if engine.dialect.name != 'postgresql':
+        return []
+    created = []
+    with engine.begin() as conn:
+        for table in TABLES:
+            if not is_partitioned(conn, table):
+                continue
+            existing = set(partitions(conn, table))
+            month = _month_start(date.today())
+            for _ in range(months_ahead + 1):
+                if month not in existing:
+                    if _default_has(conn, table, month):
+                        _split_default(conn, table, month)
+                    else:
+                        _create_partition(conn, table, month)
+                    created.append(_partition_name(table, month))
+                month = _add_months(month, 1)
+    return created
+
+# --- ARQUIVAMENTO ---
+def _pyarrow():
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise RuntimeError("O arquivamento em Parquet requer o pyarrow (pip install pyarrow).")
+    return pa, pq
+
+def _schema(pa, table):
+    # Tipos fixos a partir do modelo: um bloco só com nulos não muda o tipo da coluna
+    types = {Integer: pa.int64(), Float: pa.float64(), DateTime: pa.timestamp('us'), Date: pa.date32(), Boolean: pa.bool_()}
+    return pa.schema([(c.name, next((t for k, t in types.items() if isinstance(c.type, k)), pa.string()))
+                      for c in table.columns])
+
+def _archive_month(engine: Engine, table: str, month: date, archive_dir: str):
+    pa, pq = _pyarrow()
+    name = _partition_name(table, month)
+    path = os.path.join(archive_dir, table, f"{month:%Y-%m}.parquet")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    schema = _schema(pa, TABLES[table].__table__)
+    columns = ", ".join(schema.names)
+
+    # Ordenado por empresa e data: os row groups ficam estreitos e a leitura filtrada pula o resto
+    written = 0
+    with engine.connect() as conn, pq.ParquetWriter(path + ".tmp", schema, compression="zstd") as writer:
+        stream = conn.execution_options(stream_results=True, max_row_buffer=ARCHIVE_CHUNK)
+        expected = conn.execute(text(f"SELECT count(*) FROM {name}")).scalar()
+        for chunk in pd.read_sql_query(text(f"SELECT {columns} FROM {name} ORDER BY company_id, date, id"),
+                                       stream, chunksize=ARCHIVE_CHUNK):
+            if not chunk.empty:
+                writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+                written += len(chunk)
+    if written != expected or pq.ParquetFile(path + ".tmp").metadata.num_rows != expected:
+        os.remove(path + ".tmp")
+        raise RuntimeError(f"Arquivo de {name} incompleto ({written} de {expected} linhas); partição mantida.")
+    os.replace(path + ".tmp", path)
+
+    # Só depois do arquivo conferido a partição sai da tabela
+    with engine.begin() as conn:
+        conn.execute(text(f"ALTER TABLE {table} DETACH PARTITION {name}"))
+        conn.execute(ArchivedMonth.__table__.insert().values(
+            table_name=table, month=month, path=os.path.abspath(path), rows=written, archived_at=datetime.now()))
+        conn.execute(text(f"DROP TABLE {name}"))
+    return written
+
+def archive(engine: Engine, months: int = ARCHIVE_AFTER_MONTHS, archive_dir: str = ARCHIVE_DIR):
+    """Arquiva (Parquet) e remove as partições com mais de `months` meses. Retorna [(tabela, mês, linhas)]."""
+    cutoff = _add_months(_month_start(date.today()), -months)
+    done = []
+    for table in TABLES:
+        with engine.connect() as conn:
+            if not is_partitioned(conn, table):
+                continue
+            old_months = [m for m in partitions(conn, table) if m < cutoff]
+        for month in old_months:
+            done.append((table, month, _archive_month(engine, table, month, archive_dir)))
+    return done
+
+# --- LEITURA DOS MESES ARQUIVADOS ---
+def archive_frames(db: Session, table: str, company_id: int, start_date: datetime, end_date: datetime):
+    """
+    Linhas da empresa no período vindas dos meses arquivados, um DataFrame por mês, em ordem de (data, id).
+    Não gera nada quando nenhum mês do período foi arquivado (caso comum; só uma consulta à tabela de controle).
+    """
+    files = db.execute(select(ArchivedMonth.path).where(
+        ArchivedMonth.table_name == table,
+        ArchivedMonth.month >= _month_start(start_date.date()),
+        ArchivedMonth.month <= end_date.date()
+    ).order_by(ArchivedMonth.month)).scalars().all()
+    if not files:
+        return
+    _, pq = _pyarrow()
+    filters = [('company_id', '=', company_id),
+               ('date', '>=', pd.Timestamp(start_date)), ('date', '<=', pd.Timestamp(end_date))]
+    for path in files:
+        df = pq.read_table(path, filters=filters).to_pandas()
+        if not df.empty:
+            yield df.sort_values(['date', 'id'], ignore_index=True)
+
+def hot_start(db: Session, table: str):
+    """Primeiro dia ainda guardado no banco (após o último mês arquivado), ou None se nada foi arquivado."""
+    last = db.execute(select(ArchivedMonth.month).where(ArchivedMonth.table_name == table)
+                      .order_by(ArchivedMonth.month.desc()).limit(1)).scalar()
+    return _add_months(last, 1) if last else None
+
+if __name__ == "__main__":
+    from database import engine
+    import migrations
+
+    parser = argparse.ArgumentParser(description="Partições mensais de vendas/despesas e arquivamento dos meses antigos")
+    parser.add_argument("--convert", action="store_true", help="Converte sales e expenses em tabelas particionadas")
+    parser.add_argument("--ensure", action="store_true", help="Cria as partições dos próximos meses")
+    parser.add_argument("--archive", action="store_true", help="Arquiva os meses mais antigos que o horizonte")
+    parser.add_argument("--months", type=int, default=ARCHIVE_AFTER_MONTHS, help="Horizonte do arquivamento, em meses")
+    parser.add_argument("--dir", default=ARCHIVE_DIR, help="Pasta dos arquivos Parquet")
+    args = parser.parse_args()
+
+    migrations.upgrade(engine)
+    if args.convert:
+        for table in TABLES:
+            print(f"{table}: {'convertida' if convert(engine, table) else 'já particionada'}")
+    if args.ensure or args.convert:
+        print(f"Partições criadas: {', '.join(ensure_partitions(engine)) or 'nenhuma'}")
+    if args.archive:
+        for table, month, rows in archive(engine, args.months, args.dir):
+            print(f"{table} {month:%Y-%m}: {rows} linhas arquivadas")
@@ -0,0 +1,136 @@
+# query_plans.py
+# Verificação dos planos de execução (EXPLAIN) das consultas quentes.
+# Popula um banco de teste com volume grande, executa as funções reais de services.py,
+# captura o SQL que elas enviam ao banco e falha se alguma delas fizer leitura
+# sequencial (Seq Scan / SCAN) nas tabelas que deveriam ser lidas por índice.
+#
+# Uso: python query_plans.py [--url postgresql://...] [--companies 20] [--sales 200000]
+# Sem --url usa um arquivo SQLite temporário. NUNCA aponte para o banco de produção.
+import argparse
+import os
+import re
+import sys
+import tempfile
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from sqlalchemy import create_engine, event, func
+from sqlalchemy.orm import sessionmaker
+from models import Company, Product, Sale
+import datagen
+import migrations
+import rollup
+import services as api
+
+# --- POPULAÇÃO DO BANCO DE TESTE ---
+def seed(engine, companies: int, products: int, sales: int, days: int = 365):
+    with sessionmaker(bind=engine)() as db:
+        if db.query(func.count(Sale.id)).scalar():
+            return False
+    with engine.begin() as conn:
+        datagen.generate(conn, companies, products, days, sales / companies / days, name_prefix="Plan Check")
+    with sessionmaker(bind=engine)() as db:
+        rollup.rebuild(db)
+    with engine.begin() as conn:
+        conn.exec_driver_sql("ANALYZE")
+    return True
+
+# --- CAPTURA E EXPLAIN ---
+@contextmanager
+def capture(engine):
+    """Guarda (sql, parâmetros) de cada SELECT/UPDATE enviado ao banco enquanto o bloco roda."""
+    captured = []
+    def _listener(conn, cursor, statement, parameters, context, executemany):
+        if executemany or "pg_catalog" in statement or "sqlite_master" in statement:
+            return  # ignora inserts em lote e consultas ao catálogo (ex.: has_table do pandas)
+        if statement.lstrip().upper().startswith(("SELECT", "UPDATE", "WITH")):
+            captured.append((statement, parameters))
+    event.listen(engine, "before_cursor_execute", _listener)
+    try:
+        yield captured
+    finally:
+        event.remove(engine, "before_cursor_execute", _listener)
+
+def _pg_nodes(plan):
+    yield plan
+    for child in plan.get("Plans", []):
+        yield from _pg_nodes(child)
+
+def sequential_scans(engine, statement, parameters):
+    """Retorna (tabelas lidas sequencialmente, texto do plano)."""
+    raw = engine.raw_connection()
+    try:
+        cur = raw.cursor()
+        if engine.dialect.name == "postgresql":
+            cur.execute("EXPLAIN (FORMAT JSON) " + statement, parameters)
+            plan = cur.fetchone()[0][0]["Plan"]
+            nodes = list(_pg_nodes(plan))
+            scans = {n["Relation Name"] for n in nodes if n["Node Type"] == "Seq Scan"}
+            text_plan = " -> ".join(f"{n['Node Type']}({n.get('Relation Name', '')})" for n in nodes)
+        else:
+            cur.execute("EXPLAIN QUERY PLAN " + statement, parameters)
+            details = [row[3] for row in cur.fetchall()]
+            scans = {m.group(1) for d in details if (m := re.match(r"SCAN (\w+)", d))}
+            text_plan = " | ".join(details)
+        raw.rollback()
+        return scans, text_plan
+    finally:
+        raw.close()
+
+# --- CONSULTAS VERIFICADAS: (nome, chamada, tabelas que não podem ter leitura sequencial) ---
+def _checks(company_id, product_id):
+    now = datetime.now()
+    return [
+        ("Dashboard: KPIs do período", lambda db: api.get_period_kpis(db, company_id, 30), {"daily_sales", "daily_expenses"}),
+        ("Dashboard: evolução diária", lambda db: api.get_daily_summary(db, company_id, now.date() - timedelta(days=29), now.date()), {"daily_sales", "daily_expenses"}),
+        ("Dashboard: mapa de calor", lambda db: api.get_sales_heatmap(db, company_id, now - timedelta(days=30), now), {"sales"}),
+        ("Dashboard: top produtos", lambda db: api.get_top_products(db, company_id, now - timedelta(days=30), now), {"sales"}),
+        ("Fechamento de caixa: totais do mês", lambda db: api.get_closing_totals(db, company_id, now.replace(day=1, hour=0, minute=0), now), {"sales", "expenses"}),
+        ("Fechamento de caixa: página de vendas", lambda db: api.get_sales_page(db, company_id, now - timedelta(days=365), now, after=(now - timedelta(days=30), 0)), {"sales"}),
+        ("PDV: busca de produtos", lambda db: api.search_products(db, company_id, "modelo 00"), {"products"}),
+        ("Estoque: resumo", lambda db: api.get_inventory_summary(db, company_id), {"products"}),
+        ("Estoque: alertas de reposição", lambda db: api.get_inventory(db, company_id, low_only=True), {"products"}),
+        ("Estoque: movimentações do mês", lambda db: api.get_stock_report(db, company_id, now - timedelta(days=30), now), {"stock_movements", "stock_snapshots"}),
+        ("Estoque: baixa na venda", lambda db: api.process_sale(db, product_id, 1, "varejo", None, company_id), {"products"}),
+        ("Estoque: reposição", lambda db: api.restock_product(db, company_id, product_id, 1, 1.0), {"products"}),
+    ]
+
+def run(engine):
+    Session_ = sessionmaker(bind=engine, autoflush=False)
+    with Session_() as db:
+        company_id = db.query(Company.id).filter(Company.name.like("Plan Check %")).order_by(Company.id).limit(1).scalar()
+        product_id = db.query(Product.id).filter(Product.company_id == company_id).limit(1).scalar()
+
+    failures = 0
+    for name, call, guarded in _checks(company_id, product_id):
+        with Session_() as db, capture(engine) as captured:
+            call(db)
+        bad = []
+        for statement, parameters in captured:
+            scans, plan = sequential_scans(engine, statement, parameters)
+            if scans & guarded:
+                bad.append((sorted(scans & guarded), statement, plan))
+        status = "FALHA" if bad else "ok"
+        print(f"[{status:5}] {name} ({len(captured)} consultas)")
+        for tables, statement, plan in bad:
+            print(f"        leitura sequencial em {', '.join(tables)}")
+            print(f"        plano: {plan}")
+            print(f"        sql: {' '.join(statement.split())[:300]}")
+        failures += bool(bad)
+    return failures
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Verifica por EXPLAIN que as consultas quentes usam índices")
+    parser.add_argument("--url", default=None, help="Banco de TESTE (padrão: SQLite temporário)")
+    parser.add_argument("--companies", type=int, default=20)
+    parser.add_argument("--products", type=int, default=500)
+    parser.add_argument("--sales", type=int, default=200000)
+    args = parser.parse_args()
+
+    url = args.url or "sqlite:///" + os.path.join(tempfile.mkdtemp(), "query_plans.db")
+    engine = create_engine(url)
+    migrations.upgrade(engine)
+    if seed(engine, args.companies, args.products, args.sales):
+        print(f"Banco populado: {args.companies} empresas, {args.companies * args.products} produtos, {args.sales} vendas.")
+    failures = run(engine)
+    print("Todas as consultas usam índices." if not failures else f"{failures} consulta(s) com leitura sequencial.")
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,98 @@
+# rollup.py
+# Resumos diários por empresa (vendas e despesas por categoria).
+# São atualizados na mesma transação das vendas/despesas, então o Dashboard
+# lê poucos registros por dia em vez de todas as vendas do período.
+import argparse
+import os
+import random
+from datetime import datetime
+from sqlalchemy import case, func, insert, delete, select
+from sqlalchemy.orm import Session
+from models import Sale, Expense, DailySales, DailyExpense
+import partitioning
+
+# Linhas por (empresa, dia) no resumo de vendas: cada venda trava só uma delas até o commit,
+# então até SALES_SHARDS caixas da mesma loja gravam sem esperar um pelo outro
+SALES_SHARDS = int(os.environ.get("PEEGFLOW_ROLLUP_SHARDS", 8))
+
+def _upsert_add(db: Session, table, keys: dict, amounts: dict):
+    """INSERT ... ON CONFLICT DO UPDATE somando os valores (atômico no Postgres e no SQLite)."""
+    dialect = db.get_bind().dialect.name
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    elif dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    else:
+        updated = db.execute(table.update().where(*[table.c[k] == v for k, v in keys.items()]).values(
+            **{c: table.c[c] + v for c, v in amounts.items()})).rowcount
+        if not updated:
+            db.execute(insert(table).values(**keys, **amounts))
+        return
+    stmt = dialect_insert(table).values(**keys, **amounts)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=list(keys),
+        set_={c: table.c[c] + stmt.excluded[c] for c in amounts}
+    )
+    db.execute(stmt)
+
+def _as_day(value):
+    return value.date() if isinstance(value, datetime) else value
+
+# --- ATUALIZAÇÃO INCREMENTAL (não faz commit; quem chama controla a transação) ---
+def add_sales(db: Session, company_id: int, when, revenue: float, units: int, transactions: int = 1):
+    _upsert_add(db, DailySales.__table__,
+                {'company_id': company_id, 'day': _as_day(when), 'shard': random.randrange(SALES_SHARDS)},
+                {'revenue': revenue, 'units': units, 'transactions': transactions})
+
+def add_expense(db: Session, company_id: int, when, category: str, amount: float):
+    _upsert_add(db, DailyExpense.__table__,
+                {'company_id': company_id, 'day': _as_day(when), 'category': category or ""},
+                {'amount': amount})
+
+# --- RECONSTRUÇÃO / BACKFILL ---
+def rebuild(db: Session, company_id: int = None):
+    """
+    Recalcula os resumos a partir das tabelas de vendas e despesas (uma empresa ou todas).
+    Dias de meses já arquivados (partitioning.py) não estão mais nas tabelas: os resumos deles são mantidos.
+    """
+    sales_day = func.date(Sale.date)
+    # Pedidos distintos do dia; linhas sem pedido (históricos antigos) contam uma cada
+    tickets = func.count(func.distinct(Sale.order_id)) + func.sum(case((Sale.order_id.is_(None), 1), else_=0))
+    sales_q = select(
+        Sale.company_id, sales_day, func.sum(Sale.price * Sale.quantity), func.sum(Sale.quantity), tickets
+    ).group_by(Sale.company_id, sales_day)
+
+    exp_day = func.date(Expense.date)
+    exp_q = select(
+        Expense.company_id, exp_day, func.coalesce(Expense.category, ""), func.sum(Expense.amount)
+    ).group_by(Expense.company_id, exp_day, func.coalesce(Expense.category, ""))
+
+    del_sales, del_exp = delete(DailySales), delete(DailyExpense)
+    if company_id is not None:
+        sales_q = sales_q.where(Sale.company_id == company_id)
+        exp_q = exp_q.where(Expense.company_id == company_id)
+        del_sales = del_sales.where(DailySales.company_id == company_id)
+        del_exp = del_exp.where(DailyExpense.company_id == company_id)
+    sales_hot, exp_hot = partitioning.hot_start(db, 'sales'), partitioning.hot_start(db, 'expenses')
+    if sales_hot:
+        sales_q = sales_q.where(Sale.date >= sales_hot)
+        del_sales = del_sales.where(DailySales.day >= sales_hot)
+    if exp_hot:
+        exp_q = exp_q.where(Expense.date >= exp_hot)
+        del_exp = del_exp.where(DailyExpense.day >= exp_hot)
+
+    db.execute(del_sales)
+    db.execute(del_exp)
+    db.execute(insert(DailySales).from_select(['company_id', 'day', 'revenue', 'units', 'transactions'], sales_q))
+    db.execute(insert(DailyExpense).from_select(['company_id', 'day', 'category', 'amount'], exp_q))
+    db.commit()
+
+# Uso: python rollup.py [--company ID]
+if __name__ == "__main__":
+    from database import session_scope
+    parser = argparse.ArgumentParser(description="Reconstrói os resumos diários de vendas e despesas")
+    parser.add_argument("--company", type=int, default=None, help="ID da empresa (padrão: todas)")
+    args = parser.parse_args()
+    with session_scope() as db:
+        rebuild(db, args.company)
+    print("Resumos diários reconstruídos.")
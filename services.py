@@ -1,11 +1,28 @@
 import hashlib
-import random
+import io
+import logging
+import os
+import threading
+import time
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from fpdf import FPDF
 from sqlalchemy.orm import Session
-from sqlalchemy import func
-from datetime import datetime, timedelta
-from models import User, Product, Sale, Expense, Company
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy import func, insert, select, case, cast, literal, or_, text, tuple_, union_all, Float, Integer
+from datetime import datetime, timedelta, date
+from database import POOL_SIZE
+from models import User, Product, Sale, Order, Expense, Company, DailySales, DailyExpense, ExportWatermark, StockMovement
+import stock
+import ledger
+import partitioning
+import rollup
+import cart
+import cache
+import datagen
+
+log = logging.getLogger(__name__)
 
 # --- SEGURANÇA ---
 def hash_password(password: str):
@@ -40,47 +57,263 @@ def setup_demo_data(db: Session):
             Product(name="AirPods Max", price_retail=540.0, price_wholesale=380.0, stock=40, stock_min=5, sku="AIR-MAX", company_id=demo_id),
             Product(name="Apple Watch", price_retail=450.0, price_wholesale=310.0, stock=60, stock_min=10, sku="WATCH-S9", company_id=demo_id)
         ]
-        db.add_all(prods); db.commit()
+        db.add_all(prods); db.flush()
+        ledger.record(db, demo_id, [(p.id, p.stock, p.stock) for p in prods], ledger.OPENING)
+        db.commit()
 
-    # Limpa dados antigos para gerar novos
+    # Limpa dados antigos para gerar novos (o livro de estoque só perde o vínculo com o pedido)
+    db.query(StockMovement).filter(StockMovement.company_id == demo_id, StockMovement.order_id.isnot(None)) \
+        .update({StockMovement.order_id: None}, synchronize_session=False)
     db.query(Sale).filter(Sale.company_id == demo_id).delete()
+    db.query(Order).filter(Order.company_id == demo_id).delete()
     db.query(Expense).filter(Expense.company_id == demo_id).delete()
 
-    products = db.query(Product).filter(Product.company_id == demo_id).all()
+    products = db.query(Product.id, Product.price_retail, Product.price_wholesale).filter(Product.company_id == demo_id).all()
     
-    # Gerar 30 dias de histórico
-    for i in range(30, -1, -1):
-        data_ponto = datetime.now() - timedelta(days=i)
-        
-        # Vendas (mais volume em dias de semana)
-        num_vendas = random.randint(5, 12) if data_ponto.weekday() < 5 else random.randint(2, 5)
-        for _ in range(num_vendas):
-            p = random.choice(products)
-            db.add(Sale(product_id=p.id, quantity=random.randint(1,2), price=p.price_retail, 
-                        kind="varejo", user_id=1, company_id=demo_id, date=data_ponto))
-
-        # Despesas Fixas e Variáveis
-        if data_ponto.day == 5:
-            db.add(Expense(description="Aluguel Mensal", amount=2800.0, category="Aluguel", company_id=demo_id, date=data_ponto))
-        if random.random() < 0.2:
-            db.add(Expense(description="Marketing/Ads", amount=random.uniform(100, 400), category="Marketing", company_id=demo_id, date=data_ponto))
+    # Gerar 31 dias de histórico (gravação em lote, na mesma transação)
+    datagen.generate_history(db.connection(), demo_id, products, days=31, sales_per_day=9, user_id=1)
 
     db.commit()
+    rollup.rebuild(db, demo_id)
+    cache.invalidate(demo_id)
+    forget_skus(demo_id)
 
 # --- DEMAIS FUNÇÕES ---
+@cache.cached(tags=('products',))
 def get_products(db: Session, company_id: int):
-    return db.query(Product).filter(Product.company_id == company_id).all()
+    """Produtos da empresa como linhas (somente leitura; o cache as compartilha entre sessões)."""
+    return db.execute(select(
+        Product.id, Product.sku, Product.name, Product.category, Product.price_retail,
+        Product.price_wholesale, Product.stock, Product.stock_min
+    ).where(Product.company_id == company_id)).all()
+
+# --- ESTOQUE (projeções e agregados no banco) ---
+@dataclass(frozen=True)
+class InventorySummary:
+    products: int = 0
+    stock_value: float = 0.0   # estoque x preço de atacado
+    low_stock: int = 0         # produtos com estoque <= mínimo
+
+@cache.cached(tags=('products',))
+def get_inventory_summary(db: Session, company_id: int) -> InventorySummary:
+    """Total de produtos, valor em estoque e alertas de reposição numa única consulta."""
+    row = db.execute(select(
+        func.count(Product.id),
+        func.coalesce(func.sum(Product.stock * Product.price_wholesale), 0),
+        func.coalesce(func.sum(case((Product.stock <= Product.stock_min, 1), else_=0)), 0)
+    ).where(Product.company_id == company_id)).one()
+    return InventorySummary(int(row[0]), float(row[1]), int(row[2]))
+
+@cache.cached(tags=('products',))
+def get_inventory(db: Session, company_id: int, low_only: bool = False):
+    """
+    Colunas do inventário direto num DataFrame (sem objetos ORM): id, sku, name, price_retail, stock, stock_min.
+    low_only=True lista só os produtos abaixo do mínimo (índice parcial ix_products_low_stock).
+    """
+    q = select(Product.id, Product.sku, Product.name, Product.price_retail, Product.stock, Product.stock_min) \
+        .where(Product.company_id == company_id)
+    if low_only:
+        q = q.where(Product.stock <= Product.stock_min)
+    return pd.read_sql_query(q.order_by(Product.name, Product.id), db.connection())
+
+# --- BUSCA DE PRODUTOS (PDV) ---
+SEARCH_PAGE = 12  # cartões por página na grade do PDV
+_trigram_support = {}
+
+def _has_trigram(db: Session):
+    # O pg_trgm pode não estar instalado no servidor; verificado uma vez por banco
+    bind = db.get_bind()
+    if bind.dialect.name != 'postgresql':
+        return False
+    key = str(bind.url)
+    if key not in _trigram_support:
+        _trigram_support[key] = db.execute(text("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")).first() is not None
+    return _trigram_support[key]
+
+def _like_escape(value: str):
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+@cache.cached(tags=('products',))
+def search_products(db: Session, company_id: int, query: str = "", page: int = 0, per_page: int = SEARCH_PAGE):
+    """
+    Busca por nome ou SKU, ordenada por relevância: SKU exato, prefixo do SKU, prefixo do nome, nome contém
+    (e similaridade por trigramas no Postgres com pg_trgm). Retorna (linhas da página, há mais páginas).
+    """
+    q = (query or "").strip().lower()
+    cols = select(Product.id, Product.sku, Product.name, Product.price_retail, Product.price_wholesale, Product.stock) \
+        .where(Product.company_id == company_id)
+    if not q:
+        stmt = cols.order_by(Product.name, Product.id)
+    else:
+        prefix, contains = _like_escape(q) + "%", "%" + _like_escape(q) + "%"
+        if db.get_bind().dialect.name == 'postgresql':
+            name, sku = func.lower(Product.name), func.lower(Product.sku)
+        else:
+            name, sku = Product.name, Product.sku  # LIKE do SQLite já ignora maiúsculas (e usa o índice NOCASE)
+        match = or_(name.like(contains, escape="\\"), sku.like(prefix, escape="\\"))
+        order = [case(
+            (func.lower(Product.sku) == q, 0),
+            (sku.like(prefix, escape="\\"), 1),
+            (name.like(prefix, escape="\\"), 2),
+            else_=3
+        )]
+        if _has_trigram(db) and len(q) >= 3:
+            match = or_(match, name.op("%")(q))  # tolera erros de digitação
+            order.append(func.similarity(name, q).desc())
+        stmt = cols.where(match).order_by(*order, Product.name, Product.id)
+    rows = db.execute(stmt.offset(page * per_page).limit(per_page + 1)).all()
+    return rows[:per_page], len(rows) > per_page
+
+# --- LEITOR DE CÓDIGO DE BARRAS (SKU -> produto, em memória) ---
+@dataclass(frozen=True)
+class SkuEntry:
+    id: int
+    name: str
+    price_retail: float
+    price_wholesale: float
+
+_sku_tables = {}  # company_id -> {sku: SkuEntry}
+_sku_lock = threading.Lock()
+
+def _sku_entry(p):
+    return SkuEntry(p.id, p.name, p.price_retail, p.price_wholesale)
+
+def _sku_table(db: Session, company_id: int):
+    table = _sku_tables.get(company_id)
+    if table is None:
+        # Carregada uma vez por empresa e processo; depois só é atualizada pelos cadastros
+        rows = db.query(Product.id, Product.sku, Product.name, Product.price_retail, Product.price_wholesale) \
+            .filter(Product.company_id == company_id, Product.sku.isnot(None)).all()
+        table = {r.sku: _sku_entry(r) for r in rows}
+        with _sku_lock:
+            table = _sku_tables.setdefault(company_id, table)
+    return table
+
+def lookup_sku(db: Session, company_id: int, code: str):
+    """Produto com o SKU/código de barras exato, ou None. Leitura de um dict em memória após o aquecimento."""
+    code = (code or "").strip()
+    if not code:
+        return None
+    table = _sku_table(db, company_id)
+    entry = table.get(code)
+    if entry is None:
+        # Pode ter sido cadastrado por outro processo: confirma no banco (índice único empresa + SKU)
+        p = db.query(Product.id, Product.name, Product.price_retail, Product.price_wholesale) \
+            .filter(Product.company_id == company_id, Product.sku == code).first()
+        if p:
+            entry = table[code] = _sku_entry(p)
+    return entry
+
+def _remember_sku(company_id: int, product: Product):
+    table = _sku_tables.get(company_id)
+    if table is not None and product.sku:
+        table[product.sku] = _sku_entry(product)
+
+def forget_skus(company_id: int):
+    """Descarta a tabela de SKUs da empresa (recarregada na próxima leitura)."""
+    with _sku_lock:
+        _sku_tables.pop(company_id, None)
 
 def create_product(db: Session, data: dict, company_id: int):
     new_prod = Product(**data, company_id=company_id)
-    db.add(new_prod); db.commit()
+    db.add(new_prod); db.flush()
+    if new_prod.stock:
+        ledger.record(db, company_id, [(new_prod.id, new_prod.stock, new_prod.stock)], ledger.OPENING)
+    db.commit()
+    cache.invalidate(company_id, 'products')
+    _remember_sku(company_id, new_prod)
 
 def process_sale(db: Session, product_id: int, qty: int, kind: str, user_id: int, company_id: int):
-    product = db.query(Product).filter(Product.id == product_id).first()
-    if not product or product.stock < qty: return False, "Sem estoque"
-    product.stock -= qty
-    db.add(Sale(product_id=product.id, quantity=qty, price=product.price_retail, kind=kind, user_id=user_id, company_id=company_id))
-    db.commit(); return True, "Venda OK"
+    def _sell():
+        # Baixa atômica: só decrementa se ainda houver estoque (seguro com vários PDVs)
+        product = stock.decrement(db, company_id, product_id, qty)
+        if not product:
+            db.rollback(); return False, "Sem estoque"
+        now = datetime.now()
+        price = cart.unit_price(product.price_retail, product.price_wholesale, kind)
+        order = Order(total=price * qty, items=qty, user_id=user_id, company_id=company_id, date=now)
+        db.add(order)
+        db.add(Sale(product_id=product.id, quantity=qty, price=price, kind=kind, user_id=user_id, company_id=company_id, date=now, order=order))
+        db.flush()
+        ledger.record(db, company_id, [(product.id, -qty, product.stock)], ledger.SALE, now, order.id, user_id)
+        rollup.add_sales(db, company_id, now, price * qty, qty)
+        db.commit()
+        cache.invalidate(company_id, 'sales', 'products')
+        return True, "Venda OK"
+    return stock.with_retry(db, _sell)
+
+def apply_cart(db: Session, items: list, user_id: int, company_id: int, when: datetime = None, client_ref: str = None):
+    """
+    Grava o carrinho como um pedido (Order) com uma venda por linha, na transação corrente e sem commit.
+    Retorna (ok, resultados) com um resultado por linha; com ok False quem chama deve desfazer a transação.
+    """
+    # Quantidade total pedida por produto (o mesmo produto pode aparecer várias vezes)
+    wanted = {}
+    for item in items:
+        wanted[item['id']] = wanted.get(item['id'], 0) + item.get('qty', 1)
+
+    # Um único UPDATE condicional baixa todos os produtos que têm estoque suficiente
+    products = stock.decrement_many(db, company_id, wanted)
+
+    if len(products) < len(wanted):
+        missing = set(wanted) - set(products)
+        existing = {pid for (pid,) in db.query(Product.id).filter(
+            Product.company_id == company_id, Product.id.in_(missing))}
+        results = []
+        for item in items:
+            if item['id'] not in missing:
+                # Nada do carrinho é gravado: as linhas com estoque também ficam de fora
+                results.append({'id': item['id'], 'ok': False, 'msg': "Cancelada: outro item sem estoque"})
+            elif item['id'] in existing:
+                results.append({'id': item['id'], 'ok': False, 'msg': "Sem estoque"})
+            else:
+                results.append({'id': item['id'], 'ok': False, 'msg': "Produto não encontrado"})
+        return False, results
+
+    now = when or datetime.now()
+    rows = []
+    for item in items:
+        product, kind = products[item['id']], item.get('kind', cart.RETAIL)
+        rows.append(dict(product_id=item['id'], quantity=item.get('qty', 1),
+                         price=cart.unit_price(product.price_retail, product.price_wholesale, kind),
+                         kind=kind, user_id=user_id, company_id=company_id, date=now))
+    total, units = sum(r['price'] * r['quantity'] for r in rows), sum(r['quantity'] for r in rows)
+    # Cabeçalho do pedido na mesma transação: o cupom é a unidade de ticket médio e contagem de vendas
+    order_id = db.execute(insert(Order).values(
+        total=total, items=units, user_id=user_id, company_id=company_id, date=now, client_ref=client_ref
+    ).returning(Order.id)).scalar()
+    for r in rows:
+        r['order_id'] = order_id
+    db.execute(insert(Sale), rows)
+    ledger.record(db, company_id, [(pid, -qty, products[pid].stock) for pid, qty in wanted.items()],
+                  ledger.SALE, now, order_id, user_id)
+    rollup.add_sales(db, company_id, now, total, units)
+    return True, [{'id': item['id'], 'ok': True, 'msg': "Venda OK"} for item in items]
+
+def process_cart(db: Session, items: list, user_id: int, company_id: int):
+    """
+    Finaliza o carrinho inteiro numa única transação, como um pedido (Order) com uma venda por linha.
+    Cada item é um dict com 'id' e opcionalmente 'qty' (padrão 1) e 'kind' (padrão 'varejo'; 'atacado' usa price_wholesale).
+    Retorna (ok, resultados) com um resultado por linha; se alguma linha falhar nada é gravado.
+    """
+    if not items:
+        return False, []
+
+    def _checkout():
+        ok, results = apply_cart(db, items, user_id, company_id)
+        if not ok:
+            db.rollback()
+            return False, results
+        db.commit()
+        cache.invalidate(company_id, 'sales', 'products')
+        return True, results
+
+    try:
+        return stock.with_retry(db, _checkout)
+    except Exception:
+        log.exception("Falha ao gravar o carrinho da empresa %s", company_id)
+        db.rollback()
+        return False, [{'id': item['id'], 'ok': False, 'msg': "Erro ao gravar venda"} for item in items]
 
 def get_financial_data(db: Session, company_id: int, days=30):
     start = datetime.now() - timedelta(days=days)
@@ -88,11 +321,155 @@ def get_financial_data(db: Session, company_id: int, days=30):
     e_q = db.query(Expense).filter(Expense.company_id == company_id, Expense.date >= start).statement
     return pd.read_sql(s_q, db.bind), pd.read_sql(e_q, db.bind)
 
+@cache.cached(tags=('sales',))
 def get_daily_sales_data(db: Session, company_id: int, days=30):
-    start_date = datetime.now() - timedelta(days=days)
-    daily = db.query(func.date(Sale.date).label('date'), func.sum(Sale.price).label('total')).filter(Sale.company_id == company_id, Sale.date >= start_date).group_by(func.date(Sale.date)).all()
+    start_date = (datetime.now() - timedelta(days=days)).date()
+    daily = db.query(DailySales.day, func.sum(DailySales.revenue)).filter(DailySales.company_id == company_id, DailySales.day >= start_date) \
+        .group_by(DailySales.day).order_by(DailySales.day).all()
     return pd.DataFrame(daily, columns=['date', 'total'])
 
+@cache.cached(tags=('sales', 'expenses'))
+def get_daily_summary(db: Session, company_id: int, start_day: date, end_day: date):
+    """Resumo diário (receita, unidades, vendas, despesas) lido das tabelas de resumo: uma linha por dia."""
+    sales = db.query(DailySales.day, func.sum(DailySales.revenue), func.sum(DailySales.units), func.sum(DailySales.transactions)).filter(
+        DailySales.company_id == company_id, DailySales.day >= start_day, DailySales.day <= end_day
+    ).group_by(DailySales.day).all()
+    expenses = db.query(DailyExpense.day, func.sum(DailyExpense.amount)).filter(
+        DailyExpense.company_id == company_id, DailyExpense.day >= start_day, DailyExpense.day <= end_day
+    ).group_by(DailyExpense.day).all()
+
+    df_sales = pd.DataFrame(sales, columns=['date', 'revenue', 'units', 'transactions']).set_index('date')
+    df_exp = pd.DataFrame(expenses, columns=['date', 'expenses']).set_index('date')
+    df = df_sales.join(df_exp, how='outer').fillna(0).reset_index()
+    return df.sort_values('date')
+
+# --- GRÁFICOS DO DASHBOARD (agregados no banco) ---
+WEEKDAYS = ['Sunday', 'Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday']  # ordem do %w / dow
+
+@cache.cached(tags=('sales',))
+def get_sales_heatmap(db: Session, company_id: int, start_date: datetime, end_date: datetime):
+    """Receita por dia da semana x hora (no máximo 7 x 24 linhas), agregada no banco."""
+    if db.get_bind().dialect.name == 'sqlite':
+        weekday = cast(func.strftime('%w', Sale.date), Integer)
+        hour = cast(func.strftime('%H', Sale.date), Integer)
+    else:
+        weekday = cast(func.extract('dow', Sale.date), Integer)
+        hour = cast(func.extract('hour', Sale.date), Integer)
+    rows = db.query(weekday, hour, func.sum(Sale.price * Sale.quantity)).filter(
+        Sale.company_id == company_id, Sale.date >= start_date, Sale.date <= end_date
+    ).group_by(weekday, hour).all()
+    df = pd.DataFrame(rows, columns=['weekday', 'hour', 'price'])
+    df['weekday'] = df['weekday'].map(lambda d: WEEKDAYS[int(d)])
+    return df
+
+@cache.cached(tags=('sales', 'products'))
+def get_top_products(db: Session, company_id: int, start_date: datetime, end_date: datetime, limit: int = 5):
+    """Produtos com maior receita no período (ordem decrescente)."""
+    revenue = func.sum(Sale.price * Sale.quantity)
+    rows = db.query(Product.name, revenue).join(Product, Product.id == Sale.product_id).filter(
+        Sale.company_id == company_id, Sale.date >= start_date, Sale.date <= end_date
+    ).group_by(Product.id, Product.name).order_by(revenue.desc()).limit(limit).all()
+    return pd.DataFrame(rows, columns=['product_name', 'price'])
+
+# --- KPIs DO DASHBOARD (agregados no banco) ---
+@dataclass(frozen=True)
+class PeriodKpis:
+    revenue: float = 0.0
+    expenses: float = 0.0
+    units: int = 0
+    transactions: int = 0
+
+    @property
+    def profit(self):
+        return self.revenue - self.expenses
+
+    @property
+    def avg_ticket(self):
+        return self.revenue / self.transactions if self.transactions else 0.0
+
+    @property
+    def margin(self):
+        return self.profit / self.revenue if self.revenue > 0 else 0.0
+
+@dataclass(frozen=True)
+class KpiComparison:
+    days: int
+    current: PeriodKpis
+    previous: PeriodKpis
+
+    @property
+    def revenue_delta(self):
+        return self.current.revenue - self.previous.revenue
+
+    @property
+    def transactions_delta(self):
+        return self.current.transactions - self.previous.transactions
+
+@cache.cached(tags=('sales', 'expenses'))
+def get_period_kpis(db: Session, company_id: int, days: int = 30, end_day: date = None) -> KpiComparison:
+    """
+    KPIs do período atual (últimos `days` dias até end_day) e do período anterior de mesmo tamanho,
+    calculados numa única consulta com agregação condicional sobre os resumos diários.
+    """
+    end_day = end_day or date.today()
+    cur_start = end_day - timedelta(days=days - 1)
+    prev_start = cur_start - timedelta(days=days)
+
+    sales = select(
+        DailySales.day.label('day'),
+        DailySales.revenue.label('revenue'),
+        DailySales.units.label('units'),
+        DailySales.transactions.label('transactions'),
+        literal(0.0, Float).label('expenses')
+    ).where(DailySales.company_id == company_id, DailySales.day >= prev_start, DailySales.day <= end_day)
+    expenses = select(
+        DailyExpense.day, literal(0.0, Float), literal(0, Integer), literal(0, Integer), DailyExpense.amount
+    ).where(DailyExpense.company_id == company_id, DailyExpense.day >= prev_start, DailyExpense.day <= end_day)
+    u = union_all(sales, expenses).subquery()
+
+    is_cur = u.c.day >= cur_start
+    def _sum(col, current):
+        return func.coalesce(func.sum(case((is_cur if current else ~is_cur, col), else_=0)), 0)
+
+    row = db.execute(select(
+        _sum(u.c.revenue, True), _sum(u.c.expenses, True), _sum(u.c.units, True), _sum(u.c.transactions, True),
+        _sum(u.c.revenue, False), _sum(u.c.expenses, False), _sum(u.c.units, False), _sum(u.c.transactions, False)
+    )).one()
+    return KpiComparison(
+        days=days,
+        current=PeriodKpis(float(row[0]), float(row[1]), int(row[2]), int(row[3])),
+        previous=PeriodKpis(float(row[4]), float(row[5]), int(row[6]), int(row[7]))
+    )
+
+# --- CARGA DO DASHBOARD (consultas independentes em paralelo) ---
+# Cada consulta roda numa thread com a sua própria sessão (e conexão do pool): a página
+# espera a consulta mais lenta, não a soma das idas e voltas até o banco.
+# As threads são de todo o processo (todos os usuários): o padrão acompanha as conexões fixas
+# do pool, para que o Dashboard use todas elas sem tomar as extras de que as vendas precisam.
+DASHBOARD_WORKERS = int(os.environ.get("PEEGFLOW_DASHBOARD_WORKERS", POOL_SIZE))
+_dashboard_pool = ThreadPoolExecutor(max_workers=DASHBOARD_WORKERS, thread_name_prefix="peegflow-dashboard")
+
+@dataclass(frozen=True)
+class DashboardData:
+    kpis: KpiComparison
+    daily: pd.DataFrame         # date, revenue, expenses
+    heatmap: pd.DataFrame       # weekday, hour, price
+    top_products: pd.DataFrame  # product_name, price
+
+def load_dashboard(session_factory, company_id: int, days: int, start_date: datetime, end_date: datetime) -> DashboardData:
+    """Dispara as consultas do Dashboard ao mesmo tempo e junta os resultados."""
+    def _run(fn, *args):
+        with session_factory() as db:
+            return fn(db, company_id, *args)
+
+    futures = dict(
+        kpis=_dashboard_pool.submit(_run, get_period_kpis, days, end_date.date()),
+        daily=_dashboard_pool.submit(_run, get_daily_summary, start_date.date(), end_date.date()),
+        heatmap=_dashboard_pool.submit(_run, get_sales_heatmap, start_date, end_date),
+        top_products=_dashboard_pool.submit(_run, get_top_products, start_date, end_date),
+    )
+    return DashboardData(**{name: f.result() for name, f in futures.items()})
+
 def generate_financial_pdf(df_v, df_e, period, company):
     pdf = FPDF()
     pdf.add_page()
@@ -101,13 +478,16 @@ def generate_financial_pdf(df_v, df_e, period, company):
     pdf.ln(10)
     pdf.set_font("helvetica", "", 12)
     pdf.cell(0, 10, f"Período: {period}", ln=True)
-    pdf.cell(0, 10, f"Receitas: € {df_v['price'].sum():,.2f}", ln=True)
-    pdf.cell(0, 10, f"Despesas: € {df_e['amount'].sum():,.2f}", ln=True)
+    receitas = (df_v['price'] * df_v['quantity']).sum()
+    # As fontes padrão do PDF são latin-1 e não têm o símbolo do euro
+    pdf.cell(0, 10, f"Receitas: EUR {receitas:,.2f}", ln=True)
+    pdf.cell(0, 10, f"Despesas: EUR {df_e['amount'].sum():,.2f}", ln=True)
     pdf.set_font("helvetica", "B", 12)
-    pdf.cell(0, 10, f"Lucro: € {df_v['price'].sum() - df_e['amount'].sum():,.2f}", ln=True)
+    pdf.cell(0, 10, f"Lucro: EUR {receitas - df_e['amount'].sum():,.2f}", ln=True)
     return bytes(pdf.output(dest='S'))
 
 # Adicione isso no services.py
+@cache.cached(tags=('sales', 'expenses', 'products'))
 def get_financial_by_range(db: Session, company_id: int, start_date: datetime, end_date: datetime):
     # Garante que pegamos até o ultimo segundo do dia final
     if end_date.hour == 0 and end_date.minute == 0:
@@ -144,6 +524,403 @@ def get_financial_by_range(db: Session, company_id: int, start_date: datetime, e
     
     return df_sales, df_expenses
 
+# --- FECHAMENTO DE CAIXA (streaming e paginação por chave) ---
+STREAM_CHUNK = 5000   # linhas por bloco lido do cursor no servidor
+PAGE_SIZE = 50        # linhas por página das tabelas de detalhe
+
+def _closing_end(end_date: datetime):
+    # Mesmo critério do get_financial_by_range: fim "meia-noite" vale o dia inteiro
+    if end_date.hour == 0 and end_date.minute == 0:
+        return end_date.replace(hour=23, minute=59, second=59)
+    return end_date
+
+def _sales_ledger(company_id: int, start_date: datetime, end_date: datetime):
+    return select(
+        Sale.id, Sale.date, Product.name.label('product_name'), Product.category, Sale.quantity, Sale.price
+    ).join(Product, Product.id == Sale.product_id).where(
+        Sale.company_id == company_id, Sale.date >= start_date, Sale.date <= _closing_end(end_date)
+    ).order_by(Sale.date, Sale.id)
+
+def _expenses_ledger(company_id: int, start_date: datetime, end_date: datetime):
+    return select(
+        Expense.id, Expense.date, Expense.category, Expense.description, Expense.amount
+    ).where(
+        Expense.company_id == company_id, Expense.date >= start_date, Expense.date <= _closing_end(end_date)
+    ).order_by(Expense.date, Expense.id)
+
+# Meses arquivados em Parquet (partitioning.py) entram no fechamento no mesmo formato das consultas acima
+def _archived_sales(db: Session, company_id: int, start_date: datetime, end_date: datetime):
+    names = None
+    for df in partitioning.archive_frames(db, 'sales', company_id, start_date, _closing_end(end_date)):
+        if names is None:
+            names = pd.read_sql_query(select(
+                Product.id.label('product_id'), Product.name.label('product_name'), Product.category
+            ).where(Product.company_id == company_id), db.connection())
+        yield df.merge(names, on='product_id')[['id', 'date', 'product_name', 'category', 'quantity', 'price']]
+
+def _archived_expenses(db: Session, company_id: int, start_date: datetime, end_date: datetime):
+    for df in partitioning.archive_frames(db, 'expenses', company_id, start_date, _closing_end(end_date)):
+        yield df[['id', 'date', 'category', 'description', 'amount']]
+
+def _stream(db: Session, stmt, chunk_size: int, archived=()):
+    # Meses arquivados primeiro: são sempre mais antigos que tudo o que ficou no banco
+    for df in archived:
+        for i in range(0, len(df), chunk_size):
+            yield df.iloc[i:i + chunk_size]
+    # stream_results: cursor no servidor (Postgres), as linhas chegam em blocos em vez de todas de uma vez
+    stmt = stmt.execution_options(stream_results=True, max_row_buffer=chunk_size)
+    yield from pd.read_sql_query(stmt, db.connection(), chunksize=chunk_size)
+
+def stream_sales(db: Session, company_id: int, start_date: datetime, end_date: datetime, chunk_size: int = STREAM_CHUNK):
+    """Vendas do período (inclusive de meses arquivados) em DataFrames de até `chunk_size` linhas, ordenadas por (data, id)."""
+    return _stream(db, _sales_ledger(company_id, start_date, end_date), chunk_size,
+                   _archived_sales(db, company_id, start_date, end_date))
+
+def stream_expenses(db: Session, company_id: int, start_date: datetime, end_date: datetime, chunk_size: int = STREAM_CHUNK):
+    """Despesas do período (inclusive de meses arquivados) em DataFrames de até `chunk_size` linhas, ordenadas por (data, id)."""
+    return _stream(db, _expenses_ledger(company_id, start_date, end_date), chunk_size,
+                   _archived_expenses(db, company_id, start_date, end_date))
+
+@dataclass(frozen=True)
+class ClosingTotals:
+    revenue: float = 0.0
+    expenses: float = 0.0
+    sales_count: int = 0
+    expense_count: int = 0
+
+    @property
+    def balance(self):
+        return self.revenue - self.expenses
+
+@cache.cached(tags=('sales', 'expenses'))
+def get_closing_totals(db: Session, company_id: int, start_date: datetime, end_date: datetime,
+                       chunk_size: int = STREAM_CHUNK) -> ClosingTotals:
+    """Totais do fechamento somados bloco a bloco: a memória fica limitada a um bloco, qualquer que seja o período."""
+    revenue, sales_count = 0.0, 0
+    for chunk in stream_sales(db, company_id, start_date, end_date, chunk_size):
+        revenue += float((chunk['price'] * chunk['quantity']).sum())
+        sales_count += len(chunk)
+    expenses, expense_count = 0.0, 0
+    for chunk in stream_expenses(db, company_id, start_date, end_date, chunk_size):
+        expenses += float(chunk['amount'].sum())
+        expense_count += len(chunk)
+    return ClosingTotals(revenue, expenses, sales_count, expense_count)
+
+def _page_start(start_date: datetime, after):
+    # Meses arquivados anteriores à chave não entram mais na página: nem o arquivo é lido.
+    # Com a chave já além do último mês arquivado, archive_frames não encontra nenhum.
+    return start_date if after is None else max(start_date, after[0])
+
+def _page(db: Session, stmt, id_col, date_col, after, limit: int, archived=()):
+    # Paginação por chave (data, id): cada página parte da última linha da anterior, sem OFFSET
+    parts, missing = [], limit
+    for frame in archived:
+        if after is not None:
+            frame = frame[(frame['date'] > after[0]) | ((frame['date'] == after[0]) & (frame['id'] > after[1]))]
+        parts.append(frame.iloc[:missing])
+        missing -= len(parts[-1])
+        if not missing:
+            break
+    if missing:
+        if after is not None:
+            stmt = stmt.where(tuple_(date_col, id_col) > tuple_(*after))
+        parts.append(pd.read_sql_query(stmt.limit(missing), db.connection()))
+    df = pd.concat(parts, ignore_index=True) if len(parts) > 1 else parts[0]
+    next_after = None
+    if len(df) == limit:
+        next_after = (df['date'].iloc[-1].to_pydatetime(), int(df['id'].iloc[-1]))
+    return df, next_after
+
+@cache.cached(tags=('sales', 'products'))
+def get_sales_page(db: Session, company_id: int, start_date: datetime, end_date: datetime,
+                   after: tuple = None, limit: int = PAGE_SIZE):
+    """
+    Uma página de vendas do período. `after` é a chave (data, id) devolvida pela página anterior.
+    Retorna (DataFrame, chave da próxima página ou None se esta for a última).
+    """
+    return _page(db, _sales_ledger(company_id, start_date, end_date), Sale.id, Sale.date, after, limit,
+                 _archived_sales(db, company_id, _page_start(start_date, after), end_date))
+
+@cache.cached(tags=('expenses',))
+def get_expenses_page(db: Session, company_id: int, start_date: datetime, end_date: datetime,
+                      after: tuple = None, limit: int = PAGE_SIZE):
+    """Uma página de despesas do período; mesma convenção de get_sales_page."""
+    return _page(db, _expenses_ledger(company_id, start_date, end_date), Expense.id, Expense.date, after, limit,
+                 _archived_expenses(db, company_id, _page_start(start_date, after), end_date))
+
+# --- RELATÓRIO DETALHADO (PDF) ---
+NO_CATEGORY = "Sem categoria"
+
+def _pdf_text(value):
+    # As fontes padrão do PDF são latin-1: o que estiver fora dela vira "?"
+    return str(value).encode('latin-1', 'replace').decode('latin-1')
+
+def _category_subtotals(db: Session, company_id: int, start_date: datetime, end_date: datetime):
+    """[(categoria, lançamentos, total)] de vendas e de despesas, agregados no banco."""
+    s_cat = func.coalesce(Product.category, NO_CATEGORY)
+    sales = db.execute(
+        select(s_cat, func.count(Sale.id), func.sum(Sale.price * Sale.quantity))
+        .join(Product, Product.id == Sale.product_id)
+        .where(Sale.company_id == company_id, Sale.date >= start_date, Sale.date <= end_date)
+        .group_by(s_cat).order_by(s_cat)
+    ).all()
+    e_cat = func.coalesce(Expense.category, NO_CATEGORY)
+    expenses = db.execute(
+        select(e_cat, func.count(Expense.id), func.sum(Expense.amount))
+        .where(Expense.company_id == company_id, Expense.date >= start_date, Expense.date <= end_date)
+        .group_by(e_cat).order_by(e_cat)
+    ).all()
+    return (_with_archived(sales, _archived_sales(db, company_id, start_date, end_date), lambda df: df['price'] * df['quantity']),
+            _with_archived(expenses, _archived_expenses(db, company_id, start_date, end_date), lambda df: df['amount']))
+
+def _with_archived(rows, frames, value):
+    # Soma os subtotais dos meses arquivados aos que vieram do banco
+    totals = {category: [count, float(total or 0)] for category, count, total in rows}
+    for df in frames:
+        grouped = df.assign(value=value(df)).groupby(df['category'].fillna(NO_CATEGORY))['value'].agg(['count', 'sum'])
+        for category, (count, total) in grouped.iterrows():
+            entry = totals.setdefault(category, [0, 0.0])
+            entry[0] += int(count)
+            entry[1] += float(total)
+    return [(category, count, total) for category, (count, total) in sorted(totals.items())]
+
+def _pdf_row(pdf, widths, values, aligns, bold=False):
+    # pdf.text em vez de pdf.cell: sem o motor de quebra de linha, é ~10x mais rápido em dezenas de milhares de linhas
+    if pdf.will_page_break(6):
+        pdf.add_page()
+    pdf.set_font("helvetica", "B" if bold else "", 8)
+    x, y = pdf.l_margin, pdf.get_y()
+    for w, v, a in zip(widths, values, aligns):
+        text = _pdf_text(v)
+        pdf.text(x + (w - pdf.get_string_width(text) - 1 if a == "R" else 1), y + 4, text)
+        x += w
+    if bold:
+        pdf.line(pdf.l_margin, y + 6, x, y + 6)
+    pdf.set_y(y + 6)
+
+def _pdf_ledger(pdf, title, header, widths, aligns, chunks, to_values):
+    # Escreve as linhas bloco a bloco; o cabeçalho da tabela se repete a cada página nova
+    pdf.set_font("helvetica", "B", 12)
+    pdf.cell(0, 10, title, ln=True)
+    _pdf_row(pdf, widths, header, aligns, bold=True)
+    for chunk in chunks:
+        for row in chunk.itertuples(index=False):
+            if pdf.will_page_break(6):
+                pdf.add_page()
+                _pdf_row(pdf, widths, header, aligns, bold=True)
+            _pdf_row(pdf, widths, to_values(row), aligns)
+    pdf.ln(4)
+
+def ledger_fingerprint(db: Session, company_id: int, start_day: date, end_day: date) -> str:
+    """
+    Impressão digital dos dados do período: contagem, maior id e somas das vendas e das despesas do
+    intervalo, mais o limite dos meses arquivados. Só muda se algo do próprio período mudar (lançamento
+    retroativo, exclusão, arquivamento); vendas de hoje não a alteram. Serve de chave do PDF já gerado.
+    """
+    start_date = datetime.combine(start_day, datetime.min.time())
+    end_date = datetime.combine(end_day, datetime.max.time())
+    sales = db.execute(select(
+        func.count(Sale.id), func.max(Sale.id), func.sum(Sale.price * Sale.quantity), func.sum(Sale.quantity)
+    ).where(Sale.company_id == company_id, Sale.date >= start_date, Sale.date <= end_date)).one()
+    expenses = db.execute(select(
+        func.count(Expense.id), func.max(Expense.id), func.sum(Expense.amount)
+    ).where(Expense.company_id == company_id, Expense.date >= start_date, Expense.date <= end_date)).one()
+    # Somas arredondadas: a ordem da agregação no banco não pode mudar a chave
+    parts = (tuple(sales[:2]), round(float(sales[2] or 0), 2), sales[3], tuple(expenses[:2]), round(float(expenses[2] or 0), 2),
+             partitioning.hot_start(db, 'sales'), partitioning.hot_start(db, 'expenses'))
+    return hashlib.sha256(repr(parts).encode()).hexdigest()[:16]
+
+def generate_ledger_pdf(db: Session, company_id: int, start_day: date, end_day: date) -> bytes:
+    """
+    Relatório contábil com todas as vendas e despesas de um período JÁ ENCERRADO e subtotais por categoria.
+    Quem guarda o arquivo pode reaproveitá-lo enquanto ledger_fingerprint do período não mudar.
+    """
+    if end_day >= date.today():
+        raise ValueError("O relatório detalhado só está disponível para períodos encerrados (até ontem).")
+    if start_day > end_day:
+        raise ValueError("Data inicial posterior à data final.")
+    return _ledger_pdf(db, company_id, start_day, end_day)
+
+def _ledger_pdf(db: Session, company_id: int, start_day: date, end_day: date) -> bytes:
+    start_date = datetime.combine(start_day, datetime.min.time())
+    end_date = datetime.combine(end_day, datetime.max.time())
+    company = db.query(Company.name).filter(Company.id == company_id).scalar() or ""
+    sales_by_cat, expenses_by_cat = _category_subtotals(db, company_id, start_date, end_date)
+    revenue = sum(float(total or 0) for _, _, total in sales_by_cat)
+    expenses = sum(float(total or 0) for _, _, total in expenses_by_cat)
+
+    pdf = FPDF()
+    pdf.set_auto_page_break(True, margin=15)
+    pdf.add_page()
+    pdf.set_font("helvetica", "B", 16)
+    pdf.cell(0, 10, _pdf_text(f"Relatório Financeiro Detalhado - {company}"), ln=True, align="C")
+    pdf.set_font("helvetica", "", 11)
+    pdf.cell(0, 8, f"Período: {start_day:%d/%m/%Y} a {end_day:%d/%m/%Y}", ln=True, align="C")
+    pdf.ln(4)
+    pdf.set_font("helvetica", "", 12)
+    pdf.cell(0, 8, f"Receitas: EUR {revenue:,.2f}", ln=True)
+    pdf.cell(0, 8, f"Despesas: EUR {expenses:,.2f}", ln=True)
+    pdf.set_font("helvetica", "B", 12)
+    pdf.cell(0, 8, f"Lucro: EUR {revenue - expenses:,.2f}", ln=True)
+    pdf.ln(4)
+
+    # Subtotais por categoria
+    widths, aligns = (110, 30, 50), ("L", "R", "R")
+    for title, header, rows, total in (
+        ("Receitas por categoria", ("Categoria", "Vendas", "Total (EUR)"), sales_by_cat, revenue),
+        ("Despesas por categoria", ("Categoria", "Lançamentos", "Total (EUR)"), expenses_by_cat, expenses),
+    ):
+        pdf.set_font("helvetica", "B", 12)
+        pdf.cell(0, 10, _pdf_text(title), ln=True)
+        _pdf_row(pdf, widths, header, aligns, bold=True)
+        for category, count, subtotal in rows:
+            _pdf_row(pdf, widths, (category, count, f"{float(subtotal or 0):,.2f}"), aligns)
+        _pdf_row(pdf, widths, ("Total", sum(r[1] for r in rows), f"{total:,.2f}"), aligns, bold=True)
+        pdf.ln(4)
+
+    # Lançamentos, lidos do banco em blocos
+    pdf.add_page()
+    _pdf_ledger(
+        pdf, "Vendas", ("Data", "Produto", "Qtd", "Preço", "Total"), (32, 88, 15, 25, 30), ("L", "L", "R", "R", "R"),
+        stream_sales(db, company_id, start_date, end_date),
+        lambda r: (f"{r.date:%d/%m/%Y %H:%M}", r.product_name[:50], r.quantity, f"{r.price:,.2f}", f"{r.price * r.quantity:,.2f}"))
+    _pdf_ledger(
+        pdf, "Despesas", ("Data", "Categoria", "Descrição", "Valor"), (32, 35, 93, 30), ("L", "L", "L", "R"),
+        stream_expenses(db, company_id, start_date, end_date),
+        lambda r: (f"{r.date:%d/%m/%Y %H:%M}", r.category or NO_CATEGORY, (r.description or "")[:60], f"{r.amount:,.2f}"))
+    return bytes(pdf.output())
+
+# --- EXPORTAÇÃO PARA BI (CSV / Parquet) ---
+EXPORT_STREAMS = ('sales', 'expenses')
+EXPORT_FORMATS = ('csv', 'parquet')
+
+EXPORT_SETTLE_TIMEOUT = 10.0  # segundos de espera, no máximo, pelas escritas em curso ao fixar o limite do incremental
+
+def _export_model(stream: str):
+    if stream not in EXPORT_STREAMS:
+        raise ValueError(f"Fluxo de exportação desconhecido: {stream}")
+    return Sale if stream == 'sales' else Expense
+
+def _settled_id(db: Session, model):
+    """
+    Maior id abaixo do qual nenhuma transação ainda pode gravar (limite seguro do incremental).
+    No Postgres o id é reservado no INSERT mas só fica visível no commit: uma transação lenta com
+    id menor (ex.: um lote do diário do PDV) pode aparecer depois que a marca já passou por ele.
+    Sem travar ninguém: lê o maior id visível junto com a foto (snapshot) das transações de escrita em
+    curso e espera, consultando pg_xact_status, que essas transações terminem. Qualquer id menor ainda
+    não visível pertence a uma delas; as que começarem depois recebem ids maiores. Se alguma passar de
+    EXPORT_SETTLE_TIMEOUT, o limite recua para o maior id gravado antes da mais antiga ainda aberta.
+    No SQLite as escritas já são em série, então o maior id visível basta.
+    """
+    if db.get_bind().dialect.name != 'postgresql':
+        return db.execute(select(func.max(model.id))).scalar() or 0
+    table = model.__tablename__
+    own = db.execute(text("SELECT pg_current_xact_id_if_assigned()::text")).scalar()  # a própria transação não conta
+    with db.get_bind().connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        candidate, snapshot = conn.execute(text(f"SELECT max(id), pg_current_snapshot()::text FROM {table}")).one()
+        running = [xid for xid in snapshot.split(":")[2].split(",") if xid and xid != own]
+        deadline = time.monotonic() + EXPORT_SETTLE_TIMEOUT
+        while running and time.monotonic() < deadline:
+            time.sleep(0.05)
+            running = conn.execute(text(
+                "SELECT x::text FROM unnest(CAST(:xids AS xid8[])) AS x WHERE pg_xact_status(x) = 'in progress'"
+            ), {'xids': running}).scalars().all()
+        if not running:
+            return candidate or 0
+        # age() compara ids de transação de 32 bits (xmin das linhas) respeitando a volta do contador
+        oldest = min(int(xid) for xid in running) % 2 ** 32
+        return conn.execute(text(f"SELECT max(id) FROM {table} WHERE age(xmin) > age(CAST(:xid AS xid))"),
+                            {'xid': str(oldest)}).scalar() or 0
+
+def _export_query(stream: str, company_id: int, start_date, end_date, after_id, until_id=None):
+    model = _export_model(stream)
+    if model is Sale:
+        q = select(
+            Sale.id, Sale.date, Sale.product_id, Product.sku, Product.name.label('product_name'), Product.category,
+            Sale.quantity, Sale.price, Sale.kind, Sale.user_id
+        ).join(Product, Product.id == Sale.product_id)
+    else:
+        q = select(Expense.id, Expense.date, Expense.category, Expense.description, Expense.amount)
+    q = q.where(model.company_id == company_id)
+    if start_date is not None:
+        q = q.where(model.date >= start_date)
+    if end_date is not None:
+        q = q.where(model.date <= _closing_end(end_date))
+    if after_id is not None:
+        # Incremental: o que entrou depois da marca e até o limite seguro, em ordem de id
+        return q.where(model.id > after_id, model.id <= until_id).order_by(model.id)
+    return q.order_by(model.date, model.id)
+
+def _parquet_schema(pa, stream: str):
+    # Tipos fixos: um bloco só com nulos não pode mudar o tipo da coluna entre row groups
+    ts = pa.timestamp('us')
+    if stream == 'sales':
+        return pa.schema([('id', pa.int64()), ('date', ts), ('product_id', pa.int64()), ('sku', pa.string()),
+                          ('product_name', pa.string()), ('category', pa.string()), ('quantity', pa.int64()),
+                          ('price', pa.float64()), ('kind', pa.string()), ('user_id', pa.int64())])
+    return pa.schema([('id', pa.int64()), ('date', ts), ('category', pa.string()),
+                      ('description', pa.string()), ('amount', pa.float64())])
+
+def export_rows(db: Session, company_id: int, stream: str, out, fmt: str = 'csv', start_date: datetime = None,
+                end_date: datetime = None, incremental: bool = False, chunk_size: int = STREAM_CHUNK, progress=None):
+    """
+    Exporta vendas (com SKU, nome e categoria do produto) ou despesas da empresa para `out`
+    (caminho ou arquivo binário), lendo e escrevendo bloco a bloco: CSV, ou Parquet com um row group por bloco.
+    incremental=True exporta só o que entrou depois da última exportação incremental (até o limite seguro,
+    ver _settled_id) e avança a marca d'água até esse limite.
+    progress(linhas) é chamado a cada bloco. Retorna {'rows': linhas escritas, 'last_id': marca d'água (ou maior id exportado)}.
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Formato de exportação desconhecido: {fmt}")
+    model = _export_model(stream)
+    mark = db.get(ExportWatermark, (company_id, stream)) if incremental else None
+    after_id = (mark.last_id if mark else 0) if incremental else None
+    until_id = _settled_id(db, model) if incremental else None
+    stmt = _export_query(stream, company_id, start_date, end_date, after_id, until_id)
+
+    # Sem linhas, o pandas ainda entrega um bloco vazio
+    chunks = (chunk for chunk in _stream(db, stmt, chunk_size) if not chunk.empty)
+    own_file = isinstance(out, (str, bytes)) or hasattr(out, '__fspath__')
+    target = open(out, 'wb') if own_file else out
+    rows, last_id = 0, after_id or 0
+    try:
+        if fmt == 'parquet':
+            try:
+                import pyarrow as pa
+                import pyarrow.parquet as pq
+            except ImportError:
+                raise RuntimeError("Exportação em Parquet requer o pyarrow (pip install pyarrow).")
+            schema = _parquet_schema(pa, stream)
+            with pq.ParquetWriter(target, schema) as writer:
+                for chunk in chunks:
+                    writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+                    rows += len(chunk)
+                    last_id = max(last_id, int(chunk['id'].max()))
+                    if progress:
+                        progress(rows)
+        else:
+            text = io.TextIOWrapper(target, encoding='utf-8', newline='', write_through=True)
+            for chunk in chunks:
+                chunk.to_csv(text, header=rows == 0, index=False)
+                rows += len(chunk)
+                last_id = max(last_id, int(chunk['id'].max()))
+                if progress:
+                    progress(rows)
+            if rows == 0:
+                text.write(",".join(stmt.selected_columns.keys()) + "\n")  # só o cabeçalho
+            text.detach()  # devolve o arquivo de quem chamou sem fechá-lo
+    finally:
+        if own_file:
+            target.close()
+
+    # A marca só avança depois que o arquivo foi escrito por inteiro; tudo até o limite seguro já foi visto
+    if incremental:
+        last_id = max(last_id, until_id)
+    if incremental and last_id > after_id:
+        db.merge(ExportWatermark(company_id=company_id, stream=stream, last_id=last_id, updated_at=datetime.now()))
+        db.commit()
+    return {'rows': rows, 'last_id': last_id}
+
 # --- services.py (Adicione estas funções no final) ---
 
 def register_product(db: Session, company_id: int, name: str, price_retail: float, price_wholesale: float, stock_min: int, sku: str):
@@ -158,7 +935,14 @@ def register_product(db: Session, company_id: int, name: str, price_retail: floa
         company_id=company_id
     )
     db.add(new_prod)
-    db.commit()
+    try:
+        db.commit()
+    except IntegrityError:
+        # SKU já cadastrado nesta empresa (índice único company_id + sku)
+        db.rollback()
+        return False
+    cache.invalidate(company_id, 'products')
+    _remember_sku(company_id, new_prod)
     return True
 
 def restock_product(db: Session, company_id: int, product_id: int, qty: int, cost_unit: float):
@@ -166,25 +950,64 @@ def restock_product(db: Session, company_id: int, product_id: int, qty: int, cos
     Repõe o estoque e gera uma despesa financeira automaticamente.
     Registra data, quantidade e valor unitário (via Despesa).
     """
-    product = db.query(Product).filter(Product.id == product_id).first()
-    if not product:
-        return False
+    def _restock():
+        # 1. Atualiza a quantidade no estoque (incremento atômico no banco)
+        product = stock.increment(db, company_id, product_id, qty)
+        if not product:
+            db.rollback()
+            return False
 
-    # 1. Atualiza a quantidade no estoque
-    product.stock += qty
-    
-    # 2. Registra o custo dessa reposição no financeiro
-    total_cost = qty * cost_unit
-    desc = f"Reposição Estoque: {product.name} ({qty}x €{cost_unit:.2f})"
-    
-    new_expense = Expense(
-        description=desc,
-        amount=total_cost,
-        category="Custo de Mercadoria (CMV)", # Categoria específica para estoque
-        company_id=company_id,
-        date=datetime.now()
-    )
-    db.add(new_expense)
+        # 2. Registra o custo dessa reposição no financeiro
+        total_cost = qty * cost_unit
+        desc = f"Reposição Estoque: {product.name} ({qty}x €{cost_unit:.2f})"
+
+        new_expense = Expense(
+            description=desc,
+            amount=total_cost,
+            category="Custo de Mercadoria (CMV)", # Categoria específica para estoque
+            company_id=company_id,
+            date=datetime.now()
+        )
+        db.add(new_expense)
+        ledger.record(db, company_id, [(product.id, qty, product.stock)], ledger.RESTOCK, new_expense.date,
+                      note=f"{qty}x €{cost_unit:.2f}")
+        rollup.add_expense(db, company_id, new_expense.date, new_expense.category, total_cost)
+        db.commit()
+        cache.invalidate(company_id, 'products', 'expenses')
+        return True
+    return stock.with_retry(db, _restock)
+
+def adjust_stock(db: Session, company_id: int, product_id: int, counted: int, note: str = None, user_id: int = None):
+    """Acerta o estoque pela contagem física e registra a diferença no livro. Retorna a diferença ou None."""
+    def _adjust():
+        result = stock.set_level(db, company_id, product_id, counted)
+        if result is None:
+            db.rollback()
+            return None
+        product, delta = result
+        if delta:
+            ledger.record(db, company_id, [(product.id, delta, product.stock)], ledger.ADJUSTMENT,
+                          note=note, user_id=user_id)
+        db.commit()
+        cache.invalidate(company_id, 'products')
+        return delta
+    return stock.with_retry(db, _adjust)
+
+# --- MOVIMENTAÇÕES DE ESTOQUE ---
+@cache.cached(tags=('products',))
+def get_stock_report(db: Session, company_id: int, start: datetime, end: datetime):
+    """Estoque inicial, vendas, reposições, ajustes e estoque final por produto (foto + delta)."""
+    return ledger.movement_report(db, company_id, start, end)
+
+@cache.cached(tags=('products',))
+def get_stock_movements(db: Session, company_id: int, start: datetime, end: datetime, product_id: int = None):
+    return ledger.movements(db, company_id, start, end, product_id)
+
+def add_expense(db: Session, company_id: int, description: str, amount: float, category: str, date: datetime):
+    """Lança uma despesa no financeiro (e no resumo diário)"""
+    db.add(Expense(description=description, amount=amount, category=category, company_id=company_id, date=date))
+    rollup.add_expense(db, company_id, date, category, amount)
     db.commit()
+    cache.invalidate(company_id, 'expenses')
     return True
 
@@ -0,0 +1,189 @@
+# stock.py
+# Motor de estoque: baixas e entradas atômicas, seguras com vários PDVs vendendo o mesmo SKU.
+# Em vez de ler Product.stock para o Python e gravar de volta (perde atualizações),
+# cada operação é um UPDATE condicional com RETURNING executado pelo próprio banco.
+import argparse
+import random
+import threading
+import time
+from sqlalchemy import select, update, case
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import Session
+from models import Product
+
+# Política de retentativa para conflitos transitórios (deadlock, serialização, SQLite bloqueado)
+MAX_RETRIES = 3
+BASE_DELAY = 0.05
+
+stats = {'retries': 0, 'conflicts': 0}
+_stats_lock = threading.Lock()
+
+def _is_transient(exc: DBAPIError):
+    orig = getattr(exc, 'orig', None)
+    if getattr(orig, 'pgcode', None) in ('40001', '40P01'):  # serialization_failure, deadlock_detected
+        return True
+    return 'database is locked' in str(orig)
+
+def with_retry(db: Session, fn, retries: int = MAX_RETRIES):
+    """Executa fn() e repete (com backoff exponencial) em caso de conflito transitório."""
+    for attempt in range(retries + 1):
+        try:
+            return fn()
+        except DBAPIError as exc:
+            db.rollback()
+            if not _is_transient(exc) or attempt == retries:
+                raise
+            with _stats_lock:
+                stats['retries'] += 1
+            time.sleep(BASE_DELAY * (2 ** attempt) * random.uniform(0.5, 1.5))
+
+# --- OPERAÇÕES ATÔMICAS ---
+def decrement(db: Session, company_id: int, product_id: int, qty: int):
+    """
+    Baixa qty unidades só se houver estoque suficiente.
+    Retorna a linha (id, name, price_retail, price_wholesale, stock) ou None se não houver estoque.
+    """
+    rows = decrement_many(db, company_id, {product_id: qty})
+    return rows.get(product_id)
+
+def decrement_many(db: Session, company_id: int, wanted: dict):
+    """
+    Baixa vários produtos num único UPDATE ... WHERE stock >= qty ... RETURNING.
+    wanted = {product_id: qty}. Retorna {product_id: linha} apenas dos produtos baixados;
+    quem chama deve desfazer a transação se faltar algum.
+    """
+    if not wanted:
+        return {}
+    qty = case(wanted, value=Product.id)
+    stmt = update(Product).where(
+        Product.company_id == company_id,
+        Product.id.in_(wanted.keys()),
+        Product.stock >= qty
+    ).values(stock=Product.stock - qty).returning(
+        Product.id, Product.name, Product.price_retail, Product.price_wholesale, Product.stock
+    ).execution_options(synchronize_session=False)
+    rows = {row.id: row for row in db.execute(stmt)}
+    if len(rows) < len(wanted):
+        with _stats_lock:
+            stats['conflicts'] += 1
+    return rows
+
+def increment(db: Session, company_id: int, product_id: int, qty: int):
+    """Entrada de estoque atômica. Retorna a linha atualizada ou None se o produto não existir."""
+    stmt = update(Product).where(
+        Product.company_id == company_id,
+        Product.id == product_id
+    ).values(stock=Product.stock + qty).returning(
+        Product.id, Product.name, Product.stock
+    ).execution_options(synchronize_session=False)
+    return db.execute(stmt).first()
+
+def set_level(db: Session, company_id: int, product_id: int, counted: int, retries: int = MAX_RETRIES):
+    """
+    Acerta o estoque para a contagem física (inventário).
+    UPDATE condicional ao valor lido: se uma venda mudar o estoque no meio, relê e tenta de novo,
+    até retries vezes; depois disso desiste com RuntimeError (produto vendendo sem parar).
+    Retorna (linha (id, name, stock), diferença aplicada) ou None se o produto não existir.
+    """
+    for attempt in range(retries + 1):
+        if attempt:
+            time.sleep(BASE_DELAY * (2 ** (attempt - 1)) * random.uniform(0.5, 1.5))
+        current = db.execute(select(Product.stock).where(
+            Product.company_id == company_id, Product.id == product_id)).scalar()
+        if current is None:
+            return None
+        stmt = update(Product).where(
+            Product.company_id == company_id,
+            Product.id == product_id,
+            Product.stock == current
+        ).values(stock=counted).returning(
+            Product.id, Product.name, Product.stock
+        ).execution_options(synchronize_session=False)
+        row = db.execute(stmt).first()
+        if row:
+            return row, counted - current
+        with _stats_lock:
+            stats['conflicts'] += 1
+    raise RuntimeError("O estoque do produto mudou a cada tentativa de ajuste; tente de novo em instantes.")
+
+# --- TESTE DE CARGA CONCORRENTE ---
+# Uso: python stock.py --url postgresql://... --terminals 8 --attempts 100 --stock 500
+# Com --products N cada terminal vende um de N produtos (N = terminais: nenhum SKU em comum,
+# então a única disputa entre os caixas é a da loja inteira, como o resumo diário).
+# --latency MS soma uma ida e volta simulada a cada comando e commit (banco remoto, como o Neon):
+# é o tempo em que as travas de linha ficam presas entre os comandos da venda.
+def _load_test(url: str, terminals: int, attempts: int, initial_stock: int, products: int = 1, latency: float = 0):
+    from sqlalchemy import event, func
+    from sqlalchemy.orm import sessionmaker
+    from database import Base, build_engine, engine_pool_status
+    from models import Company, Sale
+    import services
+    import stock  # services usa o módulo importado, não este __main__
+
+    # Um pool com uma conexão por terminal: a espera por conexão não entra na medição
+    engine = build_engine(url, pool_size=terminals, max_overflow=0)
+    Base.metadata.create_all(bind=engine)
+    Session_ = sessionmaker(bind=engine, autoflush=False)
+    if latency:
+        for name in ("before_cursor_execute", "commit"):
+            event.listen(engine, name, lambda *a, **k: time.sleep(latency / 1000))
+
+    with Session_() as db:
+        company = db.query(Company).filter(Company.name == "Stock Load Test").first()
+        if not company:
+            company = Company(name="Stock Load Test", license_key="LOAD", is_active=True)
+            db.add(company); db.commit()
+        items = [Product(name="Carga", sku=f"LOAD-{time.time_ns()}-{i}", price_retail=1.0,
+                         price_wholesale=1.0, stock=initial_stock, company_id=company.id) for i in range(products)]
+        db.add_all(items); db.commit()
+        company_id, product_ids = company.id, [p.id for p in items]
+
+    sold = [0] * terminals
+    latencies = []
+    lat_lock = threading.Lock()
+
+    def terminal(n):
+        with Session_() as db:
+            for _ in range(attempts):
+                t0 = time.perf_counter()
+                ok, _ = services.process_sale(db, product_ids[n % products], 1, "varejo", None, company_id)
+                dt = time.perf_counter() - t0
+                with lat_lock:
+                    latencies.append(dt)
+                if ok:
+                    sold[n] += 1
+
+    stock.stats.update(retries=0, conflicts=0)
+    threads = [threading.Thread(target=terminal, args=(n,)) for n in range(terminals)]
+    t0 = time.perf_counter()
+    for t in threads: t.start()
+    for t in threads: t.join()
+    elapsed = time.perf_counter() - t0
+
+    with Session_() as db:
+        final_stock = db.query(func.sum(Product.stock)).filter(Product.id.in_(product_ids)).scalar()
+        sales_rows = db.query(func.sum(Sale.quantity)).filter(Sale.product_id.in_(product_ids)).scalar() or 0
+
+    total_sold = sum(sold)
+    latencies.sort()
+    p = lambda q: latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000
+    initial_stock *= products
+    print(f"Terminais: {terminals}  Produtos: {products}  Tentativas: {terminals * attempts}  Estoque inicial: {initial_stock}")
+    print(f"Vendidas: {total_sold}  Linhas de venda: {sales_rows}  Estoque final: {final_stock}")
+    print(f"Retentativas: {stock.stats['retries']}  Recusas por estoque: {stock.stats['conflicts']}")
+    print(f"Vazão: {terminals * attempts / elapsed:,.1f} vendas/s  p50 {p(0.5):.1f} ms  p99 {p(0.99):.1f} ms")
+    print(f"Pool: espera máx. {engine_pool_status(engine)['wait_max_ms']:.1f} ms")
+    consistent = final_stock >= 0 and final_stock == initial_stock - total_sold and sales_rows == total_sold
+    print("OK: sem venda acima do estoque e sem atualização perdida" if consistent else "FALHA: estoque inconsistente")
+    return consistent
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Teste de carga concorrente do motor de estoque")
+    parser.add_argument("--url", default="sqlite:///stock_load_test.db")
+    parser.add_argument("--terminals", type=int, default=8)
+    parser.add_argument("--attempts", type=int, default=50)
+    parser.add_argument("--stock", type=int, default=300, help="Estoque inicial de cada produto")
+    parser.add_argument("--products", type=int, default=1, help="Produtos vendidos (terminal n vende o produto n %% N)")
+    parser.add_argument("--latency", type=float, default=0, help="Ida e volta simulada por comando, em ms")
+    args = parser.parse_args()
+    raise SystemExit(0 if _load_test(args.url, args.terminals, args.attempts, args.stock, args.products, args.latency) else 1)